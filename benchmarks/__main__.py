@@ -0,0 +1,104 @@
+from pathlib import Path
+import sys
+
+import argparse
+import importlib
+import json
+import platform
+
+from datetime import datetime, timezone
+
+# Move to the scripts/ package folder to import Lambda modules as they are deployed
+scripts_package_path = str(Path(__file__).resolve().parent.parent / 'src' / 'scripts')
+sys.path.insert(0, scripts_package_path)
+
+BENCHMARKS = {
+    'barcode': 'benchmarks.bench_barcode',
+    'catalog': 'benchmarks.bench_catalog',
+    'clients': 'benchmarks.bench_clients',
+    'coldstart': 'benchmarks.bench_coldstart',
+    'isbn': 'benchmarks.bench_isbn',
+    'pipeline': 'benchmarks.bench_pipeline',
+    'providers': 'benchmarks.bench_providers'
+}
+
+def _leaves(results: dict, prefix: str = '') -> dict[str,float]:
+    # Flatten the numeric results into dotted paths (e.g., pipeline.nominal.records_per_sec)
+    leaves = {}
+    for key, value in results.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            leaves.update(_leaves(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            leaves[path] = value
+    return leaves
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compare the throughputs (*_per_sec, higher is better) and latencies (*_ms, lower is better)
+    of the results against a baseline.
+
+    Args:
+        results: Results of the current run, by benchmark name.
+        baseline: Results of a previous run, by benchmark name.
+        tolerance: Relative change allowed before a value is reported (e.g., 0.2 for 20%).
+
+    Returns:
+        list[str]: The description of each value which regressed beyond the tolerance.
+    """
+    current = _leaves(results)
+    previous = _leaves(baseline)
+    regressions = []
+    for path in sorted(current.keys() & previous.keys()):
+        value, reference = current[path], previous[path]
+        if not reference:
+            continue
+        if path.endswith('_per_sec'):
+            change = (reference - value) / reference
+        elif path.endswith('_ms'):
+            change = (value - reference) / reference
+        else:
+            continue
+        if change > tolerance:
+            regressions.append(f'{path}: {reference} -> {value} ({change:+.0%} worse)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run local benchmarks of the Lambda scripts.')
+    parser.add_argument('names', nargs='*', help=f'Benchmarks to run among {', '.join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--output', type=Path, help='JSON file where the results are saved')
+    parser.add_argument('--baseline', type=Path, help='JSON file of previous results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change allowed before a value is reported as a regression (default: 0.2)')
+    args = parser.parse_args()
+
+    unknown_names = set(args.names) - set(BENCHMARKS)
+    if unknown_names:
+        parser.error(f'Unknown benchmarks: {', '.join(sorted(unknown_names))}')
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = importlib.import_module(BENCHMARKS[name]).run()
+        print(f'[{name}]')
+        print(json.dumps(results[name], indent=4))
+
+    if args.output:
+        args.output.write_text(json.dumps({
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results
+        }, indent=4))
+
+    if args.baseline:
+        regressions = find_regressions(results, json.loads(args.baseline.read_text())['results'], args.tolerance)
+        print('[regressions]')
+        print('\n'.join(regressions) or 'None')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
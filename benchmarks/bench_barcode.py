@@ -0,0 +1,35 @@
+import time
+import statistics
+
+from pathlib import Path
+
+import barcode
+
+IMAGES_PATH = Path(__file__).resolve().parent.parent / 'img'
+REPETITIONS = 5
+
+def run() -> dict[str,dict]:
+    """
+    Measure the local EAN-13 decoding latency of the sample images, which fall back
+    to Rekognition text detection when no barcode is decoded.
+    """
+    if not barcode.AVAILABLE:
+        return {'error': 'NumPy and Pillow are required for barcode decoding'}
+
+    results = {}
+    for image_path in sorted(IMAGES_PATH.glob('*.jpg')):
+        image_bytes = image_path.read_bytes()
+        durations = []
+        for _ in range(REPETITIONS):
+            start = time.perf_counter()
+            code = barcode.decode_ean13(image_bytes)
+            durations.append(time.perf_counter() - start)
+
+        results[image_path.name] = {
+            'code': code,
+            'path': 'barcode' if code else 'rekognition',
+            'p50_ms': round(statistics.median(durations) * 1000, 1),
+            'max_ms': round(max(durations) * 1000, 1)
+        }
+
+    return results
@@ -0,0 +1,95 @@
+import time
+import random
+import tempfile
+import tracemalloc
+
+from pathlib import Path
+
+from catalog import CatalogIndex, write_index
+from isbn import isbn10_to_isbn13
+from metrics import percentile
+
+BOOKS = 100000
+LOOKUPS = 20000
+
+def synthetic_books(count: int, seed: int = 0) -> list[dict]:
+    """
+    Build the structured book data of known books with ISBN numbers derived from their position.
+    """
+    generator = random.Random(seed)
+    return [
+        {
+            'isbn': isbn10_to_isbn13(f'{position * 7:09d}'),
+            'authors': [f'Author {generator.randrange(5000)}'],
+            'title': f'Title {position}: {generator.choice(['Volume', 'Edition', 'Notes'])} {generator.randrange(10)}',
+            'categories': [generator.choice(['Fiction', 'History', 'Science', 'Philosophy'])],
+            'page_count': generator.randrange(80, 900),
+            'language': generator.choice(['EN', 'ES', 'FR']),
+            'publisher': f'Publisher {generator.randrange(300)}',
+            'year': generator.randrange(1950, 2025),
+            'exception': 0
+        }
+        for position in range(count)
+    ]
+
+
+def _lookups(index: CatalogIndex, isbns: list[str]) -> dict:
+    latencies = []
+    found = 0
+    start = time.perf_counter()
+    for isbn in isbns:
+        lookup_start = time.perf_counter()
+        found += index.get(isbn) is not None
+        latencies.append((time.perf_counter() - lookup_start) * 1000)
+    duration = time.perf_counter() - start
+    return {
+        'lookups_per_sec': round(len(isbns) / duration),
+        'p50_ms': round(percentile(latencies, 50), 4),
+        'p95_ms': round(percentile(latencies, 95), 4),
+        'p99_ms': round(percentile(latencies, 99), 4),
+        'found': found
+    }
+
+
+def run() -> dict[str,dict]:
+    """
+    Measure the lookup latency of the memory-mapped catalog index for known and unknown ISBN
+    numbers, and its footprint against holding the same books in a dict.
+    """
+    books = synthetic_books(BOOKS)
+    generator = random.Random(1)
+    hits = [book['isbn'] for book in generator.choices(books, k=LOOKUPS)]
+    misses = [isbn10_to_isbn13(f'{position * 7 + 3:09d}') for position in generator.choices(range(BOOKS), k=LOOKUPS)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / 'isbn.idx'
+        start = time.perf_counter()
+        write_index(books, path)
+        build_s = time.perf_counter() - start
+
+        # Mapped pages are not allocated by Python, so the heap only holds the lookup results
+        tracemalloc.start()
+        start = time.perf_counter()
+        index = CatalogIndex(path)
+        open_ms = (time.perf_counter() - start) * 1000
+        results = {'hits': _lookups(index, hits), 'misses': _lookups(index, misses)}
+        index_heap = tracemalloc.get_traced_memory()[1]
+        index.close()
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        in_memory = {book['isbn']: dict(book) for book in books}
+        dict_heap = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del in_memory
+
+        results['footprint'] = {
+            'books': BOOKS,
+            'build_books_per_sec': round(BOOKS / build_s),
+            'open_ms': round(open_ms, 4),
+            'index_bytes': path.stat().st_size,
+            'bytes_per_book': round(path.stat().st_size / BOOKS, 1),
+            'index_heap_peak_bytes': index_heap,
+            'dict_heap_bytes': dict_heap
+        }
+    return results
@@ -0,0 +1,88 @@
+import os
+import time
+import json
+import statistics
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from clients import KeepAliveSession, get_client
+from benchmarks.stubs import GoogleBooksStub
+
+ISBNS = [f'978{index:010d}' for index in range(200)]
+
+# Invocations of the worker pool scenario, each one with a new pool as lambda_handler does
+INVOCATIONS = 20
+WORKERS = 4
+
+def _per_call_ms(durations: list[float]) -> dict[str,float]:
+    return {
+        'mean_ms': round(statistics.mean(durations) * 1000, 3),
+        'p50_ms': round(statistics.median(durations) * 1000, 3)
+    }
+
+
+def _time_calls(call, arguments) -> list[float]:
+    durations = []
+    for argument in arguments:
+        start = time.perf_counter()
+        call(argument)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run() -> dict[str,dict]:
+    """
+    Compare a new connection per Google Books lookup and a new boto3 client per invocation
+    against the persistent client layer of the clients module, whose connections are also
+    reused by the new worker pools of successive invocations.
+    """
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    results = {}
+
+    with GoogleBooksStub() as stub:
+        path = '/books/v1/volumes?q=isbn:'
+
+        def urlopen_lookup(isbn):
+            with urllib.request.urlopen(stub.url + path + isbn) as req:
+                return json.loads(req.read().decode())
+
+        connections = stub.connections
+        results['books_urlopen'] = _per_call_ms(_time_calls(urlopen_lookup, ISBNS))
+        results['books_urlopen']['connections'] = stub.connections - connections
+
+        session = KeepAliveSession(stub.url)
+        connections = stub.connections
+        results['books_keepalive'] = _per_call_ms(
+            _time_calls(lambda isbn: json.loads(session.get(path + isbn)), ISBNS)
+        )
+        results['books_keepalive']['connections'] = stub.connections - connections
+        session.close()
+
+        # Connections are checked out of the session, so that they outlive the threads of each invocation
+        session = KeepAliveSession(stub.url)
+        connections = stub.connections
+        batch = len(ISBNS) // INVOCATIONS
+
+        def invocation(index):
+            with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+                list(executor.map(lambda isbn: json.loads(session.get(path + isbn)), ISBNS[index:index + batch]))
+
+        results['books_keepalive_invocations'] = _per_call_ms(
+            _time_calls(invocation, range(0, len(ISBNS), batch))
+        )
+        results['books_keepalive_invocations']['connections'] = stub.connections - connections
+        session.close()
+
+    # Client construction only, since no requests are sent to AWS
+    invocations = range(20)
+    results['rekognition_new_client'] = _per_call_ms(
+        _time_calls(lambda _: boto3.client('rekognition'), invocations)
+    )
+    results['rekognition_pooled_client'] = _per_call_ms(
+        _time_calls(lambda _: get_client('rekognition'), invocations)
+    )
+
+    return results
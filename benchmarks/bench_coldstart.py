@@ -0,0 +1,111 @@
+from pathlib import Path
+import sys
+
+import os
+import json
+import time
+import statistics
+import subprocess
+
+from benchmarks.stubs import AwsJsonStub, GoogleBooksStub
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+REPETITIONS = 5
+
+# Variants of the handler environment whose cold starts are compared
+VARIANTS = {
+    'lazy_clients': {'INIT_CLIENTS': 'false'},
+    'init_clients': {'INIT_CLIENTS': 'true'}
+}
+
+EVENT = {
+    'Records': [
+        {
+            's3': {
+                'bucket': {'name': 'my-bucket'},
+                'object': {'key': 'cover.jpg'}
+            },
+            'eventTime': '2025-01-01T00:00:00.000Z'
+        }
+    ]
+}
+
+def _aws_handlers() -> dict:
+    return {
+        'RekognitionService.DetectText': lambda request: {
+            'TextDetections': [{'DetectedText': 'ISBN 978-0-306-40615-7', 'Type': 'LINE', 'Confidence': 99.0}]
+        },
+        'DynamoDB_20120810.GetItem': lambda request: {},
+        'DynamoDB_20120810.PutItem': lambda request: {},
+        'DynamoDB_20120810.BatchWriteItem': lambda request: {'UnprocessedItems': {}}
+    }
+
+
+def _child() -> None:
+    # Runs in a new interpreter, so that every import of the handler is a cold one
+    sys.path.insert(0, str(ROOT_PATH / 'src' / 'scripts'))
+
+    start = time.perf_counter()
+    import handler
+    import_ms = (time.perf_counter() - start) * 1000
+
+    invocations_ms = []
+    for _ in range(2):
+        start = time.perf_counter()
+        response = handler.lambda_handler(EVENT, None)
+        invocations_ms.append((time.perf_counter() - start) * 1000)
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'first_invocation_ms': invocations_ms[0],
+        'warm_invocation_ms': invocations_ms[1],
+        'status': response['results'][0]['status'],
+        'numpy_imported': 'numpy' in sys.modules,
+        'pillow_imported': 'PIL' in sys.modules
+    }))
+
+
+def _cold_start(environment: dict[str,str]) -> dict:
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench_coldstart'],
+        cwd=ROOT_PATH, env=environment, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run() -> dict[str,dict]:
+    """
+    Measure the import time of the handler and the latency of its first and second
+    invocations in new interpreters, against local Rekognition, DynamoDB and Google Books stubs.
+    """
+    results = {}
+    with AwsJsonStub(_aws_handlers()) as aws_stub, GoogleBooksStub() as books_stub:
+        base_environment = {
+            **os.environ,
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'AWS_EC2_METADATA_DISABLED': 'true',
+            'AWS_ENDPOINT_URL_REKOGNITION': aws_stub.url,
+            'AWS_ENDPOINT_URL_DYNAMODB': aws_stub.url,
+            'GOOGLE_BOOKS_URL': books_stub.url,
+            'TABLE_NAME': 'isbn_events',
+            'CACHE_TABLE_NAME': 'isbn_cache'
+        }
+
+        for name, variables in VARIANTS.items():
+            runs = [_cold_start({**base_environment, **variables}) for _ in range(REPETITIONS)]
+            results[name] = {
+                key: round(statistics.median(run[key] for run in runs), 1)
+                for key in ('import_ms', 'first_invocation_ms', 'warm_invocation_ms')
+            }
+            results[name]['cold_start_ms'] = round(results[name]['import_ms'] + results[name]['first_invocation_ms'], 1)
+            results[name]['statuses'] = sorted({run['status'] for run in runs})
+            results[name]['numpy_imported'] = any(run['numpy_imported'] for run in runs)
+            results[name]['pillow_imported'] = any(run['pillow_imported'] for run in runs)
+
+    return results
+
+
+if __name__ == '__main__':
+    _child()
@@ -0,0 +1,64 @@
+import time
+import random
+
+from isbn import extract_isbn, extract_isbn_batch, isbn10_to_isbn13
+
+WORDS = ['Las', 'palabras', 'y', 'las', 'cosas', 'Siglo', 'XXI', 'editores', 'Precio', '$', '24.99']
+
+def _detection(text: str, detection_type: str = 'LINE') -> dict:
+    return {
+        'DetectedText': text,
+        'Type': detection_type,
+        'Confidence': random.uniform(70, 100),
+        'Geometry': {
+            'BoundingBox': {
+                'Width': random.uniform(0.1, 0.8),
+                'Height': random.uniform(0.01, 0.1),
+                'Left': random.uniform(0, 0.5),
+                'Top': random.uniform(0, 0.9)
+            }
+        }
+    }
+
+
+def synthetic_response(seed: int) -> dict:
+    """
+    Build a DetectText response with noisy lines and words around a printed ISBN number
+    and the digits below its barcode.
+    """
+    random.seed(seed)
+    # The check digit of an ISBN-10 number is not used to build its ISBN-13 form
+    isbn = isbn10_to_isbn13(f'{seed:09d}')
+    detections = [_detection(' '.join(random.choices(WORDS, k=5))) for _ in range(8)]
+    detections.append(_detection(f'ISBN {isbn[:3]}-{isbn[3:6]}-{isbn[6:9]}-{isbn[9:12]}-{isbn[12]}'))
+    detections.append(_detection(f'{isbn[0]} {isbn[1:7]} {isbn[7:]}'))
+    detections += [_detection(word, 'WORD') for word in random.choices(WORDS, k=30)]
+    return {'TextDetections': detections}
+
+
+def run() -> dict[str,dict]:
+    """
+    Measure the throughput of the ISBN parser over synthetic DetectText responses.
+    """
+    responses = [synthetic_response(seed) for seed in range(2000)]
+    results = {}
+
+    start = time.perf_counter()
+    isbns = [extract_isbn(response['TextDetections']) for response in responses]
+    duration = time.perf_counter() - start
+    results['single'] = {
+        'responses_per_sec': round(len(responses) / duration),
+        'mean_us': round(duration / len(responses) * 10 ** 6, 1),
+        'found': sum(isbn is not None for isbn in isbns)
+    }
+
+    start = time.perf_counter()
+    isbns = extract_isbn_batch(responses)
+    duration = time.perf_counter() - start
+    results['batch'] = {
+        'responses_per_sec': round(len(responses) / duration),
+        'mean_us': round(duration / len(responses) * 10 ** 6, 1),
+        'found': sum(isbn is not None for isbn in isbns)
+    }
+
+    return results
@@ -0,0 +1,143 @@
+import json
+import time
+import random
+import logging
+
+from collections import Counter
+from unittest.mock import patch
+
+import cache
+import clients
+import handler
+import writer
+
+from cache import AnalysisCache, ISBNCache, LRUCache, DynamoDBCache
+from clients import KeepAliveSession
+from metrics import get_metrics
+from benchmarks.bench_isbn import synthetic_response
+from benchmarks.stubs import Faults, FakeRekognition, FakeTable, GoogleBooksStub
+
+INVOCATIONS = 20
+RECORDS_PER_INVOCATION = 10
+
+# Share of the records whose image was already uploaded, which are served by the dedup and ISBN caches
+REPEATED_SHARE = 0.25
+
+# Latencies are scaled down from production values to keep the suite short
+SCENARIOS = {
+    'nominal': {
+        'rekognition': Faults(latency=0.02, jitter=0.02),
+        'books': Faults(latency=0.01, jitter=0.01),
+        'dynamodb': Faults(latency=0.005, jitter=0.005)
+    },
+    'throttled': {
+        'rekognition': Faults(latency=0.02, jitter=0.02, throttle_rate=0.05, seed=1),
+        'books': Faults(latency=0.01, jitter=0.01, throttle_rate=0.05, seed=2),
+        'dynamodb': Faults(latency=0.005, jitter=0.005, throttle_rate=0.2, seed=3)
+    },
+    'errors': {
+        'rekognition': Faults(latency=0.02, jitter=0.02, error_rate=0.05, seed=4),
+        'books': Faults(latency=0.01, jitter=0.01, error_rate=0.05, seed=5),
+        'dynamodb': Faults(latency=0.005, jitter=0.005, error_rate=0.05, seed=6)
+    }
+}
+
+def synthetic_events(invocations: int, records_per_invocation: int, seed: int = 0) -> tuple[list[dict], dict[str,dict]]:
+    """
+    Build SQS batches of S3 events whose images are named after the seed of their DetectText
+    response, repeating a share of the images to exercise the dedup and ISBN caches. Batches
+    are used instead of direct S3 events, which fail the invocation when records are deferred.
+
+    Returns:
+        tuple[list[dict], dict[str,dict]]: The events and the DetectText response of each key.
+    """
+    generator = random.Random(seed)
+    seeds = []
+    for _ in range(invocations * records_per_invocation):
+        repeated = seeds and generator.random() < REPEATED_SHARE
+        seeds.append(generator.choice(seeds) if repeated else len(seeds) + 1)
+
+    responses = {f'cover-{image_seed}.jpg': synthetic_response(image_seed) for image_seed in set(seeds)}
+    events = []
+    for index in range(0, len(seeds), records_per_invocation):
+        events.append({
+            'Records': [
+                {
+                    'eventSource': 'aws:sqs',
+                    'messageId': f'{index + position}',
+                    'body': json.dumps({'Records': [{
+                        's3': {
+                            'bucket': {'name': 'images-bucket'},
+                            'object': {'key': f'cover-{image_seed}.jpg', 'eTag': f'{image_seed:032x}'}
+                        },
+                        'eventTime': f'2025-01-01T00:{index // 60:02d}:{index % 60:02d}.{position:03d}Z'
+                    }]})
+                }
+                for position, image_seed in enumerate(seeds[index:index + records_per_invocation])
+            ]
+        })
+    return events, responses
+
+
+def run_scenario(faults: dict[str,Faults], events: list[dict], responses: dict[str,dict]) -> dict:
+    """
+    Replay S3 events through the Lambda handler against stand-ins of Rekognition, DynamoDB
+    and the Google Books API with the injected faults.
+    """
+    rekognition = FakeRekognition(lambda image: responses[image['S3Object']['Name']], faults['rekognition'])
+    tables = {'isbn_events': FakeTable(faults['dynamodb']), 'isbn_cache': FakeTable(faults['dynamodb'])}
+    isbn_cache = ISBNCache(LRUCache(1024, 900), DynamoDBCache('isbn_cache'))
+    analysis_cache = AnalysisCache(LRUCache(1024, 900))
+
+    metrics = get_metrics()
+    metrics.emit = False
+    metrics.clear()
+
+    with GoogleBooksStub(faults['books']) as books_stub, \
+         patch.object(handler, 'get_client', lambda service_name: rekognition), \
+         patch.object(writer, 'get_table', tables.get), \
+         patch.object(cache, 'get_table', tables.get), \
+         patch.object(cache, '_isbn_cache', isbn_cache), \
+         patch.object(cache, '_analysis_cache', analysis_cache), \
+         patch.object(clients, '_books_session', KeepAliveSession(books_stub.url)), \
+         patch.dict('os.environ', {'TABLE_NAME': 'isbn_events'}):
+        statuses = Counter()
+        start = time.perf_counter()
+        for event in events:
+            for result in handler.lambda_handler(event, None)['results']:
+                statuses[result['status']] += 1
+        duration = time.perf_counter() - start
+        clients._books_session.close()
+
+    records = sum(statuses.values())
+    return {
+        'faults': {service: service_faults.to_dict() for service, service_faults in faults.items()},
+        'records': records,
+        'succeeded': statuses['SUCCESS'],
+        'failed': statuses['FAILED'],
+        'deferred': statuses['DEFERRED'],
+        'duration_s': round(duration, 3),
+        'records_per_sec': round(records / duration, 2),
+        'rekognition_calls': rekognition.calls,
+        'books_requests': books_stub.requests,
+        'items_written': len(tables['isbn_events'].items),
+        'stages': {
+            stage: {key: round(value, 3) if isinstance(value, float) else value for key, value in summary.items()}
+            for stage, summary in sorted(metrics.summary().items())
+        }
+    }
+
+
+def run() -> dict[str,dict]:
+    """
+    Measure the records per second and the p50, p95 and p99 latencies of each stage of the
+    pipeline under nominal, throttled and failing downstream services.
+    """
+    events, responses = synthetic_events(INVOCATIONS, RECORDS_PER_INVOCATION)
+
+    # Keep the logs of the injected failures out of the benchmark output
+    logging.disable(logging.CRITICAL)
+    try:
+        return {name: run_scenario(faults, events, responses) for name, faults in SCENARIOS.items()}
+    finally:
+        logging.disable(logging.NOTSET)
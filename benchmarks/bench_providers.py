@@ -0,0 +1,103 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import clients
+import providers
+
+from clients import KeepAliveSession
+from metrics import get_metrics, percentile
+from providers import OpenLibraryProvider, hedged_lookup
+from utils import GoogleBooksProvider
+from benchmarks.stubs import Faults, GoogleBooksStub, OpenLibraryStub
+
+LOOKUPS = 300
+WARMUP_LOOKUPS = 50
+WORKERS = 8
+
+# Latencies are scaled down from production values, with a share of Google Books
+# requests slowed down as its stragglers
+SCENARIOS = {
+    'tail': {
+        'books': Faults(latency=0.01, jitter=0.01, tail_rate=0.03, tail_latency=0.3, seed=1),
+        'openlibrary': Faults(latency=0.02, jitter=0.01, seed=2)
+    },
+    'slow_secondary': {
+        'books': Faults(latency=0.01, jitter=0.01, tail_rate=0.03, tail_latency=0.3, seed=3),
+        'openlibrary': Faults(latency=0.2, jitter=0.1, seed=4)
+    }
+}
+
+
+def run_scenario(faults: dict[str,Faults], hedged: bool) -> dict:
+    """
+    Look up distinct ISBN numbers with Google Books alone or hedged with Open Library,
+    against local stubs of both APIs with the injected faults.
+    """
+    metrics = get_metrics()
+    metrics.emit = False
+    metrics.clear()
+
+    with GoogleBooksStub(faults['books']) as books_stub, \
+         OpenLibraryStub(faults['openlibrary']) as open_library_stub, \
+         patch.object(clients, '_books_session', KeepAliveSession(books_stub.url)), \
+         patch.object(providers, '_executor', ThreadPoolExecutor(max_workers=2 * WORKERS)):
+        lookup_providers = [GoogleBooksProvider()]
+        if hedged:
+            lookup_providers.append(OpenLibraryProvider(KeepAliveSession(open_library_stub.url)))
+
+        def timed(isbn):
+            start = time.perf_counter()
+            book_data = hedged_lookup(isbn, lookup_providers)
+            return (time.perf_counter() - start) * 1000, book_data
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            # The first lookups measure the latencies which the hedge delay is derived from
+            list(executor.map(timed, (f'978{number:010d}' for number in range(WARMUP_LOOKUPS))))
+            metrics.clear()
+            start = time.perf_counter()
+            results = list(executor.map(timed, (f'979{number:010d}' for number in range(LOOKUPS))))
+            duration = time.perf_counter() - start
+
+        # Abandoned lookups are awaited, so that the latencies of every provider are complete
+        providers._executor.shutdown(wait=True)
+
+    latencies = [latency for latency, _ in results]
+    summary = metrics.summary()
+    return {
+        'lookups': LOOKUPS,
+        'found': sum(book_data is not None for _, book_data in results),
+        'hedged': sum(record.get('hedged', 0) for record in metrics.records('lookup')),
+        'lookups_per_sec': round(LOOKUPS / duration, 2),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'hedge_delay_ms': round(lookup_providers[0].hedge_delay() * 1000, 3),
+        'providers': {
+            provider.name: {
+                'requests': summary.get(provider.name, {}).get('count', 0),
+                **{
+                    key: round(value, 3) for key, value in summary.get(provider.name, {}).items()
+                    if key.endswith('_ms')
+                }
+            }
+            for provider in lookup_providers
+        },
+        'books_requests': books_stub.requests,
+        'openlibrary_requests': open_library_stub.requests
+    }
+
+
+def run() -> dict[str,dict]:
+    """
+    Measure the latency percentiles of the metadata lookups, and of each provider, with and
+    without hedging the slow Google Books lookups with Open Library.
+    """
+    results = {}
+    for name, faults in SCENARIOS.items():
+        results[name] = {
+            'single': run_scenario(faults, hedged=False),
+            'hedged': run_scenario(faults, hedged=True)
+        }
+    return results
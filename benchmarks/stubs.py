@@ -0,0 +1,340 @@
+import gzip
+import json
+import time
+import random
+import socket
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.exceptions import ClientError
+
+
+class Faults:
+    """
+    Latency, errors and throttling injected into a stand-in service, drawn independently
+    for every call with a seeded generator.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, tail_rate: float = 0.0, tail_latency: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self) -> str | None:
+        """
+        Sleep for the injected latency and draw the outcome of a call.
+
+        Returns:
+            str | None: 'throttle' or 'error' for failed calls, or None for successful ones.
+        """
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            # A share of the calls is slowed down by the tail latency, as the stragglers of a real service
+            if self._random.random() < self.tail_rate:
+                delay += self.tail_latency
+            draw = self._random.random()
+        if delay > 0:
+            time.sleep(delay)
+        if draw < self.throttle_rate:
+            return 'throttle'
+        if draw < self.throttle_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def to_dict(self) -> dict[str,float]:
+        return {
+            'latency_s': self.latency,
+            'jitter_s': self.jitter,
+            'error_rate': self.error_rate,
+            'throttle_rate': self.throttle_rate,
+            'tail_rate': self.tail_rate,
+            'tail_latency_s': self.tail_latency
+        }
+
+
+def volume_response(isbn: str) -> dict:
+    """
+    Build a Google Books 'volumes' response with a single matching volume for the ISBN.
+    """
+    return {
+        'kind': 'books#volumes',
+        'totalItems': 1,
+        'items': [
+            {
+                'volumeInfo': {
+                    'title': 'Las palabras y las cosas',
+                    'subtitle': 'una arqueología de las ciencias humanas',
+                    'authors': ['Michel Foucault'],
+                    'publisher': 'Siglo XXI',
+                    'publishedDate': '2011-03-20',
+                    'industryIdentifiers': [
+                        {'type': 'ISBN_10', 'identifier': isbn[3:] if len(isbn) == 13 else isbn},
+                        {'type': 'ISBN_13', 'identifier': isbn}
+                    ],
+                    'pageCount': 398,
+                    'categories': ['Civilization'],
+                    'language': 'es'
+                }
+            }
+        ]
+    }
+
+
+def _query_isbns(path: str) -> list[str]:
+    # Both single 'isbn:X' queries and combined 'isbn:X OR isbn:Y' queries are supported
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query).get('q', [''])[0]
+    return [term.split(':', 1)[1] for term in query.split(' OR ') if term.startswith('isbn:')]
+
+
+class GoogleBooksStub:
+    """
+    Local HTTP/1.1 server which mimics the 'volumes' endpoint of the Google Books API,
+    supporting keep-alive connections, gzip-encoded responses, combined ISBN queries and
+    injected faults, which are answered with 500 and 429 status codes.
+    """
+    def __init__(self, faults: Faults | None = None):
+        stub = self
+        self.faults = faults or Faults()
+        self.connections = 0
+        self.requests = 0
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Avoid delayed ACK stalls between the header and body writes of keep-alive responses
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                stub.connections += 1
+
+            def do_GET(self):
+                stub.requests += 1
+                outcome = stub.faults.apply()
+                if outcome is not None:
+                    status = 429 if outcome == 'throttle' else 500
+                    body = json.dumps({'error': {'code': status}}).encode()
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                isbns = _query_isbns(self.path)
+                items = [item for isbn in isbns for item in volume_response(isbn)['items']]
+                body = json.dumps({'kind': 'books#volumes', 'totalItems': len(items), 'items': items}).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def edition_response(isbn: str) -> dict:
+    """
+    Build the edition of the Open Library Books API (jscmd=data) for the ISBN.
+    """
+    return {
+        'title': 'Las palabras y las cosas',
+        'subtitle': 'una arqueología de las ciencias humanas',
+        'authors': [{'name': 'Michel Foucault', 'url': 'https://openlibrary.org/authors/OL20992A'}],
+        'publishers': [{'name': 'Siglo XXI'}],
+        'publish_date': 'March 2011',
+        'identifiers': {'isbn_13': [isbn] if len(isbn) == 13 else []},
+        'number_of_pages': 398,
+        'subjects': [{'name': 'Civilization'}, {'name': 'Philosophy'}]
+    }
+
+
+class OpenLibraryStub:
+    """
+    Local HTTP/1.1 server which mimics the Books API of Open Library, answering the editions
+    of the 'bibkeys' of each request except the unknown ISBN numbers, and injected faults
+    with 500 and 429 status codes.
+    """
+    def __init__(self, faults: Faults | None = None, unknown: set[str] | None = None):
+        stub = self
+        self.faults = faults or Faults()
+        self.unknown = unknown or set()
+        self.requests = 0
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                stub.requests += 1
+                outcome = stub.faults.apply()
+                if outcome is not None:
+                    status = 429 if outcome == 'throttle' else 500
+                    body = b'{}'
+                else:
+                    status = 200
+                    bibkeys = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('bibkeys', [''])[0]
+                    body = json.dumps({
+                        bibkey: edition_response(bibkey.split(':', 1)[1])
+                        for bibkey in bibkeys.split(',')
+                        if bibkey.startswith('ISBN:') and bibkey.split(':', 1)[1] not in stub.unknown
+                    }).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AwsJsonStub:
+    """
+    Local HTTP/1.1 server which mimics AWS services of the JSON protocol (e.g., Rekognition
+    and DynamoDB), answering each X-Amz-Target operation with the response of its handler.
+    """
+    def __init__(self, handlers: dict):
+        stub = self
+        self.handlers = handlers
+        self.requests = {}
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                target = self.headers.get('X-Amz-Target', '')
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                stub.requests[target] = stub.requests.get(target, 0) + 1
+
+                handler = stub.handlers.get(target)
+                if handler is None:
+                    status, body = 400, {'__type': 'UnknownOperationException', 'message': target}
+                else:
+                    status, body = 200, handler(request)
+                body = json.dumps(body).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-amz-json-1.1')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _client_error(outcome: str, operation: str) -> ClientError:
+    code = 'ThrottlingException' if outcome == 'throttle' else 'InternalServerError'
+    return ClientError({'Error': {'Code': code, 'Message': f'Injected {outcome}'}}, operation)
+
+
+class FakeRekognition:
+    """
+    In-process Rekognition client whose DetectText responses are built by a function of
+    the requested image, with injected faults raised as ClientError.
+    """
+    def __init__(self, responses, faults: Faults | None = None):
+        self.responses = responses
+        self.faults = faults or Faults()
+        self.calls = 0
+
+    def detect_text(self, Image: dict, **kwargs) -> dict:
+        self.calls += 1
+        outcome = self.faults.apply()
+        if outcome is not None:
+            raise _client_error(outcome, 'DetectText')
+        return self.responses(Image)
+
+
+class FakeTable:
+    """
+    In-process stand-in of the DynamoDB tables of clients.get_table, which keeps
+    items in memory. Throttled BatchWriteItem calls return the whole batch as unprocessed
+    items, as DynamoDB does when partitions are throttled.
+    """
+    def __init__(self, faults: Faults | None = None):
+        self.faults = faults or Faults()
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def get_item(self, Key: dict) -> dict:
+        outcome = self.faults.apply()
+        if outcome is not None:
+            raise _client_error(outcome, 'GetItem')
+        with self._lock:
+            item = self.items.get(tuple(Key.values()))
+        return {'Item': item} if item is not None else {}
+
+    def put_item(self, Item: dict) -> dict:
+        outcome = self.faults.apply()
+        if outcome is not None:
+            raise _client_error(outcome, 'PutItem')
+        with self._lock:
+            self.items[(Item['isbn'],)] = Item
+        return {}
+
+    def batch_write_item(self, RequestItems: dict) -> dict:
+        outcome = self.faults.apply()
+        if outcome == 'error':
+            raise _client_error(outcome, 'BatchWriteItem')
+        if outcome == 'throttle':
+            return {'UnprocessedItems': RequestItems}
+        with self._lock:
+            for requests in RequestItems.values():
+                for request in requests:
+                    item = request['PutRequest']['Item']
+                    self.items[(item['isbn'], item['timestamp'])] = item
+        return {'UnprocessedItems': {}}
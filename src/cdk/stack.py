@@ -12,10 +12,14 @@ from aws_cdk import (
     aws_apigateway as apigateway,
     aws_dynamodb as dynamodb,
     aws_s3 as s3,
-    aws_logs as logs
+    aws_s3_notifications as s3_notifications,
+    aws_sqs as sqs,
+    aws_logs as logs,
+    aws_cloudwatch as cloudwatch
 )
 
 config_file = Path(__file__).parent.parent / 'config.conf'
+scripts_path = Path(__file__).parent.parent / 'scripts'
 parser = ConfigParser()
 parser.read(config_file)
 
@@ -34,6 +38,17 @@ if TRANSITION_DAYS > 0 and EXPIRATION_DAYS > TRANSITION_DAYS:
 else:
     transition_state = None
 
+# Raw detections are kept in their own bucket, out of the expiration of the images
+ENABLE_ARCHIVE = parser.getboolean('archiveOptions', 'enableArchive')
+ARCHIVE_BUCKET_NAME = parser.get('archiveOptions', 'bucketName').strip()
+ARCHIVE_PREFIX = parser.get('archiveOptions', 'prefix').strip()
+ARCHIVE_TRANSITION_DAYS = parser.getint('archiveOptions', 'transitionDays')
+
+if ENABLE_ARCHIVE and (not ARCHIVE_BUCKET_NAME or ARCHIVE_BUCKET_NAME == BUCKET_NAME):
+    raise ValueError(f'Invalid archive bucket name: {ARCHIVE_BUCKET_NAME}')
+if not ARCHIVE_PREFIX.endswith('/') or ARCHIVE_TRANSITION_DAYS < 0:
+    raise ValueError(f'Invalid archive options: prefix {ARCHIVE_PREFIX}, transitionDays {ARCHIVE_TRANSITION_DAYS}')
+
 REMOVAL_POLICY = parser.get('storagePolicies', 'removalPolicy').strip().upper()
 
 if REMOVAL_POLICY == 'DESTROY':
@@ -43,6 +58,199 @@ elif REMOVAL_POLICY == 'RETAIN':
 else:
     raise ValueError(f'Invalid removal policy: {REMOVAL_POLICY}')
 
+CAPACITY_MODE = parser.get('tableOptions', 'capacityMode').strip().upper()
+READ_CAPACITY = parser.getint('tableOptions', 'readCapacity')
+WRITE_CAPACITY = parser.getint('tableOptions', 'writeCapacity')
+AUTO_SCALING = parser.getboolean('tableOptions', 'autoScaling')
+MAX_READ_CAPACITY = parser.getint('tableOptions', 'maxReadCapacity')
+MAX_WRITE_CAPACITY = parser.getint('tableOptions', 'maxWriteCapacity')
+TARGET_UTILIZATION = parser.getint('tableOptions', 'targetUtilization')
+WARM_READ_UNITS = parser.getint('tableOptions', 'warmReadUnitsPerSecond')
+WARM_WRITE_UNITS = parser.getint('tableOptions', 'warmWriteUnitsPerSecond')
+
+if CAPACITY_MODE == 'PROVISIONED':
+    configured_billing = dynamodb.BillingMode.PROVISIONED
+elif CAPACITY_MODE == 'ON_DEMAND':
+    configured_billing = dynamodb.BillingMode.PAY_PER_REQUEST
+else:
+    raise ValueError(f'Invalid capacity mode: {CAPACITY_MODE}')
+if min(READ_CAPACITY, WRITE_CAPACITY) < 1:
+    raise ValueError(f'Invalid capacity: {READ_CAPACITY} RCU, {WRITE_CAPACITY} WCU')
+if MAX_READ_CAPACITY < READ_CAPACITY or MAX_WRITE_CAPACITY < WRITE_CAPACITY:
+    raise ValueError(f'Invalid maximum capacity: {MAX_READ_CAPACITY} RCU, {MAX_WRITE_CAPACITY} WCU, below the minimum capacity')
+if not 20 <= TARGET_UTILIZATION <= 90:
+    raise ValueError(f'Invalid target utilization: {TARGET_UTILIZATION}')
+
+# Warm throughput cannot be set below the 12000 read and 4000 write units per second of new tables
+if not (WARM_READ_UNITS == 0 or WARM_READ_UNITS >= 12000) or not (WARM_WRITE_UNITS == 0 or WARM_WRITE_UNITS >= 4000):
+    raise ValueError(f'Invalid warm throughput: {WARM_READ_UNITS} reads, {WARM_WRITE_UNITS} writes per second')
+
+if WARM_READ_UNITS or WARM_WRITE_UNITS:
+    warm_throughput = dynamodb.WarmThroughput(
+        read_units_per_second=WARM_READ_UNITS or None,
+        write_units_per_second=WARM_WRITE_UNITS or None
+    )
+else:
+    warm_throughput = None
+
+# Global secondary indexes of the isbn_events table, which are queried by tools/query.py. CloudFormation
+# only creates one index per update of an existing table, so they are added to it in successive deploys
+DAY_INDEX_NAME = 'day-index'
+EXCEPTION_INDEX_NAME = 'exception-index'
+EVENT_INDEXES = [name.strip() for name in parser.get('tableOptions', 'eventIndexes').split(',') if name.strip()]
+
+if any(name not in (DAY_INDEX_NAME, EXCEPTION_INDEX_NAME) for name in EVENT_INDEXES):
+    raise ValueError(f'Invalid event indexes: {EVENT_INDEXES}')
+
+MEMORY_CACHE_SIZE = parser.getint('cacheOptions', 'memoryCacheSize')
+MEMORY_CACHE_TTL = parser.getint('cacheOptions', 'memoryTtlSeconds')
+CACHE_TABLE_TTL_DAYS = parser.getint('cacheOptions', 'tableTtlDays')
+NOT_FOUND_TTL = parser.getint('cacheOptions', 'notFoundTtlSeconds')
+DEDUP_TTL_DAYS = parser.getint('cacheOptions', 'dedupTtlDays')
+
+if min(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL, CACHE_TABLE_TTL_DAYS, NOT_FOUND_TTL, DEDUP_TTL_DAYS) < 0:
+    raise ValueError('Invalid cache options: sizes and TTLs must be integers greater than or equal to 0')
+
+# ZIP file of the layer built by tools/catalog.py, relative to the root directory of the project
+CATALOG_LAYER_PATH = parser.get('catalogOptions', 'layerPath').strip()
+
+if CATALOG_LAYER_PATH:
+    catalog_layer_file = config_file.parent.parent / CATALOG_LAYER_PATH
+    if catalog_layer_file.suffix != '.zip' or not catalog_layer_file.is_file():
+        raise ValueError(f'Invalid catalog layer: {CATALOG_LAYER_PATH}')
+else:
+    catalog_layer_file = None
+
+# Providers of book metadata in order of preference, the following ones hedging the slow lookups of the first one
+BOOK_PROVIDERS = [name.strip() for name in parser.get('providerOptions', 'providers').split(',') if name.strip()]
+HEDGE_PERCENTILE = parser.getfloat('providerOptions', 'hedgePercentile')
+HEDGE_DELAY_MS = parser.getint('providerOptions', 'hedgeDelayMs')
+
+if not BOOK_PROVIDERS or not set(BOOK_PROVIDERS) <= {'google', 'openlibrary'} or len(set(BOOK_PROVIDERS)) != len(BOOK_PROVIDERS):
+    raise ValueError(f'Invalid book providers: {BOOK_PROVIDERS}')
+if not 0 < HEDGE_PERCENTILE <= 100 or HEDGE_DELAY_MS < 0:
+    raise ValueError(f'Invalid hedge options: hedgePercentile {HEDGE_PERCENTILE}, hedgeDelayMs {HEDGE_DELAY_MS}')
+
+IMAGE_LAYER_ARN = parser.get('imageOptions', 'layerArn').strip()
+DECODE_BARCODES = parser.getboolean('imageOptions', 'decodeBarcodes')
+PREPROCESS_IMAGES = parser.getboolean('imageOptions', 'preprocessImages')
+MAX_IMAGE_SIDE = parser.getint('imageOptions', 'maxImageSide')
+JPEG_QUALITY = parser.getint('imageOptions', 'jpegQuality')
+
+if (DECODE_BARCODES or PREPROCESS_IMAGES) and not IMAGE_LAYER_ARN:
+    raise ValueError('Barcode decoding and image preprocessing require the ARN of a Lambda layer with NumPy and Pillow')
+if MAX_IMAGE_SIDE < 80 or not 1 <= JPEG_QUALITY <= 95:
+    raise ValueError(f'Invalid image options: maxImageSide {MAX_IMAGE_SIDE}, jpegQuality {JPEG_QUALITY}')
+
+MIN_CONFIDENCE = parser.get('rekognitionOptions', 'minConfidence').strip()
+MIN_BOUNDING_BOX_HEIGHT = parser.get('rekognitionOptions', 'minBoundingBoxHeight').strip()
+REGIONS_OF_INTEREST = parser.get('rekognitionOptions', 'regionsOfInterest').strip()
+MULTI_BOOK = parser.getboolean('rekognitionOptions', 'multiBook')
+
+if MIN_CONFIDENCE and not 0 <= float(MIN_CONFIDENCE) <= 100:
+    raise ValueError(f'Invalid minimum confidence: {MIN_CONFIDENCE}')
+if MIN_BOUNDING_BOX_HEIGHT and not 0 <= float(MIN_BOUNDING_BOX_HEIGHT) <= 1:
+    raise ValueError(f'Invalid minimum bounding box height: {MIN_BOUNDING_BOX_HEIGHT}')
+for region in filter(None, (region.strip() for region in REGIONS_OF_INTEREST.split(';'))):
+    ratios = [float(ratio) for ratio in region.split(',')]
+    if len(ratios) != 4 or not all(0 <= ratio <= 1 for ratio in ratios):
+        raise ValueError(f'Invalid region of interest: {region}')
+
+LAMBDA_MEMORY_SIZE = parser.getint('lambdaOptions', 'memorySize')
+LAMBDA_ARCHITECTURE = parser.get('lambdaOptions', 'architecture').strip().lower()
+LAMBDA_TIMEOUT_SECONDS = parser.getint('lambdaOptions', 'timeoutSeconds')
+PROVISIONED_CONCURRENCY = parser.getint('lambdaOptions', 'provisionedConcurrency')
+
+if LAMBDA_ARCHITECTURE == 'arm64':
+    configured_architecture = lambda_.Architecture.ARM_64
+elif LAMBDA_ARCHITECTURE == 'x86_64':
+    configured_architecture = lambda_.Architecture.X86_64
+else:
+    raise ValueError(f'Invalid architecture: {LAMBDA_ARCHITECTURE}')
+if not 128 <= LAMBDA_MEMORY_SIZE <= 10240:
+    raise ValueError(f'Invalid memory size: {LAMBDA_MEMORY_SIZE}')
+if not 1 <= LAMBDA_TIMEOUT_SECONDS <= 900:
+    raise ValueError(f'Invalid timeout: {LAMBDA_TIMEOUT_SECONDS}')
+if PROVISIONED_CONCURRENCY < 0:
+    raise ValueError(f'Invalid provisioned concurrency: {PROVISIONED_CONCURRENCY}')
+
+LAMBDA_TIMEOUT = Duration.seconds(LAMBDA_TIMEOUT_SECONDS)
+
+# The lookup function answers within the 29 seconds of API Gateway integrations
+ENABLE_LOOKUP = parser.getboolean('lambdaOptions', 'enableLookup')
+LOOKUP_TIMEOUT = Duration.seconds(min(LAMBDA_TIMEOUT_SECONDS, 29))
+
+ENABLE_BULK = parser.getboolean('bulkOptions', 'enableBulk')
+BULK_PREFIX = parser.get('bulkOptions', 'prefix').strip()
+MANIFEST_PREFIX = parser.get('bulkOptions', 'manifestPrefix').strip()
+BULK_MEMORY_SIZE = parser.getint('bulkOptions', 'memorySize')
+BULK_TIMEOUT_SECONDS = parser.getint('bulkOptions', 'timeoutSeconds')
+BULK_WORKERS = parser.getint('bulkOptions', 'workers')
+BULK_MAX_REDRIVES = parser.getint('bulkOptions', 'maxRedrives')
+
+# Manifests are written out of the prefix of the archives, so that they cannot trigger another run
+if not BULK_PREFIX.endswith('/') or not MANIFEST_PREFIX.endswith('/') or MANIFEST_PREFIX.startswith(BULK_PREFIX):
+    raise ValueError(f'Invalid bulk prefixes: {BULK_PREFIX}, {MANIFEST_PREFIX}')
+if not 128 <= BULK_MEMORY_SIZE <= 10240:
+    raise ValueError(f'Invalid bulk memory size: {BULK_MEMORY_SIZE}')
+if not 1 <= BULK_TIMEOUT_SECONDS <= 900:
+    raise ValueError(f'Invalid bulk timeout: {BULK_TIMEOUT_SECONDS}')
+if BULK_WORKERS < 1:
+    raise ValueError(f'Invalid bulk workers: {BULK_WORKERS}')
+if BULK_MAX_REDRIVES < 0:
+    raise ValueError(f'Invalid bulk re-drives: {BULK_MAX_REDRIVES}')
+
+BULK_TIMEOUT = Duration.seconds(BULK_TIMEOUT_SECONDS)
+
+# S3 notifications of the same event type cannot overlap, so the processor only receives the
+# images and the bulk function the archives of its prefix
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG')
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+# Requests written by the bulk function next to an archive to re-drive its deferred members
+REDRIVE_SUFFIX = '.redrive.json'
+
+ENABLE_AGGREGATES = parser.getboolean('aggregateOptions', 'enableAggregates')
+AGGREGATE_BATCH_SIZE = parser.getint('aggregateOptions', 'batchSize')
+AGGREGATE_BATCHING_WINDOW = parser.getint('aggregateOptions', 'maxBatchingWindowSeconds')
+AGGREGATE_RETRY_ATTEMPTS = parser.getint('aggregateOptions', 'retryAttempts')
+
+if not 1 <= AGGREGATE_BATCH_SIZE <= 10000:
+    raise ValueError(f'Invalid aggregate batch size: {AGGREGATE_BATCH_SIZE}')
+if not 0 <= AGGREGATE_BATCHING_WINDOW <= 300:
+    raise ValueError(f'Invalid aggregate batching window: {AGGREGATE_BATCHING_WINDOW}')
+if not 0 <= AGGREGATE_RETRY_ATTEMPTS <= 10000:
+    raise ValueError(f'Invalid aggregate retry attempts: {AGGREGATE_RETRY_ATTEMPTS}')
+
+ENABLE_QUEUE = parser.getboolean('queueOptions', 'enableQueue')
+QUEUE_BATCH_SIZE = parser.getint('queueOptions', 'batchSize')
+QUEUE_BATCHING_WINDOW = parser.getint('queueOptions', 'maxBatchingWindowSeconds')
+QUEUE_MAX_CONCURRENCY = parser.getint('queueOptions', 'maxConcurrency')
+QUEUE_MAX_RECEIVE_COUNT = parser.getint('queueOptions', 'maxReceiveCount')
+
+if not 0 <= QUEUE_BATCHING_WINDOW <= 300:
+    raise ValueError(f'Invalid maximum batching window: {QUEUE_BATCHING_WINDOW}')
+if not 1 <= QUEUE_BATCH_SIZE <= (10000 if QUEUE_BATCHING_WINDOW > 0 else 10):
+    raise ValueError(f'Invalid batch size: {QUEUE_BATCH_SIZE}, which can exceed 10 only with a batching window')
+if not 2 <= QUEUE_MAX_CONCURRENCY <= 1000:
+    raise ValueError(f'Invalid maximum concurrency: {QUEUE_MAX_CONCURRENCY}')
+if QUEUE_MAX_RECEIVE_COUNT < 1:
+    raise ValueError(f'Invalid maximum receive count: {QUEUE_MAX_RECEIVE_COUNT}')
+
+METRICS_NAMESPACE = parser.get('metricsOptions', 'namespace').strip()
+ALARM_EVALUATION_PERIODS = parser.getint('metricsOptions', 'alarmEvaluationPeriods')
+P99_ALARM_THRESHOLDS = {}
+for threshold in filter(None, (threshold.strip() for threshold in parser.get('metricsOptions', 'p99AlarmThresholdsMs').split(';'))):
+    stage, _, milliseconds = threshold.partition(':')
+    if not stage.strip() or not milliseconds.strip().isdigit():
+        raise ValueError(f'Invalid p99 alarm threshold: {threshold}')
+    P99_ALARM_THRESHOLDS[stage.strip()] = int(milliseconds)
+
+if not METRICS_NAMESPACE:
+    raise ValueError('Invalid metrics namespace: it cannot be empty')
+if ALARM_EVALUATION_PERIODS < 1:
+    raise ValueError(f'Invalid alarm evaluation periods: {ALARM_EVALUATION_PERIODS}')
+
 class isbnProcessorStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -67,6 +275,26 @@ class isbnProcessorStack(Stack):
                 lifecycle_rules=[s3_lifecycle_rule],
                 removal_policy=configured_removal
             )
+
+        # 3. Create S3 Bucket of the archive of raw detections, which never expire
+        if ENABLE_ARCHIVE:
+            detections_bucket = s3. \
+                Bucket(
+                    self,
+                    id='DetectionsBucket',
+                    bucket_name=ARCHIVE_BUCKET_NAME,
+                    lifecycle_rules=[
+                        s3.LifecycleRule(
+                            transitions=[
+                                s3.Transition(
+                                    storage_class=s3.StorageClass.GLACIER_INSTANT_RETRIEVAL,
+                                    transition_after=Duration.days(ARCHIVE_TRANSITION_DAYS)
+                                )
+                            ]
+                        )
+                    ] if ARCHIVE_TRANSITION_DAYS > 0 else None,
+                    removal_policy=configured_removal
+                )
         
         # =============================
         # API Gateway
@@ -162,15 +390,18 @@ class isbnProcessorStack(Stack):
         # DynamoDB Table
         # =============================
         
-        # 1. Create the DynamoDB Table with provisioned settings
+        # 1. Create the DynamoDB Table with the configured capacity mode
+        provisioned = configured_billing == dynamodb.BillingMode.PROVISIONED
         isbn_events_table = dynamodb. \
             Table(
                 self,
                 id='EventsTable',
                 table_name='isbn_events',
-                billing_mode=dynamodb.BillingMode.PROVISIONED,
-                read_capacity=1,
-                write_capacity=2,
+                billing_mode=configured_billing,
+                read_capacity=READ_CAPACITY if provisioned else None,
+                write_capacity=WRITE_CAPACITY if provisioned else None,
+                warm_throughput=warm_throughput,
+                stream=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES if ENABLE_AGGREGATES else None,
                 partition_key=dynamodb.Attribute(
                     name='isbn',
                     type=dynamodb.AttributeType.STRING
@@ -182,6 +413,94 @@ class isbnProcessorStack(Stack):
                 removal_policy=configured_removal
             )
 
+
+        # 2. Add the configured indexes of the read side: events by day, and the sparse index of the events
+        #    without matching results, whose items are the only ones with the 'exception_day' attribute
+        index_keys = {
+            DAY_INDEX_NAME: ('day', dynamodb.ProjectionType.ALL),
+            EXCEPTION_INDEX_NAME: ('exception_day', dynamodb.ProjectionType.KEYS_ONLY)
+        }
+        for index_name in EVENT_INDEXES:
+            partition_key, projection_type = index_keys[index_name]
+            isbn_events_table.add_global_secondary_index(
+                index_name=index_name,
+                partition_key=dynamodb.Attribute(name=partition_key, type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name='timestamp', type=dynamodb.AttributeType.STRING),
+                projection_type=projection_type,
+                read_capacity=READ_CAPACITY if provisioned else None,
+                write_capacity=WRITE_CAPACITY if provisioned else None
+            )
+
+        # 3. Scale the provisioned capacity of the table and its indexes between the configured
+        #    bounds to track the target utilization
+        if provisioned and AUTO_SCALING:
+            isbn_events_table. \
+                auto_scale_read_capacity(min_capacity=READ_CAPACITY, max_capacity=MAX_READ_CAPACITY). \
+                scale_on_utilization(target_utilization_percent=TARGET_UTILIZATION)
+            isbn_events_table. \
+                auto_scale_write_capacity(min_capacity=WRITE_CAPACITY, max_capacity=MAX_WRITE_CAPACITY). \
+                scale_on_utilization(target_utilization_percent=TARGET_UTILIZATION)
+            for index_name in EVENT_INDEXES:
+                isbn_events_table. \
+                    auto_scale_global_secondary_index_read_capacity(
+                        index_name, min_capacity=READ_CAPACITY, max_capacity=MAX_READ_CAPACITY
+                    ). \
+                    scale_on_utilization(target_utilization_percent=TARGET_UTILIZATION)
+                isbn_events_table. \
+                    auto_scale_global_secondary_index_write_capacity(
+                        index_name, min_capacity=WRITE_CAPACITY, max_capacity=MAX_WRITE_CAPACITY
+                    ). \
+                    scale_on_utilization(target_utilization_percent=TARGET_UTILIZATION)
+        
+        # 4. Create the on-demand DynamoDB Table which caches ISBN data with native TTL expiration
+        isbn_cache_table = dynamodb. \
+            Table(
+                self,
+                id='CacheTable',
+                table_name='isbn_cache',
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                partition_key=dynamodb.Attribute(
+                    name='isbn',
+                    type=dynamodb.AttributeType.STRING
+                ),
+                time_to_live_attribute='expires_at',
+                removal_policy=configured_removal
+            )
+
+        # 5. Create the on-demand DynamoDB Table which maps the content hash of each analyzed image
+        #    to its ISBN number, so that re-uploaded images skip Rekognition
+        image_hashes_table = dynamodb. \
+            Table(
+                self,
+                id='ImageHashesTable',
+                table_name='isbn_image_hashes',
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                partition_key=dynamodb.Attribute(
+                    name='content_hash',
+                    type=dynamodb.AttributeType.STRING
+                ),
+                time_to_live_attribute='expires_at',
+                removal_policy=configured_removal
+            )
+
+        # 6. Create the on-demand DynamoDB Table of the counters per ISBN number, day and exception
+        #    flag, which are updated from the stream of the isbn_events table
+        if ENABLE_AGGREGATES:
+            aggregates_table = dynamodb. \
+                Table(
+                    self,
+                    id='AggregatesTable',
+                    table_name='isbn_aggregates',
+                    billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                    partition_key=dynamodb.Attribute(
+                        name='pk',
+                        type=dynamodb.AttributeType.STRING
+                    ),
+                    # Markers of the applied stream batches expire once their retries are over
+                    time_to_live_attribute='expires_at',
+                    removal_policy=configured_removal
+                )
+
         # =============================
         # Lambda Function
         # =============================
@@ -196,6 +515,23 @@ class isbnProcessorStack(Stack):
                     )
                 ]
             )
+        if ENABLE_BULK:
+            bucket_lambda_policy.add_statements(
+                iam.PolicyStatement(
+                    actions=['s3:PutObject'],
+                    resources=[
+                        f'{images_bucket.bucket_arn}/{MANIFEST_PREFIX}*',
+                        f'{images_bucket.bucket_arn}/{BULK_PREFIX}*{REDRIVE_SUFFIX}'
+                    ]
+                )
+            )
+        if ENABLE_ARCHIVE:
+            bucket_lambda_policy.add_statements(
+                iam.PolicyStatement(
+                    actions=['s3:PutObject'],
+                    resources=[f'{detections_bucket.bucket_arn}/{ARCHIVE_PREFIX}*']
+                )
+            )
         
         rekognition_lambda_policy = iam. \
             PolicyDocument(
@@ -211,8 +547,12 @@ class isbnProcessorStack(Stack):
             PolicyDocument(
                 statements=[
                     iam.PolicyStatement(
-                        actions=['dynamodb:PutItem'],
+                        actions=['dynamodb:BatchWriteItem'],
                         resources=[isbn_events_table.table_arn]
+                    ),
+                    iam.PolicyStatement(
+                        actions=['dynamodb:GetItem', 'dynamodb:PutItem'],
+                        resources=[isbn_cache_table.table_arn, image_hashes_table.table_arn]
                     )
                 ]
             )
@@ -235,27 +575,120 @@ class isbnProcessorStack(Stack):
                 }
             )
 
-        # 3. Create Lambda event source from S3
-        s3_event_source = lambda_event_sources. \
-            S3EventSource(
-                bucket=images_bucket,
-                events=[s3.EventType.OBJECT_CREATED_PUT]
-            )
+        # 3. Create Lambda event sources from S3, either directly or buffered by an SQS queue, with
+        #    one notification per image suffix if the archives of the bulk prefix are sent elsewhere
+        notification_filters = [[s3.NotificationKeyFilter(suffix=suffix)] for suffix in IMAGE_SUFFIXES] \
+                               if ENABLE_BULK else [[]]
+        if ENABLE_QUEUE:
+            dead_letter_queue = sqs. \
+                Queue(
+                    self,
+                    id='ImagesDeadLetterQueue',
+                    queue_name='isbn_images_dlq',
+                    retention_period=Duration.days(14)
+                )
+
+            # The visibility timeout covers six times the function timeout, as recommended for SQS event sources
+            images_queue = sqs. \
+                Queue(
+                    self,
+                    id='ImagesQueue',
+                    queue_name='isbn_images',
+                    visibility_timeout=Duration.seconds(LAMBDA_TIMEOUT.to_seconds() * 6),
+                    dead_letter_queue=sqs.DeadLetterQueue(
+                        max_receive_count=QUEUE_MAX_RECEIVE_COUNT,
+                        queue=dead_letter_queue
+                    )
+                )
+            for filters in notification_filters:
+                images_bucket.add_event_notification(
+                    s3.EventType.OBJECT_CREATED_PUT,
+                    s3_notifications.SqsDestination(images_queue),
+                    *filters
+                )
+
+            event_sources = [
+                lambda_event_sources. \
+                    SqsEventSource(
+                        images_queue,
+                        batch_size=QUEUE_BATCH_SIZE,
+                        max_batching_window=Duration.seconds(QUEUE_BATCHING_WINDOW),
+                        max_concurrency=QUEUE_MAX_CONCURRENCY,
+                        report_batch_item_failures=True
+                    )
+            ]
+        else:
+            event_sources = [
+                lambda_event_sources. \
+                    S3EventSource(
+                        bucket=images_bucket,
+                        events=[s3.EventType.OBJECT_CREATED_PUT],
+                        filters=filters
+                    )
+                for filters in notification_filters
+            ]
         
-        # 4. Create Lambda function with logging options and add event source
+        # 4. Attach the layer with the image processing dependencies and the layer with the
+        #    index of known books, which is consulted before the Google Books API, if required
+        lambda_layers = []
+        if DECODE_BARCODES or PREPROCESS_IMAGES:
+            lambda_layers.append(
+                lambda_.LayerVersion.from_layer_version_arn(self, id='ImageLayer', layer_version_arn=IMAGE_LAYER_ARN)
+            )
+        if catalog_layer_file is not None:
+            lambda_layers.append(
+                lambda_.LayerVersion(
+                    self,
+                    id='CatalogLayer',
+                    code=lambda_.Code.from_asset(str(catalog_layer_file)),
+                    description='Sorted index of known books, extracted at /opt/catalog/isbn.idx',
+                    removal_policy=RemovalPolicy.DESTROY
+                )
+            )
+        lambda_layers = lambda_layers or None
+
+        # 5. Create Lambda function with logging and cold start options
+        lambda_environment = {
+            'INIT_CLIENTS': 'true',
+            'METRICS_NAMESPACE': METRICS_NAMESPACE,
+            'TABLE_NAME': isbn_events_table.table_name, # Required environment variable for loading data
+            'CACHE_TABLE_NAME': isbn_cache_table.table_name,
+            'MEMORY_CACHE_SIZE': str(MEMORY_CACHE_SIZE),
+            'MEMORY_CACHE_TTL': str(MEMORY_CACHE_TTL),
+            'CACHE_TABLE_TTL': str(CACHE_TABLE_TTL_DAYS * 24 * 3600),
+            'NOT_FOUND_TTL': str(NOT_FOUND_TTL),
+            'DEDUP_TABLE_NAME': image_hashes_table.table_name,
+            'DEDUP_TTL': str(DEDUP_TTL_DAYS * 24 * 3600),
+            'BARCODE_DECODING': str(DECODE_BARCODES).lower(),
+            'PREPROCESS_IMAGES': str(PREPROCESS_IMAGES).lower(),
+            'MAX_IMAGE_SIDE': str(MAX_IMAGE_SIDE),
+            'JPEG_QUALITY': str(JPEG_QUALITY),
+            'MIN_CONFIDENCE': MIN_CONFIDENCE,
+            'MIN_BOUNDING_BOX_HEIGHT': MIN_BOUNDING_BOX_HEIGHT,
+            'REGIONS_OF_INTEREST': REGIONS_OF_INTEREST,
+            'MULTI_BOOK': str(MULTI_BOOK).lower(),
+            'BOOK_PROVIDERS': ','.join(BOOK_PROVIDERS),
+            'HEDGE_PERCENTILE': str(HEDGE_PERCENTILE),
+            'HEDGE_DELAY_MS': str(HEDGE_DELAY_MS)
+        }
+        if ENABLE_ARCHIVE:
+            lambda_environment['DETECTIONS_BUCKET'] = detections_bucket.bucket_name
+            lambda_environment['DETECTIONS_PREFIX'] = ARCHIVE_PREFIX
+
         lambda_processor = lambda_. \
             Function(
                 self,
                 id='LambdaFunction',
                 function_name='isbn_processor',
                 runtime=lambda_.Runtime.PYTHON_3_12,
-                code=lambda_.Code.from_asset('scripts'),
+                code=lambda_.Code.from_asset(str(scripts_path)),
                 handler='handler.lambda_handler',
                 role=lambda_exec_role,
-                timeout=Duration.seconds(5),
-                environment={
-                    'TABLE_NAME': isbn_events_table.table_name # Required environment variable for loading data
-                },
+                timeout=LAMBDA_TIMEOUT,
+                memory_size=LAMBDA_MEMORY_SIZE,
+                architecture=configured_architecture,
+                layers=lambda_layers,
+                environment=lambda_environment,
                 log_group=logs.LogGroup(
                     self,
                     id='LambdaLogGroup',
@@ -263,4 +696,173 @@ class isbnProcessorStack(Stack):
                     removal_policy=RemovalPolicy.DESTROY
                 )
             )
-        lambda_processor.add_event_source(s3_event_source)
\ No newline at end of file
+
+        # 6. Route the events to an alias with provisioned concurrency, if required, since
+        #    unqualified invocations are not served by provisioned containers
+        if PROVISIONED_CONCURRENCY > 0:
+            lambda_target = lambda_processor.add_alias(
+                'live',
+                provisioned_concurrent_executions=PROVISIONED_CONCURRENCY
+            )
+        else:
+            lambda_target = lambda_processor
+        for event_source in event_sources:
+            lambda_target.add_event_source(event_source)
+
+        # 7. Create the Lambda function of the synchronous lookup endpoint, which runs the same
+        #    pipeline on the request body and returns the book data through a proxy integration
+        if ENABLE_LOOKUP:
+            lambda_lookup = lambda_. \
+                Function(
+                    self,
+                    id='LookupFunction',
+                    function_name='isbn_lookup',
+                    runtime=lambda_.Runtime.PYTHON_3_12,
+                    code=lambda_.Code.from_asset(str(scripts_path)),
+                    handler='handler.lookup_handler',
+                    role=lambda_exec_role,
+                    timeout=LOOKUP_TIMEOUT,
+                    memory_size=LAMBDA_MEMORY_SIZE,
+                    architecture=configured_architecture,
+                    layers=lambda_layers,
+                    environment=lambda_environment,
+                    log_group=logs.LogGroup(
+                        self,
+                        id='LookupLogGroup',
+                        retention=logs.RetentionDays.ONE_WEEK,
+                        removal_policy=RemovalPolicy.DESTROY
+                    )
+                )
+
+            # Binary bodies of the media types of the REST API are passed to the function as base64
+            rest_api.root.add_resource('lookup').add_method(
+                'POST',
+                integration=apigateway.LambdaIntegration(lambda_lookup, proxy=True)
+            )
+
+        # 8. Create the Lambda function which streams the archives uploaded under the bulk prefix,
+        #    analyzes their images and writes a manifest of the run back to the bucket, along with
+        #    the re-drive requests of its deferred members which trigger another run. Archives
+        #    may be uploaded with multipart uploads, so every object creation event is sent
+        if ENABLE_BULK:
+            lambda_bulk = lambda_. \
+                Function(
+                    self,
+                    id='BulkFunction',
+                    function_name='isbn_bulk',
+                    runtime=lambda_.Runtime.PYTHON_3_12,
+                    code=lambda_.Code.from_asset(str(scripts_path)),
+                    handler='bulk.bulk_handler',
+                    role=lambda_exec_role,
+                    timeout=BULK_TIMEOUT,
+                    memory_size=BULK_MEMORY_SIZE,
+                    architecture=configured_architecture,
+                    layers=lambda_layers,
+                    environment={
+                        **lambda_environment,
+                        'BULK_WORKERS': str(BULK_WORKERS),
+                        'BULK_MAX_REDRIVES': str(BULK_MAX_REDRIVES),
+                        'MANIFEST_PREFIX': MANIFEST_PREFIX
+                    },
+                    log_group=logs.LogGroup(
+                        self,
+                        id='BulkLogGroup',
+                        retention=logs.RetentionDays.ONE_WEEK,
+                        removal_policy=RemovalPolicy.DESTROY
+                    )
+                )
+            for suffix in (*ARCHIVE_SUFFIXES, REDRIVE_SUFFIX):
+                images_bucket.add_event_notification(
+                    s3.EventType.OBJECT_CREATED,
+                    s3_notifications.LambdaDestination(lambda_bulk),
+                    s3.NotificationKeyFilter(prefix=BULK_PREFIX, suffix=suffix)
+                )
+
+        # 9. Create the Lambda function which consumes the stream of the isbn_events table in batches,
+        #    only receiving the inserted and removed events and the rewritten events whose exception
+        #    flag changed, and applies them to the counters of the aggregates table,
+        #    with a role of its own so that the other functions are not granted its table and stream
+        if ENABLE_AGGREGATES:
+            aggregates_exec_role = iam. \
+                Role(
+                    self,
+                    id='AggregatesExecutionRole',
+                    role_name='LambdaISBNAggregatesRole',
+                    assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'),
+                    managed_policies=[
+                        iam.ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole')
+                    ]
+                )
+
+            lambda_aggregates = lambda_. \
+                Function(
+                    self,
+                    id='AggregatesFunction',
+                    function_name='isbn_aggregates',
+                    runtime=lambda_.Runtime.PYTHON_3_12,
+                    code=lambda_.Code.from_asset(str(scripts_path)),
+                    handler='aggregates.aggregate_handler',
+                    role=aggregates_exec_role,
+                    timeout=Duration.seconds(60),
+                    memory_size=256,
+                    architecture=configured_architecture,
+                    environment={
+                        'METRICS_NAMESPACE': METRICS_NAMESPACE,
+                        'AGGREGATES_TABLE_NAME': aggregates_table.table_name
+                    },
+                    log_group=logs.LogGroup(
+                        self,
+                        id='AggregatesLogGroup',
+                        retention=logs.RetentionDays.ONE_WEEK,
+                        removal_policy=RemovalPolicy.DESTROY
+                    )
+                )
+            aggregates_table.grant(lambda_aggregates, 'dynamodb:UpdateItem', 'dynamodb:PutItem')
+            lambda_aggregates.add_event_source(
+                lambda_event_sources. \
+                    DynamoEventSource(
+                        isbn_events_table,
+                        starting_position=lambda_.StartingPosition.TRIM_HORIZON,
+                        batch_size=AGGREGATE_BATCH_SIZE,
+                        max_batching_window=Duration.seconds(AGGREGATE_BATCHING_WINDOW),
+                        retry_attempts=AGGREGATE_RETRY_ATTEMPTS,
+                        filters=[
+                            lambda_.FilterCriteria.filter({'eventName': lambda_.FilterRule.is_equal('INSERT')}),
+                            lambda_.FilterCriteria.filter({'eventName': lambda_.FilterRule.is_equal('REMOVE')}),
+                            *[
+                                lambda_.FilterCriteria.filter({
+                                    'eventName': lambda_.FilterRule.is_equal('MODIFY'),
+                                    'dynamodb': {
+                                        'OldImage': {'exception': {'N': lambda_.FilterRule.is_equal(old)}},
+                                        'NewImage': {'exception': {'N': lambda_.FilterRule.is_equal(new)}}
+                                    }
+                                })
+                                for old, new in (('0', '1'), ('1', '0'))
+                            ]
+                        ]
+                    )
+            )
+
+        # =============================
+        # CloudWatch Alarms
+        # =============================
+
+        # 1. Alarm on the p99 latency of each stage, whose metrics are emitted by the function as EMF log lines
+        for stage, threshold in P99_ALARM_THRESHOLDS.items():
+            cloudwatch. \
+                Alarm(
+                    self,
+                    id=f'{stage.title()}LatencyAlarm',
+                    alarm_description=f'p99 latency of the {stage} stage of the ISBN processor above {threshold} ms',
+                    metric=cloudwatch.Metric(
+                        namespace=METRICS_NAMESPACE,
+                        metric_name='Duration',
+                        dimensions_map={'Stage': stage},
+                        statistic='p99',
+                        period=Duration.minutes(5)
+                    ),
+                    threshold=threshold,
+                    evaluation_periods=ALARM_EVALUATION_PERIODS,
+                    comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+                    treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING
+                )
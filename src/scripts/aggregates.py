@@ -0,0 +1,187 @@
+import os
+import time
+import random
+import hashlib
+import logging
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from botocore.exceptions import ClientError
+from clients import get_table
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+AGGREGATES_TABLE_NAME = os.getenv('AGGREGATES_TABLE_NAME', 'isbn_aggregates')
+
+# Upper bound of keys updated at the same time within a single invocation
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
+
+# Seconds for which the marker of an applied batch is kept, longer than the stream retention
+MARKER_TTL = int(os.getenv('AGGREGATES_MARKER_TTL', str(2 * 24 * 3600)))
+
+# Keys updated by a transaction, next to the marker of its part (at most 100 actions)
+MAX_TRANSACTION_KEYS = 99
+
+# Attempts of a transaction cancelled by conflicts with concurrent transactions
+MAX_ATTEMPTS = 4
+
+
+def isbn_key(isbn: str) -> str:
+    return f'isbn#{isbn}'
+
+
+def day_key(day: str) -> str:
+    return f'day#{day}'
+
+
+def exception_key(exception: int) -> str:
+    return f'exception#{exception}'
+
+
+def record_images(record: dict[str,Any]) -> list[tuple[dict[str,Any], int]]:
+    """
+    Get the images of a stream record whose counters change, with the sign of the change:
+    the new image of an inserted item is added, the old image of a removed item is subtracted,
+    and a modified item subtracts its old image and adds its new one.
+    """
+    images = record['dynamodb']
+    changes = {'INSERT': [('NewImage', 1)], 'REMOVE': [('OldImage', -1)], 'MODIFY': [('OldImage', -1), ('NewImage', 1)]}
+    return [(images[name], sign) for name, sign in changes.get(record.get('eventName'), []) if name in images]
+
+
+def coalesce(records: list[dict[str,Any]]) -> dict[str,Counter]:
+    """
+    Sum the changes of the counters of a DynamoDB Streams batch by aggregate key, so that
+    a burst of events results in a single update per key.
+
+    Args:
+        records: Records of the stream batch, with the new and old images of each item.
+
+    Returns:
+        dict[str,Counter]: The increments of the counters (events, not_found) of each key,
+                           without the keys whose changes cancel out.
+    """
+    increments = {}
+    for record in records:
+        for image, sign in record_images(record):
+            exception = int(image.get('exception', {}).get('N', '0'))
+            day = image['day']['S'] if 'day' in image else image['timestamp']['S'][:10]
+
+            for key in (isbn_key(image['isbn']['S']), day_key(day), exception_key(exception)):
+                counters = increments.setdefault(key, Counter())
+                counters['events'] += sign
+                counters['not_found'] += sign * exception
+
+    # Rewritten items (e.g., retried records) subtract what they add again
+    return {key: counters for key, counters in increments.items() if any(counters.values())}
+
+
+def batch_id(records: list[dict[str,Any]]) -> str:
+    """
+    Identify a stream batch by the sequence numbers of its records, which are the same
+    when Lambda retries the batch.
+    """
+    digest = hashlib.sha256(usedforsecurity=False)
+    for record in records:
+        digest.update(record['dynamodb']['SequenceNumber'].encode())
+    return digest.hexdigest()[:32]
+
+
+def batch_parts(increments: dict[str,Counter]) -> list[list[str]]:
+    """
+    Split the keys of a batch, in a stable order, into the parts written by one transaction
+    each, leaving room in every transaction for the marker of its part.
+    """
+    keys = sorted(increments)
+    return [keys[i:i + MAX_TRANSACTION_KEYS] for i in range(0, len(keys), MAX_TRANSACTION_KEYS)]
+
+
+def marker_key(batch: str, part: int) -> str:
+    return f'batch#{batch}#{part}'
+
+
+def update_counters(table_name: str, increments: dict[str,Counter], keys: list[str], batch: str, part: int) -> bool:
+    """
+    Add the increments of a part of a batch to the atomic counters of its aggregate keys in a
+    single transaction, together with a marker item of the part that expires after a while.
+    The marker can only be written once, so a retried batch does not count its records twice,
+    however many other batches were applied to the same keys in the meantime.
+
+    Returns:
+        bool: Whether the counters were updated, which is False if the part was already applied.
+    """
+    actions = [{
+        'Put': {
+            'Item': {'pk': marker_key(batch, part), 'expires_at': int(time.time()) + MARKER_TTL},
+            'ConditionExpression': 'attribute_not_exists(pk)'
+        }
+    }]
+    for key in keys:
+        actions.append({
+            'Update': {
+                'Key': {'pk': key},
+                'UpdateExpression': 'ADD events :events, not_found :not_found',
+                'ExpressionAttributeValues': {
+                    ':events': increments[key]['events'],
+                    ':not_found': increments[key]['not_found']
+                }
+            }
+        })
+
+    table = get_table(table_name)
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            table.transact_write_items(TransactItems=actions)
+            return True
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [reason.get('Code') for reason in err.response.get('CancellationReasons', [])]
+            if reasons and reasons[0] == 'ConditionalCheckFailed':
+                return False
+            # Conflicts with concurrent transactions on the same keys are retried
+            if 'TransactionConflict' not in reasons or attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
+    return False
+
+
+def aggregate_handler(event, context):
+    """
+    Keep the aggregates table up to date with the events inserted into and removed from the
+    isbn_events table, with one transaction per part of up to 99 ISBN numbers, days and
+    exception flags of each stream batch. A failed transaction fails the invocation, so that
+    Lambda retries the whole batch, whose applied parts are then skipped.
+    """
+    start = time.perf_counter()
+    records = event.get('Records', [])
+    increments = coalesce(records)
+    if not increments:
+        return {'records': len(records), 'updated': 0}
+
+    batch = batch_id(records)
+    parts = batch_parts(increments)
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(parts))) as executor:
+        applied = list(executor.map(
+            lambda part: update_counters(AGGREGATES_TABLE_NAME, increments, parts[part], batch, part),
+            range(len(parts))
+        ))
+    updated = sum(len(keys) for keys, done in zip(parts, applied) if done)
+
+    logger.info(
+        'Aggregated %d records into %d keys, %d parts already applied',
+        len(records), len(increments), applied.count(False)
+    )
+    metrics = get_metrics()
+    metrics.record(
+        'aggregates',
+        duration_ms=round((time.perf_counter() - start) * 1000, 3),
+        records=len(records),
+        items=updated
+    )
+    metrics.flush()
+    return {'records': len(records), 'updated': updated}
@@ -0,0 +1,157 @@
+import io
+import os
+import logging
+
+# NumPy and Pillow are not part of the Lambda runtime, so they are provided by a layer
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Longest side of the grayscale image which is scanned, enough for ~3 pixels per module
+MAX_SIDE = int(os.getenv('BARCODE_MAX_SIDE', '1024'))
+SCANLINES = int(os.getenv('BARCODE_SCANLINES', '24'))
+
+# Widths of the four runs of each digit, starting with a space for left digits (L and G
+# codes) and with a bar for right digits (R codes, which share the widths of L codes)
+L_WIDTHS = [
+    (3, 2, 1, 1), (2, 2, 2, 1), (2, 1, 2, 2), (1, 4, 1, 1), (1, 1, 3, 2),
+    (1, 2, 3, 1), (1, 1, 1, 4), (1, 3, 1, 2), (1, 2, 1, 3), (3, 1, 1, 2)
+]
+G_WIDTHS = [widths[::-1] for widths in L_WIDTHS]
+
+# The first digit is encoded by the parity (L or G) of the six left digits
+FIRST_DIGIT_PARITIES = {
+    'LLLLLL': 0, 'LLGLGG': 1, 'LLGGLG': 2, 'LLGGGL': 3, 'LGLLGG': 4,
+    'LGGLLG': 5, 'LGGGLL': 6, 'LGLGLG': 7, 'LGLGGL': 8, 'LGGLGL': 9
+}
+
+# Runs of an EAN-13 symbol: start guard, 6 digits, middle guard, 6 digits and end guard
+SYMBOL_RUNS = 3 + 6 * 4 + 5 + 6 * 4 + 3
+MAX_DIGIT_ERROR = 2.0
+
+if AVAILABLE:
+    LEFT_PATTERNS = np.array(L_WIDTHS + G_WIDTHS, dtype=float)
+    RIGHT_PATTERNS = np.array(L_WIDTHS, dtype=float)
+
+
+def _load_grayscale(image_bytes: bytes) -> 'np.ndarray':
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # Decode JPEG images directly at a reduced scale, which is much faster than resizing
+        image.draft('L', (MAX_SIDE, MAX_SIDE))
+        image = ImageOps.exif_transpose(image).convert('L')
+        image.thumbnail((MAX_SIDE, MAX_SIDE))
+        return np.asarray(image, dtype=np.float32)
+
+
+def _runs(scanline: 'np.ndarray') -> tuple['np.ndarray','np.ndarray']:
+    # Binarize the scanline at the midpoint of its dark and light levels
+    low, high = np.percentile(scanline, (5, 95))
+    if high - low < 40:
+        return np.empty(0), np.empty(0, dtype=bool)
+    dark = scanline < (low + high) / 2
+
+    edges = np.flatnonzero(dark[1:] != dark[:-1]) + 1
+    bounds = np.concatenate(([0], edges, [len(dark)]))
+    return np.diff(bounds).astype(float), dark[bounds[:-1]]
+
+
+def _decode_digit(widths: 'np.ndarray', patterns: 'np.ndarray') -> tuple[int,float]:
+    normalized = widths * 7 / widths.sum()
+    errors = np.abs(patterns - normalized).sum(axis=1)
+    index = int(errors.argmin())
+    return index, float(errors[index])
+
+
+def _is_guard(widths: 'np.ndarray', module: float) -> bool:
+    return bool(np.all(np.abs(widths / module - 1) < 0.7))
+
+
+def _decode_symbol(widths: 'np.ndarray') -> str | None:
+    # The symbol is 95 modules wide, with a quiet zone at least as wide as its guards
+    module = widths[1:SYMBOL_RUNS + 1].sum() / 95
+    if widths[0] < 3 * module or widths[SYMBOL_RUNS + 1] < 3 * module:
+        return None
+    symbol = widths[1:SYMBOL_RUNS + 1]
+    if not (_is_guard(symbol[:3], module) and _is_guard(symbol[27:32], module) and _is_guard(symbol[56:], module)):
+        return None
+
+    digits = []
+    parities = ''
+    for index in range(6):
+        digit, error = _decode_digit(symbol[3 + index * 4:7 + index * 4], LEFT_PATTERNS)
+        if error > MAX_DIGIT_ERROR:
+            return None
+        digits.append(digit % 10)
+        parities += 'L' if digit < 10 else 'G'
+    for index in range(6):
+        digit, error = _decode_digit(symbol[32 + index * 4:36 + index * 4], RIGHT_PATTERNS)
+        if error > MAX_DIGIT_ERROR:
+            return None
+        digits.append(digit)
+
+    if parities not in FIRST_DIGIT_PARITIES:
+        return None
+    code = str(FIRST_DIGIT_PARITIES[parities]) + ''.join(map(str, digits))
+
+    checksum = sum((3 if index % 2 else 1) * int(digit) for index, digit in enumerate(code))
+    return code if checksum % 10 == 0 else None
+
+
+def decode_scanline(scanline: 'np.ndarray') -> str | None:
+    """
+    Decode an EAN-13 symbol from a single row of grayscale pixels, read from left to right.
+    """
+    widths, dark = _runs(scanline)
+
+    # Every candidate starts at a light quiet zone followed by the three runs of the start guard
+    for start in np.flatnonzero(~dark[:max(len(dark) - SYMBOL_RUNS - 1, 0)]):
+        code = _decode_symbol(widths[start:start + SYMBOL_RUNS + 2])
+        if code is not None:
+            return code
+    return None
+
+
+def decode_ean13(image_bytes: bytes) -> str | None:
+    """
+    Decode the EAN-13 barcode of an image by sampling horizontal scanlines of its
+    downscaled grayscale version, in both directions to support upside-down images.
+
+    Args:
+        image_bytes: Bytes of the JPEG or PNG image.
+
+    Returns:
+        str | None: The checksum-valid 13-digit code of the barcode, or None if no barcode
+                    could be decoded or NumPy and Pillow are not available.
+    """
+    if not AVAILABLE:
+        return None
+
+    try:
+        pixels = _load_grayscale(image_bytes)
+    except (OSError, ValueError) as err:
+        logger.warning('Could not load the image for barcode decoding. %s', err)
+        return None
+
+    # Sample from the center of the image outwards, where barcodes are usually framed
+    height = pixels.shape[0]
+    offsets = np.linspace(0, 0.45, SCANLINES // 2) * height
+    rows = sorted({int(height / 2 + sign * offset) for offset in offsets for sign in (1, -1)},
+                  key=lambda row: abs(row - height / 2))
+
+    votes = {}
+    for row in rows:
+        scanline = pixels[row]
+        code = decode_scanline(scanline) or decode_scanline(scanline[::-1])
+        if code is not None:
+            votes[code] = votes.get(code, 0) + 1
+            # Two matching scanlines are enough to rule out misreadings
+            if votes[code] == 2:
+                return code
+
+    return max(votes, key=votes.get) if votes else None
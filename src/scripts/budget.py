@@ -0,0 +1,244 @@
+import os
+import math
+import time
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+# Time kept out of the budget of downstream calls to flush the writer and return the results
+RESERVE_MS = int(os.getenv('DEADLINE_RESERVE_MS', '1000'))
+
+# Consecutive failures which open a circuit, and seconds before a trial call is let through
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+
+# Calls of shared clients waited for within the budget, sized like the connection pool of boto3
+BOUNDED_WORKERS = int(os.getenv('MAX_POOL_CONNECTIONS', '16'))
+
+_lock = threading.Lock()
+_deadline = None
+_breakers = {}
+_executor = None
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the time budget of an invocation does not allow another downstream call.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling a downstream service whose circuit is open.
+    """
+
+
+class Deadline:
+    """
+    Time budget of an invocation, which ends a reserve before the Lambda timeout so that
+    the results can still be written and returned.
+    """
+    def __init__(self, remaining_ms: float | None = None, reserve_ms: float = RESERVE_MS):
+        self._ends_at = math.inf if remaining_ms is None \
+                        else time.monotonic() + (remaining_ms - reserve_ms) / 1000
+
+    @classmethod
+    def from_context(cls, context, reserve_ms: float = RESERVE_MS) -> 'Deadline':
+        """
+        Build the deadline of an invocation from its Lambda context, which is unbounded for
+        callers without a context (e.g., local tools).
+        """
+        get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        if not callable(get_remaining_time):
+            return cls()
+        return cls(get_remaining_time(), reserve_ms)
+
+    def remaining(self) -> float:
+        return max(self._ends_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, limit: float) -> float:
+        """
+        Get the socket timeout of a call, which is the limit of the call capped by the budget.
+
+        Raises:
+            DeadlineExceeded: If there is no budget left.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('No time left for the call')
+        return min(limit, remaining)
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker which opens after consecutive failures, failing the
+    following calls fast until the reset timeout lets a single trial call through.
+    """
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> None:
+        """
+        Raises:
+            CircuitOpenError: If the circuit is open, or a trial call is already in progress.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial = True
+                return
+        raise CircuitOpenError('Circuit open after repeated failures')
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+    def reset(self) -> None:
+        self.record_success()
+
+
+def call_with_budget(operation: Callable[[float], T], retryable: Callable[[Exception], bool],
+                     timeout: float, max_attempts: int = 3, base_delay: float = 0.1, max_delay: float = 1.0,
+                     breaker: CircuitBreaker | None = None, deadline: Deadline | None = None) -> T:
+    """
+    Call an operation with a socket timeout capped by the deadline, retrying retryable errors
+    with jittered exponential backoff only while the budget allows another attempt.
+
+    Args:
+        operation: Function called with the socket timeout of each attempt.
+        retryable: Function which tells whether an error is transient.
+        timeout: Maximum socket timeout of each attempt, in seconds.
+        max_attempts: Maximum number of attempts.
+        base_delay: Base delay of the backoff, in seconds.
+        max_delay: Maximum delay of the backoff, in seconds.
+        breaker: Optional circuit breaker of the downstream service, which records the
+                 outcome of each attempt.
+        deadline: Time budget of the call, by default the one of the current invocation.
+
+    Returns:
+        The result of the operation.
+
+    Raises:
+        DeadlineExceeded: If the budget ran out before a successful attempt.
+        CircuitOpenError: If the circuit of the service is open.
+        Exception: The error of the last attempt, if it was not retryable or no attempts remain.
+    """
+    deadline = deadline or get_deadline()
+    for attempt in range(max_attempts):
+        if breaker is not None:
+            breaker.allow()
+        try:
+            result = operation(deadline.timeout(timeout))
+        except Exception as err:
+            if not retryable(err):
+                if breaker is not None:
+                    breaker.record_success()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt == max_attempts - 1:
+                raise
+
+            # Full jitter, and no retry whose delay would leave no time for the attempt itself
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if delay >= deadline.remaining():
+                raise DeadlineExceeded('No time left to retry the call') from err
+            time.sleep(delay)
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=BOUNDED_WORKERS, thread_name_prefix='bounded')
+    return _executor
+
+
+def call_within_deadline(operation: Callable[[], T], deadline: Deadline | None = None) -> T:
+    """
+    Call an operation whose timeout cannot be set per call, such as a request of a boto3 client
+    shared by every thread, waiting for it only as long as the budget allows. An abandoned call
+    keeps running in the background until the timeouts of its client end it.
+
+    Args:
+        operation: Function called without arguments.
+        deadline: Time budget of the call, by default the one of the current invocation.
+
+    Returns:
+        The result of the operation.
+
+    Raises:
+        DeadlineExceeded: If there is no budget left, or the call did not finish within it.
+    """
+    deadline = deadline or get_deadline()
+    remaining = deadline.remaining()
+    if remaining == math.inf:
+        return operation()
+    if remaining <= 0:
+        raise DeadlineExceeded('No time left for the call')
+
+    future = _get_executor().submit(operation)
+    try:
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        future.cancel()
+        raise DeadlineExceeded('The call did not finish within the time left') from None
+
+
+def set_deadline(deadline: Deadline) -> None:
+    """
+    Set the deadline of the current invocation, which is shared by the threads of its records.
+    """
+    global _deadline
+    _deadline = deadline
+
+
+def get_deadline() -> Deadline:
+    """
+    Get the deadline of the current invocation, which is unbounded if none was set.
+    """
+    return _deadline or Deadline()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """
+    Get the circuit breaker of a downstream service, which is created once per container
+    so that its state survives across warm invocations.
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker())
+    return breaker
@@ -0,0 +1,345 @@
+import io
+import os
+import json
+import time
+import tarfile
+import logging
+import zipfile
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import PurePosixPath
+from typing import Any, Callable, Iterator
+
+from budget import Deadline, get_deadline, set_deadline
+from cache import get_isbn_cache, get_analysis_cache
+from clients import get_client
+from detections import flush_detections
+from handler import analyze_record, load_record, lookup_books, close_writer, MAX_IMAGE_BYTES, PREPROCESS_IMAGES
+from metrics import get_metrics
+from writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BULK_WORKERS = int(os.getenv('BULK_WORKERS', '8'))
+MANIFEST_PREFIX = os.getenv('MANIFEST_PREFIX', 'bulk-manifests/')
+
+# Members analyzed together, which bounds the image bytes held in memory at the same time
+CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '25'))
+
+# Members deferred when the run is out of time are re-driven by a request written next to the archive,
+# which triggers another run of only those members, up to a number of times
+REDRIVE_SUFFIX = '.redrive.json'
+MAX_REDRIVES = int(os.getenv('BULK_MAX_REDRIVES', '3'))
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+
+# Size of the ranged GET requests of ZIP archives, which are read through their central directory
+RANGE_SIZE = 8 * 1024 * 1024
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable read-only file over an S3 object which fetches the requested ranges on demand,
+    so that ZIP archives can be read member by member without downloading them.
+    """
+    def __init__(self, bucket: str, key: str, size: int):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.requests = 0
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = self.size + offset
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        if self._position >= self.size:
+            return 0
+        end = min(self._position + len(buffer), self.size) - 1
+        body = get_client('s3').get_object(
+            Bucket=self.bucket, Key=self.key, Range=f'bytes={self._position}-{end}'
+        )['Body'].read()
+        self.requests += 1
+        buffer[:len(body)] = body
+        self._position += len(body)
+        return len(body)
+
+
+def _is_image(name: str) -> bool:
+    path = PurePosixPath(name)
+    return path.suffix.lower() in IMAGE_SUFFIXES and not path.name.startswith('.')
+
+
+def iter_members(bucket: str, key: str, names: set[str] | None = None,
+                 expired: Callable[[], bool] | None = None) -> Iterator[tuple[str,bytes | None]]:
+    """
+    Read the images of a ZIP or TAR archive stored in S3 one member at a time, without
+    extracting the archive. TAR archives, optionally compressed, are read as a stream, and
+    ZIP archives with ranged requests.
+
+    Args:
+        bucket: Name of the S3 bucket of the archive.
+        key: Key of the archive object.
+        names: Optional names of the members to read, whose other members are skipped.
+        expired: Optional check of the time budget, after which the remaining members are only
+                 listed, by the central directory of ZIP archives or the headers of TAR archives.
+
+    Yields:
+        tuple[str,bytes | None]: The name and bytes of each image member, which are None for
+                                 the members listed once the budget expired.
+
+    Raises:
+        ValueError: If the archive is neither a ZIP nor a TAR archive.
+    """
+    if key.lower().endswith('.zip'):
+        size = get_client('s3').head_object(Bucket=bucket, Key=key)['ContentLength']
+        reader = io.BufferedReader(S3RangeReader(bucket, key, size), buffer_size=RANGE_SIZE)
+        with zipfile.ZipFile(reader) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_image(info.filename) and (names is None or info.filename in names):
+                    yield info.filename, None if expired is not None and expired() else archive.read(info)
+        return
+
+    body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        with tarfile.open(fileobj=body, mode='r|*') as archive:
+            for info in archive:
+                # The data of members which are not extracted is skipped by the next header
+                if info.isfile() and _is_image(info.name) and (names is None or info.name in names):
+                    yield info.name, None if expired is not None and expired() else archive.extractfile(info).read()
+    except tarfile.ReadError as err:
+        raise ValueError(f'Unsupported archive: {key}') from err
+    finally:
+        body.close()
+
+
+def _chunks(members: Iterator, size: int) -> Iterator[list]:
+    chunk = []
+    for member in members:
+        chunk.append(member)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def member_timestamp(event_time: str, index: int) -> str:
+    # Sort key of the rows of a member, suffixed with its position in the archive so that
+    # copies of the same book in an archive are separate events
+    return f'{event_time}#{index:05d}'
+
+
+def process_archive(bucket: str, key: str, event_time: str, workers: int = BULK_WORKERS,
+                    members: dict[str,int] | None = None) -> dict[str,Any]:
+    """
+    Analyze every image of an archive with the pipeline of the Lambda handler, reading
+    the members sequentially and analyzing each chunk of members on a bounded pool.
+
+    Args:
+        bucket: Name of the S3 bucket of the archive.
+        key: Key of the archive object.
+        event_time: Time of the S3 event of the archive, which is suffixed with the position of
+                    each member in the archive as the timestamp of its rows.
+        workers: Number of members analyzed at the same time.
+        members: Optional positions of the only members to analyze by name, as re-driven members
+                 keep the timestamps of the first run.
+
+    Returns:
+        dict[str,Any]: The manifest of the archive, with the summary of the run and the result
+                       and timings of each member.
+    """
+    rekognition = get_client('rekognition')
+    table_name = os.getenv('TABLE_NAME')
+    processed = []
+    start = time.perf_counter()
+
+    # Members are no longer read once the run is out of time, so that the manifest and the
+    # re-drive request of the remaining members are still written before the timeout
+    def indexed_members():
+        members_iter = iter_members(bucket, key, set(members) if members else None, get_deadline().expired)
+        for index, (name, image_bytes) in enumerate(members_iter):
+            yield (members[name] if members else index), name, image_bytes
+
+    def analyze(member):
+        index, name, image_bytes = member
+        record = {
+            's3': {'bucket': {'name': bucket}, 'object': {'key': f'{key}/{name}'}},
+            'eventTime': member_timestamp(event_time, index)
+        }
+        member_start = time.perf_counter()
+        if image_bytes is None:
+            result = {'bucket': bucket, 'key': record['s3']['object']['key'], 'status': 'DEFERRED',
+                      'error': 'No time left to read the member'}
+        elif len(image_bytes) > MAX_IMAGE_BYTES and not PREPROCESS_IMAGES:
+            result = {'bucket': bucket, 'key': record['s3']['object']['key'], 'status': 'FAILED',
+                      'error': f'Images sent as bytes cannot exceed {MAX_IMAGE_BYTES} bytes'}
+        else:
+            result = analyze_record(record, rekognition, image_bytes)
+        result['member'] = name
+        result['index'] = index
+        if image_bytes is not None:
+            result['bytes'] = len(image_bytes)
+        result['analysis_ms'] = round((time.perf_counter() - member_start) * 1000, 3)
+        return result, record
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in _chunks(indexed_members(), CHUNK_SIZE):
+            analyzed = list(executor.map(analyze, chunk))
+            results = [result for result, _ in analyzed]
+
+            # The ISBN numbers of the chunk are looked up together, as in the Lambda handler
+            writer = BatchWriter(table_name)
+            books_data = lookup_books(results)
+            load_start = time.perf_counter()
+            results = list(executor.map(
+                lambda result, record: load_record(result, record, writer, books_data.get(result.get('isbn'))),
+                results, [record for _, record in analyzed]
+            ))
+            close_writer(writer, results)
+            flush_detections()
+            load_ms = round((time.perf_counter() - load_start) * 1000, 3)
+
+            for result in results:
+                result['load_ms'] = load_ms
+                processed.append({
+                    name: result[name] for name in
+                    ('member', 'index', 'bytes', 'status', 'isbn', 'isbns', 'source', 'error', 'analysis_ms', 'load_ms')
+                    if name in result
+                })
+
+            # Emit the metrics of the stages of each chunk, instead of holding them until the end of the run
+            get_metrics().flush()
+            logger.info('Processed %d members of %s', len(processed), key)
+
+    duration = time.perf_counter() - start
+    statuses = [member['status'] for member in processed]
+    return {
+        'archive': f's3://{bucket}/{key}',
+        'event_time': event_time,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'summary': {
+            'members': len(processed),
+            'succeeded': statuses.count('SUCCESS'),
+            'failed': statuses.count('FAILED'),
+            'deferred': statuses.count('DEFERRED'),
+            'duration_s': round(duration, 3),
+            'members_per_sec': round(len(processed) / duration, 2) if duration else 0.0
+        },
+        'members': processed
+    }
+
+
+def manifest_key(key: str) -> str:
+    # Manifests are kept out of the prefix of the archives, so that they do not trigger a run
+    return f'{MANIFEST_PREFIX}{key}.manifest.json'
+
+
+def redrive_key(key: str, attempt: int) -> str:
+    return f'{key}.{attempt}{REDRIVE_SUFFIX}'
+
+
+def redrive_members(bucket: str, archive: str, manifest: dict[str,Any], attempt: int) -> str | None:
+    """
+    Write the request which re-drives the deferred members of a run of an archive, whose
+    creation triggers a new run of the bulk function with only those members.
+
+    Args:
+        bucket: Name of the S3 bucket of the archive.
+        archive: Key of the archive object.
+        manifest: Manifest of the run, with the event time of the archive and its members.
+        attempt: Number of the re-drive, starting at 1.
+
+    Returns:
+        str | None: The key of the request, or None if there is no deferred member or the
+                    members were already re-driven MAX_REDRIVES times.
+    """
+    deferred = {member['member']: member['index'] for member in manifest['members'] if member['status'] == 'DEFERRED'}
+    if not deferred:
+        return None
+    if attempt > MAX_REDRIVES:
+        logger.error('%d members of %s are still deferred after %d re-drives', len(deferred), archive, MAX_REDRIVES)
+        return None
+
+    key = redrive_key(archive, attempt)
+    request = {'archive': archive, 'event_time': manifest['event_time'], 'attempt': attempt, 'members': deferred}
+    get_client('s3').put_object(
+        Bucket=bucket, Key=key, Body=json.dumps(request, indent=4).encode(), ContentType='application/json'
+    )
+    logger.info('Re-driving %d deferred members of %s with %s', len(deferred), archive, key)
+    return key
+
+
+def bulk_handler(event, context):
+    """
+    Process the archives of an S3 event, or the re-drive requests of the members deferred by
+    previous runs, writing the manifest of each run back to the bucket.
+    """
+    set_deadline(Deadline.from_context(context))
+    manifests = []
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        # Keys of S3 notifications are URL-encoded, with spaces as '+'
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+        start = time.perf_counter()
+
+        archive, attempt = key, 1
+        try:
+            if key.endswith(REDRIVE_SUFFIX):
+                request = json.loads(get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read())
+                archive, attempt = request['archive'], request['attempt'] + 1
+                manifest = process_archive(bucket, archive, request['event_time'], members=request['members'])
+            else:
+                manifest = process_archive(bucket, key, record['eventTime'])
+        except Exception as err:
+            logger.exception('Could not process archive %s', key)
+            manifest = {'archive': f's3://{bucket}/{archive}', 'error': repr(err), 'members': []}
+
+        # Deferred members are not only listed in the manifest, but processed again by another run
+        redrive = redrive_members(bucket, archive, manifest, attempt)
+        if redrive is not None:
+            manifest['redrive'] = redrive
+
+        get_client('s3').put_object(
+            Bucket=bucket,
+            Key=manifest_key(key),
+            Body=json.dumps(manifest, indent=4).encode(),
+            ContentType='application/json'
+        )
+
+        # Archives are reported as their own stage, since their duration is not comparable
+        # to the one of the invocations of the processor
+        statuses = [member['status'] for member in manifest['members']]
+        metrics = get_metrics()
+        metrics.record('cache', **get_isbn_cache().pop_stats())
+        metrics.record('dedup', **get_analysis_cache().pop_stats())
+        metrics.record(
+            'archive',
+            duration_ms=round((time.perf_counter() - start) * 1000, 3),
+            records=len(statuses),
+            errors=statuses.count('FAILED') + ('error' in manifest),
+            deferred=statuses.count('DEFERRED')
+        )
+        metrics.flush()
+        manifests.append({'archive': manifest['archive'], 'manifest': manifest_key(key), **manifest.get('summary', {})})
+        logger.info('Manifest of %s written to %s', key, manifest_key(key))
+
+    return {'manifests': manifests}
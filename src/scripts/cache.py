@@ -0,0 +1,306 @@
+import os
+import copy
+import json
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Any, Callable
+
+from botocore.exceptions import ClientError
+from clients import get_table
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CACHE_TABLE_NAME = os.getenv('CACHE_TABLE_NAME')
+MEMORY_CACHE_SIZE = int(os.getenv('MEMORY_CACHE_SIZE', '1024'))
+MEMORY_CACHE_TTL = int(os.getenv('MEMORY_CACHE_TTL', '900'))
+CACHE_TABLE_TTL = int(os.getenv('CACHE_TABLE_TTL', str(30 * 24 * 3600)))
+NOT_FOUND_TTL = int(os.getenv('NOT_FOUND_TTL', '3600'))
+DEDUP_TABLE_NAME = os.getenv('DEDUP_TABLE_NAME')
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', str(7 * 24 * 3600)))
+
+_lock = threading.Lock()
+_isbn_cache = None
+_analysis_cache = None
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache whose entries expire after a time-to-live.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, ttl: float | None = None) -> None:
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class DynamoDBCache:
+    """
+    Cache backed by a DynamoDB table whose items are expired through the native TTL of
+    the 'expires_at' attribute. Since the deletion of expired items is not immediate,
+    their expiration is also checked on read.
+    """
+    def __init__(self, table_name: str, key_name: str = 'isbn', stage: str = 'cache_table'):
+        self.table_name = table_name
+        self.key_name = key_name
+        self.stage = stage
+
+    def get(self, key: str) -> dict[str,Any] | None:
+        with get_metrics().stage(self.stage):
+            response = get_table(self.table_name).get_item(Key={self.key_name: key})
+        item = response.get('Item')
+        if item is None or int(item['expires_at']) <= time.time():
+            return None
+        return json.loads(item['data'])
+
+    def put(self, key: str, value: dict[str,Any], ttl: float) -> None:
+        # The data is stored as a JSON string to keep numbers as integers instead of Decimal
+        with get_metrics().stage(self.stage):
+            get_table(self.table_name).put_item(
+                Item={
+                    self.key_name: key,
+                    'data': json.dumps(value),
+                    'expires_at': int(time.time() + ttl)
+                }
+            )
+
+
+class ISBNCache:
+    """
+    Read-through cache of structured book data with an in-memory tier, which survives
+    across warm invocations, and an optional DynamoDB tier. Books which are not found
+    (exception: 1) are kept for a shorter time-to-live.
+    """
+    def __init__(self, memory: LRUCache, table: DynamoDBCache | None = None,
+                 table_ttl: float = CACHE_TABLE_TTL, not_found_ttl: float = NOT_FOUND_TTL):
+        self.memory = memory
+        self.table = table
+        self.table_ttl = table_ttl
+        self.not_found_ttl = not_found_ttl
+        self._stats = {'memory_hits': 0, 'table_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._stats[counter] += 1
+
+    def pop_stats(self) -> dict[str,int]:
+        """
+        Get the hit and miss counters since the last call and reset them.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            self._stats = dict.fromkeys(self._stats, 0)
+        return stats
+
+    def clear(self) -> None:
+        self.memory.clear()
+        self.pop_stats()
+
+    def get_or_load(self, isbn: str, loader: Callable[[str], dict[str,Any]]) -> dict[str,Any]:
+        """
+        Get the book data of an ISBN number from the cache tiers, or from the loader
+        in case of a miss, storing the result in every tier.
+
+        Args:
+            isbn: String of the ISBN-10 or ISBN-13 number used as the cache key.
+            loader: Function which structures the book data of the ISBN number on a miss.
+
+        Returns:
+            dict[str,Any]: A copy of the book data, which can be modified by the caller.
+        """
+        book_data = self._get(isbn)
+        if book_data is None:
+            self._count('misses')
+            book_data = loader(isbn)
+            self._put(isbn, book_data)
+        return copy.deepcopy(book_data)
+
+    def get_or_load_many(self, isbns: list[str],
+                         loader: Callable[[list[str]], dict[str,dict[str,Any]]]) -> dict[str,dict[str,Any]]:
+        """
+        Get the book data of several ISBN numbers from the cache tiers, calling the loader
+        once with every missing number.
+
+        Args:
+            isbns: List of ISBN-10 or ISBN-13 numbers used as cache keys.
+            loader: Function which structures the book data of the missing numbers, which can
+                    leave out the numbers it could not look up.
+
+        Returns:
+            dict[str,dict[str,Any]]: Copies of the book data of each found ISBN number.
+        """
+        books_data = {}
+        missing = []
+        for isbn in isbns:
+            book_data = self._get(isbn)
+            if book_data is None:
+                self._count('misses')
+                missing.append(isbn)
+            else:
+                books_data[isbn] = book_data
+
+        if missing:
+            for isbn, book_data in loader(missing).items():
+                self._put(isbn, book_data)
+                books_data[isbn] = book_data
+
+        return {isbn: copy.deepcopy(book_data) for isbn, book_data in books_data.items()}
+
+    def _get(self, isbn: str) -> dict[str,Any] | None:
+        book_data = self.memory.get(isbn)
+        if book_data is not None:
+            self._count('memory_hits')
+            return book_data
+
+        if self.table is not None:
+            try:
+                book_data = self.table.get(isbn)
+            except ClientError as err:
+                # A failing cache table only costs a regular lookup
+                logger.warning('Could not read the cache table. %s', err.response['Error']['Message'])
+
+        if book_data is not None:
+            self._count('table_hits')
+            self._put_memory(isbn, book_data)
+        return book_data
+
+    def _put(self, isbn: str, book_data: dict[str,Any]) -> None:
+        if self.table is not None:
+            ttl = self.not_found_ttl if book_data.get('exception') == 1 else self.table_ttl
+            try:
+                self.table.put(isbn, book_data, ttl)
+            except ClientError as err:
+                logger.warning('Could not write to the cache table. %s', err.response['Error']['Message'])
+        self._put_memory(isbn, book_data)
+
+    def _put_memory(self, isbn: str, book_data: dict[str,Any]) -> None:
+        negative_ttl = self.not_found_ttl if book_data.get('exception') == 1 else None
+        self.memory.put(isbn, copy.deepcopy(book_data), ttl=negative_ttl)
+
+
+class AnalysisCache:
+    """
+    Cache of the analysis of each image keyed by its content hash, so that re-uploaded
+    images skip Rekognition, with an in-memory tier and an optional DynamoDB tier. Only
+    the analyses which detected an ISBN number are cached, along with their duration,
+    which is counted as saved time on every hit.
+    """
+    def __init__(self, memory: LRUCache, table: DynamoDBCache | None = None, ttl: float = DEDUP_TTL):
+        self.memory = memory
+        self.table = table
+        self.ttl = ttl
+        self._stats = {'hits': 0, 'misses': 0, 'rekognition_calls_saved': 0, 'saved_ms': 0.0}
+        self._lock = threading.Lock()
+
+    def pop_stats(self) -> dict[str,float]:
+        """
+        Get the hit and miss counters and the saved analysis time since the last call and reset them.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            self._stats = dict.fromkeys(self._stats, 0)
+        stats['saved_ms'] = round(stats['saved_ms'], 3)
+        return stats
+
+    def clear(self) -> None:
+        self.memory.clear()
+        self.pop_stats()
+
+    def get(self, content_hash: str) -> dict[str,Any] | None:
+        """
+        Get the analysis of an image from the cache tiers.
+
+        Args:
+            content_hash: ETag of the S3 object or MD5 hash of the image bytes.
+
+        Returns:
+            dict[str,Any] | None: The ISBN number, the path which served the image and the
+                                  duration of the original analysis, or None on a miss.
+        """
+        analysis = self.memory.get(content_hash)
+        if analysis is None and self.table is not None:
+            try:
+                analysis = self.table.get(content_hash)
+            except ClientError as err:
+                logger.warning('Could not read the dedup table. %s', err.response['Error']['Message'])
+            if analysis is not None:
+                self.memory.put(content_hash, analysis)
+
+        with self._lock:
+            if analysis is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+                self._stats['rekognition_calls_saved'] += analysis['source'] == 'rekognition'
+                self._stats['saved_ms'] += analysis['analysis_ms']
+        return analysis
+
+    def put(self, content_hash: str, analysis: dict[str,Any]) -> None:
+        if self.table is not None:
+            try:
+                self.table.put(content_hash, analysis, self.ttl)
+            except ClientError as err:
+                logger.warning('Could not write to the dedup table. %s', err.response['Error']['Message'])
+        self.memory.put(content_hash, analysis)
+
+
+def get_isbn_cache() -> ISBNCache:
+    """
+    Get the ISBN cache of the container, with a DynamoDB tier only if CACHE_TABLE_NAME is set.
+    """
+    global _isbn_cache
+    if _isbn_cache is None:
+        with _lock:
+            if _isbn_cache is None:
+                table = DynamoDBCache(CACHE_TABLE_NAME) if CACHE_TABLE_NAME else None
+                _isbn_cache = ISBNCache(LRUCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL), table)
+    return _isbn_cache
+
+
+def get_analysis_cache() -> AnalysisCache:
+    """
+    Get the image analysis cache of the container, with a DynamoDB tier only if DEDUP_TABLE_NAME is set.
+    """
+    global _analysis_cache
+    if _analysis_cache is None:
+        with _lock:
+            if _analysis_cache is None:
+                table = DynamoDBCache(DEDUP_TABLE_NAME, key_name='content_hash', stage='dedup_table') \
+                        if DEDUP_TABLE_NAME else None
+                _analysis_cache = AnalysisCache(LRUCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL), table)
+    return _analysis_cache
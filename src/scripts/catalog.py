@@ -0,0 +1,132 @@
+import os
+import mmap
+import json
+import struct
+import threading
+
+from pathlib import Path
+from typing import Any, Iterable
+
+from isbn import normalize_isbn
+
+# Lambda layers are extracted under /opt, so the index of the catalog layer is found without any setting
+CATALOG_PATH = os.getenv('CATALOG_PATH', '/opt/catalog/isbn.idx')
+
+# Header with the format version and the number of books, followed by a fixed-width entry
+# per book, sorted by ISBN-13, with the offset and length of its record in the data section
+MAGIC = b'ISBNIDX1'
+HEADER = struct.Struct('<8sI')
+ENTRY = struct.Struct('<13sII')
+
+# Fields of the structured book data kept in the records of the index
+BOOK_FIELDS = ('isbn', 'authors', 'title', 'categories', 'page_count', 'language', 'publisher', 'year')
+
+_lock = threading.Lock()
+_catalog = None
+_loaded = False
+
+
+class CatalogIndex:
+    """
+    Read-only index of known books memory-mapped from a sorted binary file, where each
+    lookup is a binary search over the fixed-width entries, so that only the pages which
+    are read are loaded into memory and the index is shared by the threads of a container.
+    """
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with self.path.open('rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f'Invalid catalog index: {path}')
+        self._data_start = HEADER.size + self.count * ENTRY.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _entry(self, position: int) -> tuple[bytes,int,int]:
+        return ENTRY.unpack_from(self._map, HEADER.size + position * ENTRY.size)
+
+    def get(self, isbn: str) -> dict[str,Any] | None:
+        """
+        Get the book data of an ISBN number, in the same format as structure_book_data.
+
+        Args:
+            isbn: ISBN-10 or ISBN-13 number, which is looked up by its ISBN-13 form.
+
+        Returns:
+            dict[str,Any] | None: A new copy of the book data, or None if the book is not in the index.
+        """
+        normalized = normalize_isbn(isbn)
+        if normalized is None:
+            return None
+        key = normalized.encode()
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry_key, offset, length = self._entry(middle)
+            if entry_key < key:
+                low = middle + 1
+            elif entry_key > key:
+                high = middle
+            else:
+                start = self._data_start + offset
+                book_data = json.loads(self._map[start:start + length])
+                book_data['exception'] = 0
+                return book_data
+        return None
+
+    def close(self) -> None:
+        self._map.close()
+
+
+def write_index(books: Iterable[dict[str,Any]], path: str | Path) -> int:
+    """
+    Write the sorted binary index of some books, keeping the last record of each ISBN-13 number.
+
+    Args:
+        books: Structured book data of known books, whose numbers are stored in their ISBN-13 form.
+        path: Path of the index file.
+
+    Returns:
+        int: The number of books in the index.
+
+    Raises:
+        ValueError: If a book has no valid ISBN number.
+    """
+    records = {}
+    for book in books:
+        isbn = normalize_isbn(str(book.get('isbn', '')))
+        if isbn is None:
+            raise ValueError(f'Invalid ISBN number in catalog: {book.get('isbn')}')
+        record = {field: book[field] for field in BOOK_FIELDS if field in book}
+        record['isbn'] = isbn
+        records[isbn] = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode()
+
+    entries = []
+    offset = 0
+    for isbn in sorted(records):
+        entries.append(ENTRY.pack(isbn.encode(), offset, len(records[isbn])))
+        offset += len(records[isbn])
+
+    with Path(path).open('wb') as file:
+        file.write(HEADER.pack(MAGIC, len(entries)))
+        file.writelines(entries)
+        file.writelines(records[isbn] for isbn in sorted(records))
+    return len(entries)
+
+
+def get_catalog() -> CatalogIndex | None:
+    """
+    Get the catalog index of the container, which is opened once, or None if CATALOG_PATH
+    does not exist (e.g., the catalog layer is not attached).
+    """
+    global _catalog, _loaded
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                _catalog = CatalogIndex(CATALOG_PATH) if os.path.exists(CATALOG_PATH) else None
+                _loaded = True
+    return _catalog
@@ -0,0 +1,355 @@
+import os
+import gzip
+import time
+import queue
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+
+from typing import Any
+
+import boto3
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from botocore.config import Config
+
+# Connection pool shared by the threads of an invocation, sized above the record worker pool, with
+# timeouts and attempts which fit a call of AWS (e.g., DetectText) within the budget of a stage
+# instead of the 60 seconds of the default read timeout
+BOTO_CONFIG = Config(
+    max_pool_connections=int(os.getenv('MAX_POOL_CONNECTIONS', '16')),
+    tcp_keepalive=True,
+    connect_timeout=float(os.getenv('AWS_CONNECT_TIMEOUT', '2')),
+    read_timeout=float(os.getenv('AWS_READ_TIMEOUT', '5')),
+    retries={'mode': 'standard', 'max_attempts': int(os.getenv('AWS_MAX_ATTEMPTS', '2'))}
+)
+
+GOOGLE_BOOKS_URL = os.getenv('GOOGLE_BOOKS_URL', 'https://www.googleapis.com')
+OPEN_LIBRARY_URL = os.getenv('OPEN_LIBRARY_URL', 'https://openlibrary.org')
+
+# Module-level state is kept by warm Lambda containers between invocations
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_tables = {}
+_books_session = None
+_open_library_session = None
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket which allows a number of operations per second, with bursts
+    of up to one second of operations.
+    """
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Block until the tokens are available. Requests larger than the burst size wait for
+        a full bucket and leave a negative balance, which delays the following requests.
+        """
+        required = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= required:
+                    self._tokens -= tokens
+                    return
+                wait = (required - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class KeepAliveSession:
+    """
+    Persistent HTTP(S) connections to a single host which are reused between requests,
+    avoiding a new TCP and TLS handshake for every call. Since http.client connections
+    are not thread-safe, each request checks out an idle connection of the session and
+    returns it once the response is read, so that connections outlive the threads which
+    opened them (e.g., the worker pools created by each invocation).
+    """
+    def __init__(self, base_url: str, timeout: float | None = None, rate_limiter: RateLimiter | None = None):
+        parsed_url = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url.rstrip('/')
+        self.host = parsed_url.netloc
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self._connection_class = http.client.HTTPSConnection \
+                                 if parsed_url.scheme == 'https' else http.client.HTTPConnection
+        # The most recently used connection is checked out first, since it is the least likely to be closed
+        self._idle = queue.LifoQueue()
+
+    def _checkout(self) -> http.client.HTTPConnection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connection_class(self.host, timeout=self.timeout)
+
+    def _set_timeout(self, connection: http.client.HTTPConnection, timeout: float | None) -> None:
+        # The timeout of an open connection is set on its socket, since it is only read on connect
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def get(self, path: str, timeout: float | None = None) -> bytes:
+        """
+        Make a GET request to the host, accepting gzip-encoded responses.
+
+        Args:
+            path: Path and query string of the request (e.g., /books/v1/volumes?q=isbn:9789876290500).
+            timeout: Optional socket timeout of the request, in seconds, instead of the one of the session.
+
+        Returns:
+            bytes: The decompressed body of the response.
+
+        Raises:
+            urllib.error.HTTPError: If the response has a non-2xx status code.
+            urllib.error.URLError: If the connection to the host fails.
+        """
+        headers = {
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive'
+        }
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        # A connection closed by the server while idle is retried once with a new connection
+        for attempt in range(2):
+            connection = self._checkout() if attempt == 0 else self._connection_class(self.host, timeout=self.timeout)
+            self._set_timeout(connection, self.timeout if timeout is None else timeout)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as err:
+                connection.close()
+                if attempt == 1:
+                    raise urllib.error.URLError(err)
+            except (http.client.HTTPException, OSError) as err:
+                connection.close()
+                raise urllib.error.URLError(err)
+
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(
+                self.base_url + path, response.status, response.reason, response.headers, None
+            )
+        return body
+
+
+def _get_session() -> boto3.session.Session:
+    # The default boto3 session is not thread-safe, so clients are built from a dedicated one
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service_name: str):
+    """
+    Get the boto3 client of an AWS service, which is created once per container.
+
+    Args:
+        service_name: Name of the AWS service (e.g., rekognition).
+
+    Returns:
+        botocore.client.BaseClient: The thread-safe client with the tuned connection pool.
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _get_session().client(service_name, config=BOTO_CONFIG)
+                _clients[service_name] = client
+    return client
+
+
+class DynamoDBTable:
+    """
+    DynamoDB table with the interface of the Table resource of boto3, built on the low-level
+    client of the container, which unlike resources is thread-safe and can be shared by every
+    thread. Items, keys and condition objects are serialized and deserialized as the Table
+    resource does, with numbers returned as Decimal.
+    """
+    SERIALIZED_PARAMETERS = ('Key', 'Item', 'ExclusiveStartKey')
+    DESERIALIZED_FIELDS = ('Item', 'Attributes', 'LastEvaluatedKey')
+    CONDITION_PARAMETERS = ('KeyConditionExpression', 'FilterExpression', 'ConditionExpression')
+
+    def __init__(self, table_name: str, client=None):
+        self.name = table_name
+        self.client = client if client is not None else get_client('dynamodb')
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def serialize(self, item: dict[str,Any]) -> dict[str,Any]:
+        return {name: self._serializer.serialize(value) for name, value in item.items()}
+
+    def deserialize(self, item: dict[str,Any]) -> dict[str,Any]:
+        return {name: self._deserializer.deserialize(value) for name, value in item.items()}
+
+    def _request(self, operation: str, **kwargs: Any) -> dict[str,Any]:
+        # A builder per request, so that the placeholders of its conditions do not collide
+        builder = ConditionExpressionBuilder()
+        names = kwargs.pop('ExpressionAttributeNames', {})
+        values = kwargs.pop('ExpressionAttributeValues', {})
+        for parameter in self.CONDITION_PARAMETERS:
+            if isinstance(kwargs.get(parameter), ConditionBase):
+                expression = builder.build_expression(
+                    kwargs[parameter], is_key_condition=parameter == 'KeyConditionExpression'
+                )
+                kwargs[parameter] = expression.condition_expression
+                names = {**names, **expression.attribute_name_placeholders}
+                values = {**values, **expression.attribute_value_placeholders}
+
+        for parameter in self.SERIALIZED_PARAMETERS:
+            if parameter in kwargs:
+                kwargs[parameter] = self.serialize(kwargs[parameter])
+        if names:
+            kwargs['ExpressionAttributeNames'] = names
+        if values:
+            kwargs['ExpressionAttributeValues'] = self.serialize(values)
+
+        response = getattr(self.client, operation)(TableName=self.name, **kwargs)
+        for field in self.DESERIALIZED_FIELDS:
+            if field in response:
+                response[field] = self.deserialize(response[field])
+        if 'Items' in response:
+            response['Items'] = [self.deserialize(item) for item in response['Items']]
+        return response
+
+    def get_item(self, **kwargs: Any) -> dict[str,Any]:
+        return self._request('get_item', **kwargs)
+
+    def put_item(self, **kwargs: Any) -> dict[str,Any]:
+        return self._request('put_item', **kwargs)
+
+    def update_item(self, **kwargs: Any) -> dict[str,Any]:
+        return self._request('update_item', **kwargs)
+
+    def delete_item(self, **kwargs: Any) -> dict[str,Any]:
+        return self._request('delete_item', **kwargs)
+
+    def query(self, **kwargs: Any) -> dict[str,Any]:
+        return self._request('query', **kwargs)
+
+    def scan(self, **kwargs: Any) -> dict[str,Any]:
+        return self._request('scan', **kwargs)
+
+    def transact_write_items(self, TransactItems: list[dict[str,Any]]) -> dict[str,Any]:
+        """
+        Write the actions on items of the table as a single transaction, each given as a Put,
+        Update, Delete or ConditionCheck with string expressions and without the table name.
+        """
+        actions = []
+        for action in TransactItems:
+            [(operation, parameters)] = action.items()
+            parameters = {**parameters, 'TableName': self.name}
+            for parameter in ('Key', 'Item', 'ExpressionAttributeValues'):
+                if parameter in parameters:
+                    parameters[parameter] = self.serialize(parameters[parameter])
+            actions.append({operation: parameters})
+        return self.client.transact_write_items(TransactItems=actions)
+
+    def batch_write_item(self, RequestItems: dict[str,list[dict[str,Any]]]) -> dict[str,Any]:
+        """
+        Write a batch of put requests of the table, returning its unprocessed requests
+        with their items deserialized.
+        """
+        response = self.client.batch_write_item(
+            RequestItems={
+                table_name: [{'PutRequest': {'Item': self.serialize(request['PutRequest']['Item'])}}
+                             for request in requests]
+                for table_name, requests in RequestItems.items()
+            }
+        )
+        response['UnprocessedItems'] = {
+            table_name: [{'PutRequest': {'Item': self.deserialize(request['PutRequest']['Item'])}}
+                         for request in requests]
+            for table_name, requests in response.get('UnprocessedItems', {}).items()
+        }
+        return response
+
+
+def get_table(table_name: str) -> DynamoDBTable:
+    """
+    Get a DynamoDB table, which is created once per container and shared by every thread.
+
+    Args:
+        table_name: Name of the DynamoDB table.
+
+    Returns:
+        DynamoDBTable: The table built on the shared DynamoDB client.
+    """
+    table = _tables.get(table_name)
+    if table is None:
+        # The client is got before taking the lock, which get_client takes as well
+        client = get_client('dynamodb')
+        with _lock:
+            table = _tables.get(table_name)
+            if table is None:
+                table = _tables[table_name] = DynamoDBTable(table_name, client)
+    return table
+
+
+def init_clients(service_names: list[str], table_names: list[str]) -> None:
+    """
+    Construct the clients and tables used by the invocations of a container ahead of time,
+    so that the service models are loaded during the init phase. Since tables and sessions
+    are shared by every thread, the worker threads of the invocations reuse them.
+
+    Args:
+        service_names: Names of the AWS services whose clients are constructed.
+        table_names: Names of the DynamoDB tables which are constructed.
+    """
+    for service_name in service_names:
+        get_client(service_name)
+    for table_name in table_names:
+        get_table(table_name)
+    get_books_session()
+
+
+def get_books_session() -> KeepAliveSession:
+    """
+    Get the keep-alive session for the Google Books API, which is created once per container.
+    """
+    global _books_session
+    if _books_session is None:
+        with _lock:
+            if _books_session is None:
+                _books_session = KeepAliveSession(GOOGLE_BOOKS_URL)
+    return _books_session
+
+
+def get_open_library_session() -> KeepAliveSession:
+    """
+    Get the keep-alive session for the Open Library API, which is created once per container.
+    """
+    global _open_library_session
+    if _open_library_session is None:
+        with _lock:
+            if _open_library_session is None:
+                _open_library_session = KeepAliveSession(OPEN_LIBRARY_URL)
+    return _open_library_session
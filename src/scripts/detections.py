@@ -0,0 +1,142 @@
+import os
+import gzip
+import json
+import uuid
+import logging
+import threading
+
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any
+
+from clients import get_client
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Bucket of the archive of raw Rekognition detections, which is disabled when empty
+DETECTIONS_BUCKET = os.getenv('DETECTIONS_BUCKET', '')
+DETECTIONS_PREFIX = os.getenv('DETECTIONS_PREFIX', 'detections/')
+
+# Fields of the bounding boxes read by the parsers of isbn.py, whose ratios are rounded
+# to a precision far below a pixel of the images
+BOX_FIELDS = ('Width', 'Height', 'Left', 'Top')
+BOX_DIGITS = 5
+
+_lock = threading.Lock()
+_archive = None
+
+
+def compact_detection(detection: dict[str,Any]) -> dict[str,Any]:
+    """
+    Strip a TextDetection of Rekognition down to the fields read by the ISBN parsers, dropping
+    the identifiers, parents and polygons, while keeping the field names of Rekognition so that
+    the parsers read archived detections as they are.
+    """
+    compact = {
+        'DetectedText': detection.get('DetectedText', ''),
+        'Type': detection.get('Type', 'LINE'),
+        'Confidence': round(detection.get('Confidence', 0.0), 2)
+    }
+    box = detection.get('Geometry', {}).get('BoundingBox')
+    if box:
+        compact['Geometry'] = {
+            'BoundingBox': {field: round(box[field], BOX_DIGITS) for field in BOX_FIELDS if field in box}
+        }
+    return compact
+
+
+def archive_key(day: str, prefix: str = DETECTIONS_PREFIX) -> str:
+    # Objects are partitioned by the day of their events, and named after their write time
+    written_at = datetime.now(timezone.utc).strftime('%H%M%S')
+    return f'{prefix}dt={day}/{written_at}-{uuid.uuid4().hex[:12]}.jsonl.gz'
+
+
+class DetectionArchive:
+    """
+    Thread-safe buffer of the detections of the images analyzed by an invocation, which
+    are written as gzip-compressed JSONL objects, one per day of the events, so that the
+    history of images can be parsed again without calling Rekognition.
+    """
+    def __init__(self, bucket: str, prefix: str = DETECTIONS_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+        self._entries = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, record: dict[str,Any], detections: list[dict[str,Any]], isbns: list[str]) -> dict[str,Any]:
+        """
+        Buffer the detections of the image of an S3 event record.
+
+        Args:
+            record: S3 event notification record with bucket, object and eventTime fields.
+            detections: TextDetections of the DetectText response of the image.
+            isbns: ISBN numbers parsed from the detections, one per book of the image.
+
+        Returns:
+            dict[str,Any]: The buffered entry, which is only serialized when flushed, so that
+                           the keys of the items of the image can be added once they are loaded.
+        """
+        entry = {
+            'bucket': record['s3']['bucket']['name'],
+            'key': record['s3']['object']['key'],
+            'event_time': record['eventTime'],
+            'isbns': isbns,
+            'detections': [compact_detection(detection) for detection in detections]
+        }
+        etag = record['s3']['object'].get('eTag')
+        if etag:
+            entry['etag'] = etag.strip('"')
+
+        with self._lock:
+            self._entries[record['eventTime'][:10]].append(entry)
+        return entry
+
+    def flush(self) -> list[str]:
+        """
+        Write the buffered detections to S3. Failed writes are logged instead of raised, since
+        the records whose detections they hold were already processed.
+
+        Returns:
+            list[str]: The keys of the written objects.
+        """
+        with self._lock:
+            days, self._entries = self._entries, defaultdict(list)
+
+        keys = []
+        for day, entries in sorted(days.items()):
+            key = archive_key(day, self.prefix)
+            lines = [json.dumps(entry, separators=(',', ':'), ensure_ascii=False).encode() for entry in entries]
+            try:
+                with get_metrics().stage('detections', records=len(lines)) as values:
+                    body = gzip.compress(b'\n'.join(lines) + b'\n')
+                    values['bytes'] = len(body)
+                    get_client('s3').put_object(
+                        Bucket=self.bucket, Key=key, Body=body, ContentType='application/x-ndjson'
+                    )
+                keys.append(key)
+            except Exception:
+                logger.exception('Could not archive the detections of %d images', len(lines))
+        return keys
+
+
+def get_detection_archive() -> DetectionArchive | None:
+    """
+    Get the detection archive of the container, which is created once, or None if
+    DETECTIONS_BUCKET is not set.
+    """
+    global _archive
+    if _archive is None and DETECTIONS_BUCKET:
+        with _lock:
+            if _archive is None:
+                _archive = DetectionArchive(DETECTIONS_BUCKET, DETECTIONS_PREFIX)
+    return _archive
+
+
+def flush_detections() -> list[str]:
+    """
+    Write the detections buffered by the container, if the archive is enabled.
+    """
+    archive = get_detection_archive()
+    return archive.flush() if archive is not None else []
@@ -1,61 +1,607 @@
-import re
 import os
+import json
+import time
+import base64
+import hashlib
 import logging
 
-import boto3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
 from botocore.exceptions import ClientError
-from utils import structure_book_data
+from budget import Deadline, DeadlineExceeded, call_within_deadline, set_deadline, get_deadline
+from cache import get_isbn_cache, get_analysis_cache
+from clients import get_client, init_clients
+from detections import get_detection_archive, flush_detections
+from isbn import extract_isbn, extract_books, normalize_isbn
+from metrics import get_metrics
+from preprocess import build_filters, downscale_image, AVAILABLE as PREPROCESS_AVAILABLE
+from utils import structure_book_data, structure_books_data, BooksUnavailableError
+from writer import BatchWriter
 
 # Set up logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-def load_to_db(object, table_name):
-    try:
-        # Set up DynamoDB resource and table
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(table_name)
+# Upper bound of records analyzed at the same time within a single invocation
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
 
-        # Upload the data to the table
-        response = table.put_item(Item=object)
+# Decode EAN-13 barcodes locally before calling Rekognition, which requires NumPy and Pillow,
+# so that they are only imported by the containers which decode barcodes
+BARCODE_DECODING = os.getenv('BARCODE_DECODING', 'false').lower() == 'true'
+if BARCODE_DECODING:
+    from barcode import decode_ean13, AVAILABLE as BARCODE_DECODING
+else:
+    decode_ean13 = None
 
-        # Log the uploaded data
-        logger.info('Object loaded to DynamoDB table %s: %s', table_name, response)
+# Send downscaled image bytes to Rekognition instead of the original S3 object, which requires Pillow
+PREPROCESS_IMAGES = os.getenv('PREPROCESS_IMAGES', 'false').lower() == 'true' and PREPROCESS_AVAILABLE
+DETECT_TEXT_FILTERS = build_filters()
 
-    except ClientError as err:
-        logger.error('CLIENT ERROR %s', err.response['Error']['Code'])
-        err_message = f'Could not upload the object to DynamoDB. {err.response['Error']['Message']}'
-        logger.exception('MESSAGE %s', err_message)
+# Extract the ISBN number of every book of a photo instead of a single one, writing a row per book
+MULTI_BOOK = os.getenv('MULTI_BOOK', 'false').lower() == 'true'
 
+# Construct the clients during the init phase, which is not billed to the first invocation
+# of provisioned containers and runs with a full vCPU for on-demand ones. Clients, tables
+# and sessions are shared by the worker threads of every invocation, so none is built again
+if os.getenv('INIT_CLIENTS', 'false').lower() == 'true':
+    init_clients(
+        ['rekognition', 's3'] if BARCODE_DECODING or PREPROCESS_IMAGES else ['rekognition'],
+        [name for name in (os.getenv('TABLE_NAME'), os.getenv('CACHE_TABLE_NAME'), os.getenv('DEDUP_TABLE_NAME')) if name]
+    )
 
-def lambda_handler(event, context):
-    try:
-        # Set up Rekognition client and analyze the image from the S3 event
-        rekognition = boto3.client('rekognition')
+# Maximum size of the image bytes accepted by Rekognition, which preprocessed images are kept under
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Images without a valid ISBN number fail on every attempt, so their messages are not retried
+NO_ISBN_ERROR = 'No valid ISBN number detected'
+
+
+class DeferredRecordsError(Exception):
+    """
+    Raised at the end of an invocation sent directly by S3 with records which ran out of time
+    or could not reach the Google Books API, so that Lambda retries the event. Records which
+    were already loaded are written again with the same key.
+    """
+
+def load_to_db(object, writer):
+    # Buffer the object, which is written to the DynamoDB table along with other records
+    with get_metrics().stage('load_to_db') as values:
+        values['bytes'] = len(json.dumps(object))
+        writer.add(object)
+    logger.info('Object buffered for DynamoDB table %s', writer.table_name)
+
+
+def analyze_image(bucket, key, rekognition, image_bytes=None, multi_book=False, archive=None):
+    """
+    Get the ISBN number of an image stored in S3, decoding its EAN-13 barcode locally
+    when enabled and falling back to Rekognition text detection, which receives the
+    downscaled image bytes when preprocessing is enabled. The duration of each stage
+    is recorded along with the original and sent image sizes.
+
+    Args:
+        bucket: Name of the S3 bucket of the image.
+        key: Key of the image object.
+        rekognition: Rekognition client shared by the records of the invocation.
+        image_bytes: Optional bytes of the image, which are analyzed instead of the S3 object.
+        multi_book: Whether the ISBN numbers of every book of the image are extracted, in
+                    which case a single barcode is not decoded locally.
+        archive: Optional function called with the TextDetections of the Rekognition response.
+
+    Returns:
+        tuple[str | list[str] | None, str]: The checksum-valid ISBN-13 number, or None if it
+                                            could not be detected, or the list of numbers of
+                                            every book in multi-book mode, and the path which
+                                            served the image (barcode or rekognition).
+    """
+    metrics = get_metrics()
+    stored_in_s3 = image_bytes is None
+    decode_barcode = BARCODE_DECODING and not multi_book
+
+    if stored_in_s3 and (decode_barcode or PREPROCESS_IMAGES):
+        with metrics.stage('s3') as values:
+            image_bytes = call_within_deadline(
+                lambda: get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+            )
+            values['bytes'] = len(image_bytes)
+
+    if decode_barcode:
+        with metrics.stage('barcode'):
+            isbn = normalize_isbn(decode_ean13(image_bytes) or '')
+        if isbn is not None:
+            return isbn, 'barcode'
+
+    # Send the downscaled image bytes when preprocessing, or let Rekognition read the S3 object
+    if PREPROCESS_IMAGES:
+        with metrics.stage('preprocess') as values:
+            image = {'Bytes': downscale_image(image_bytes)}
+            values['bytes'] = len(image['Bytes'])
+    elif not stored_in_s3:
+        image = {'Bytes': image_bytes}
+    else:
         image = {
             'S3Object': {
-                    'Bucket': event['Records'][0]['s3']['bucket']['name'],
-                    'Name': event['Records'][0]['s3']['object']['key']
+                    'Bucket': bucket,
+                    'Name': key
                 }
         }
-        response = rekognition.detect_text(Image=image)
-        
-        # Join together all the detected digits in the first line
-        first_line = response['TextDetections'][0]['DetectedText']
-        isbn = ''.join(re.findall(r'\d', first_line))
-        
-        # Build the JSON object with ISBN data along with timestamp information from the S3 event
-        book_data = structure_book_data(isbn)
-        book_data['timestamp'] = event['Records'][0]['eventTime']
 
-        # Log the parsed data and load it into the DynamoDB table
-        logger.info('Parsed data: %s', book_data)
-        load_to_db(book_data, os.getenv('TABLE_NAME'))
-        
-    except ClientError as err:
+    # Analyze the image from the S3 event with Rekognition, waiting for it only within the budget
+    filters = {'Filters': DETECT_TEXT_FILTERS} if DETECT_TEXT_FILTERS else {}
+    with metrics.stage('rekognition') as values:
+        response = call_within_deadline(lambda: rekognition.detect_text(Image=image, **filters))
+        values['retries'] = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if 'Bytes' in image:
+            values['bytes'] = len(image['Bytes'])
+
+    # Keep the raw detections, so that the image can be parsed again without calling Rekognition
+    if archive is not None:
+        archive(response['TextDetections'])
+
+    # Select the most likely checksum-valid ISBN number among every detection, or of every book
+    if multi_book:
+        return [book['isbn'] for book in extract_books(response['TextDetections'])], 'rekognition'
+    return extract_isbn(response['TextDetections']), 'rekognition'
+
+
+def _fail(result, err):
+    # Record the error of a record which could not be processed
+    if isinstance(err, ClientError):
         logger.error('CLIENT ERROR %s', err.response['Error']['Code'])
         err_message = f'Could not analyze image. {err.response['Error']['Message']}'
         logger.exception('MESSAGE %s', err_message)
-        
+        result['error'] = err_message
+    else:
+        logger.exception('UNEXPECTED ERROR OCCURED')
+        result['error'] = repr(err)
+    result['status'] = 'FAILED'
+    return result
+
+
+def _defer(result, reason):
+    # Leave a record for a later attempt, since it may succeed with more time or a reachable API
+    logger.warning('Deferring %s. %s', result['key'], reason)
+    result['status'] = 'DEFERRED'
+    result['error'] = str(reason)
+    return result
+
+
+def content_hash(record, image_bytes=None):
+    """
+    Get the key of the image of a record in the analysis cache, which is the ETag of the
+    S3 object or the MD5 hash of the image bytes. Both are equal for single-part uploads.
+
+    Returns:
+        str | None: The content hash, or None if the record has neither an ETag nor bytes.
+    """
+    etag = record['s3']['object'].get('eTag')
+    if etag:
+        return etag.strip('"')
+    if image_bytes is not None:
+        return hashlib.md5(image_bytes, usedforsecurity=False).hexdigest()
+    return None
+
+
+def analyze_record(record, rekognition, image_bytes=None):
+    """
+    Detect the ISBN number of the image of a single S3 event record. Images whose content
+    was already analyzed get the cached ISBN number without reading or analyzing the image.
+
+    Args:
+        record: S3 event notification record with bucket and object fields.
+        rekognition: Rekognition client shared by the records of the invocation.
+        image_bytes: Optional bytes of the image, for records which are not read from S3.
+
+    Returns:
+        dict[str,Any]: The partial result of the record, with the ISBN number and the path
+                       which served the image, or a status of FAILED along with the error
+                       message.
+    """
+    result = {
+        'bucket': record['s3']['bucket']['name'],
+        'key': record['s3']['object']['key']
+    }
+
+    analysis_cache = get_analysis_cache()
+    key = content_hash(record, image_bytes)
+    analysis = analysis_cache.get(key) if key is not None else None
+    if analysis is not None:
+        if MULTI_BOOK:
+            result['isbns'] = analysis.get('isbns', [analysis['isbn']])
+        else:
+            result['isbn'] = analysis['isbn']
+        result['source'] = 'dedup'
+        return result
+
+    # Rekognition is not called without time left to load its result
+    if get_deadline().expired():
+        return _defer(result, 'No time left to analyze the image')
+
+    detection_archive = get_detection_archive()
+    detections = []
+    try:
+        start = time.perf_counter()
+        isbn, result['source'] = analyze_image(
+            result['bucket'], result['key'], rekognition, image_bytes, MULTI_BOOK,
+            detections.extend if detection_archive is not None else None
+        )
+    except DeadlineExceeded as err:
+        return _defer(result, err)
     except Exception as err:
-        logger.exception('UNEXPECTED ERROR OCCURED')
\ No newline at end of file
+        return _fail(result, err)
+
+    # The numbers of every book are cached along with the first one, which serves the single-book mode
+    isbns = None
+    if MULTI_BOOK:
+        isbns, isbn = isbn, isbn[0] if isbn else None
+
+    # Detections are archived with the numbers parsed from them, which a replay compares against,
+    # and with the keys of the items of the image, which load_record adds to the entry
+    if result['source'] == 'rekognition' and detection_archive is not None:
+        result['archive_entry'] = detection_archive.add(
+            record, detections, isbns if isbns is not None else [isbn] if isbn else []
+        )
+
+    if isbn is not None and key is not None:
+        analysis = {
+            'isbn': isbn,
+            'source': result['source'],
+            'analysis_ms': round((time.perf_counter() - start) * 1000, 3)
+        }
+        if isbns is not None:
+            analysis['isbns'] = isbns
+        analysis_cache.put(key, analysis)
+
+    if isbn is None:
+        logger.warning('No valid ISBN number detected in %s', result['key'])
+        result['status'] = 'FAILED'
+        result['error'] = NO_ISBN_ERROR
+    elif isbns is not None:
+        result['isbns'] = isbns
+    else:
+        result['isbn'] = isbn
+    return result
+
+
+def event_timestamp(event_time, position=0, books=1):
+    # Sort key of the row of a book, suffixed with its position when the image has several books
+    return event_time if books == 1 else f'{event_time}#{position:02d}'
+
+
+def _event_item(book_data, timestamp):
+    # Build the item of an event from its book data and the timestamp of its sort key, as a new
+    # dict since the book data is shared by the records of the same number and the ISBN cache
+    item = {**book_data, 'timestamp': timestamp}
+
+    # Partition keys of the day index, and of the sparse index of books without matching results
+    item['day'] = timestamp[:10]
+    if item.get('exception') == 1:
+        item['exception_day'] = item['day']
+    return item
+
+
+def load_record(result, record, writer, book_data=None):
+    """
+    Structure the book data of an analyzed record and buffer it for the DynamoDB table.
+
+    Args:
+        result: Partial result of the record returned by analyze_record.
+        record: S3 event notification record with the eventTime field.
+        writer: Batch writer of the DynamoDB table where the structured data is stored.
+        book_data: Optional book data of the ISBN number looked up along with other records,
+                   which is otherwise looked up on its own.
+
+    Returns:
+        dict[str,Any]: The result of the record, with a status of SUCCESS along with the ISBN
+                       number, FAILED along with the error message, or DEFERRED if the book
+                       data could not be looked up in time.
+    """
+    # The archived entry of the image gets the keys of its items, which are stored under the ISBN
+    # number of the provider, so that a replay can delete them if the image is parsed differently
+    entry = result.pop('archive_entry', None)
+    result = _load_result(result, record, writer, book_data)
+    if entry is not None and result['status'] != 'DEFERRED':
+        items = [result['item']] if 'item' in result else result.get('items', [])
+        entry['keys'] = [{'isbn': item['isbn'], 'timestamp': item['timestamp']} for item in items]
+    return result
+
+
+def _load_result(result, record, writer, book_data=None):
+    if result.get('status') in ('FAILED', 'DEFERRED'):
+        return result
+    if 'isbns' in result:
+        return load_books(result, record, writer)
+
+    try:
+        # Build the JSON object with ISBN data along with timestamp information from the S3 event
+        if book_data is None:
+            book_data = structure_book_data(result['isbn'])
+        book_data = _event_item(book_data, record['eventTime'])
+
+        # Log the parsed data and load it into the DynamoDB table
+        logger.info('Parsed data: %s', book_data)
+        load_to_db(book_data, writer)
+
+        result['status'] = 'SUCCESS'
+        result['isbn'] = book_data['isbn']
+        result['item'] = book_data
+
+    except BooksUnavailableError as err:
+        _defer(result, err)
+    except Exception as err:
+        _fail(result, err)
+
+    return result
+
+
+def load_books(result, record, writer):
+    """
+    Look up the book data of every book of a multi-book record concurrently and buffer a
+    row per book for the DynamoDB table. Rows of the same event share its timestamp, which
+    is suffixed with the position of each book in the image so that their keys do not
+    collide, even for copies of the same book.
+
+    Args:
+        result: Partial result of the record returned by analyze_record, with the ISBN numbers.
+        record: S3 event notification record with the eventTime field.
+        writer: Batch writer of the DynamoDB table where the structured data is stored.
+
+    Returns:
+        dict[str,Any]: The result of the record, with a status of SUCCESS along with the ISBN
+                       numbers, FAILED along with the error message, or DEFERRED if the book
+                       data of any book could not be looked up in time.
+    """
+    isbns = result['isbns']
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(isbns))) as executor:
+        futures = [executor.submit(structure_book_data, isbn) for isbn in isbns]
+
+    # Rows are only buffered once every book was looked up, so that a retried record is written whole
+    try:
+        books_data = [future.result() for future in futures]
+    except BooksUnavailableError as err:
+        return _defer(result, err)
+    except Exception as err:
+        return _fail(result, err)
+
+    items = []
+    for position, book_data in enumerate(books_data):
+        items.append(_event_item(book_data, event_timestamp(record['eventTime'], position, len(books_data))))
+        load_to_db(items[-1], writer)
+
+    logger.info('Parsed %d books: %s', len(items), [item['isbn'] for item in items])
+    result['status'] = 'SUCCESS'
+    result['isbns'] = [item['isbn'] for item in items]
+    result['items'] = items
+    return result
+
+
+def process_record(record, rekognition, writer, image_bytes=None):
+    """
+    Run the Rekognition, Google Books and DynamoDB pipeline for a single S3 event record.
+
+    Args:
+        record: S3 event notification record with bucket, object and eventTime fields.
+        rekognition: Rekognition client shared by the records of the invocation.
+        writer: Batch writer of the DynamoDB table where the structured data is stored.
+        image_bytes: Optional bytes of the image, for records which are not read from S3.
+
+    Returns:
+        dict[str,Any]: The result of the record, with a status of SUCCESS along with the ISBN
+                       number, or FAILED along with the error message, and the path which
+                       served the image.
+    """
+    return load_record(analyze_record(record, rekognition, image_bytes), record, writer)
+
+
+def lookup_books(results):
+    """
+    Look up the book data of every ISBN number detected in the invocation with combined
+    Google Books queries, including the books of multi-book records, whose concurrent
+    lookups are then served by the ISBN cache. Failed lookups are left to the per-record path.
+
+    Args:
+        results: Partial results of the records returned by analyze_record.
+
+    Returns:
+        dict[str,dict[str,Any]]: Book data of each ISBN number which could be looked up.
+    """
+    isbns = sorted(
+        {result['isbn'] for result in results if 'isbn' in result}
+        | {isbn for result in results for isbn in result.get('isbns', [])}
+    )
+    if len(isbns) < 2:
+        return {}
+
+    try:
+        return structure_books_data(isbns)
+    except Exception:
+        logger.exception('Could not look up the ISBN numbers together')
+        return {}
+
+
+def close_writer(writer, results):
+    # Write the remaining objects and report the records whose objects could not be written
+    failed_items = {id(item) for item in writer.close()}
+    for result in results:
+        items = [result.pop('item', None), *result.pop('items', [])]
+        if any(id(item) in failed_items for item in items if item is not None):
+            result['status'] = 'FAILED'
+            result['error'] = f'Could not upload the object to DynamoDB table {writer.table_name}'
+
+
+def unwrap_records(event):
+    """
+    Get the S3 event records of an invocation, which are either sent directly by S3 or
+    wrapped in the messages of the SQS queue which receives the S3 notifications.
+
+    Args:
+        event: S3 event, or SQS event whose message bodies are S3 events.
+
+    Returns:
+        tuple[list[dict[str,Any]], list[str | None]]: The S3 event records along with the ID of
+                                                      the SQS message of each record, which is
+                                                      None for records sent directly by S3.
+    """
+    records = []
+    message_ids = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            records.append(record)
+            message_ids.append(None)
+            continue
+
+        try:
+            body = json.loads(record['body'])
+        except ValueError:
+            logger.warning('Discarding message %s without an S3 event', record['messageId'])
+            continue
+
+        # The test event sent by S3 when the notification is created has no records
+        for s3_record in body.get('Records', []):
+            records.append(s3_record)
+            message_ids.append(record['messageId'])
+
+    return records, message_ids
+
+
+def batch_item_failures(results, message_ids):
+    # Report the messages with retryable failures or deferred records, so that only those return to the queue
+    failed_ids = dict.fromkeys(
+        message_id for result, message_id in zip(results, message_ids)
+        if result['status'] != 'SUCCESS' and result['error'] != NO_ISBN_ERROR
+    )
+    return [{'itemIdentifier': message_id} for message_id in failed_ids]
+
+
+def report_invocation(results, start):
+    """
+    Log the outcome of the records of an invocation and emit the metrics of every stage.
+
+    Args:
+        results: Results of the records of the invocation.
+        start: Value of time.perf_counter() at the start of the invocation.
+
+    Returns:
+        int: The number of deferred records.
+    """
+    failed = sum(result['status'] == 'FAILED' for result in results)
+    deferred = sum(result['status'] == 'DEFERRED' for result in results)
+    logger.info(
+        'Processed %d records: %d succeeded, %d failed, %d deferred',
+        len(results), len(results) - failed - deferred, failed, deferred
+    )
+    logger.info('Image analysis paths: %s', Counter(result['source'] for result in results if 'source' in result))
+    cache_stats = get_isbn_cache().pop_stats()
+    logger.info('ISBN cache stats: %s', cache_stats)
+    dedup_stats = get_analysis_cache().pop_stats()
+    logger.info('Image dedup stats: %s', dedup_stats)
+
+    # Emit the metrics of every stage of the invocation as EMF log lines
+    metrics = get_metrics()
+    metrics.record('cache', **cache_stats)
+    metrics.record('dedup', **dedup_stats)
+    metrics.record(
+        'invocation',
+        duration_ms=round((time.perf_counter() - start) * 1000, 3),
+        records=len(results),
+        errors=failed,
+        deferred=deferred
+    )
+    metrics.flush()
+    return deferred
+
+
+def lambda_handler(event, context):
+    from_queue = any(record.get('eventSource') == 'aws:sqs' for record in event.get('Records', []))
+    records, message_ids = unwrap_records(event)
+    if not records:
+        return {'results': [], 'batchItemFailures': []} if from_queue else {'results': []}
+
+    start = time.perf_counter()
+
+    # Downstream calls share the remaining time of the invocation, minus a reserve to return
+    set_deadline(Deadline.from_context(context))
+
+    # Reuse the Rekognition client of the container, which is thread-safe, for every record
+    rekognition = get_client('rekognition')
+    writer = BatchWriter(os.getenv('TABLE_NAME'))
+
+    # Analyze the records concurrently in a bounded pool, keeping the order of the event, then
+    # look up their ISBN numbers together before structuring and buffering each record
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(records))) as executor:
+        results = list(executor.map(lambda record: analyze_record(record, rekognition), records))
+        books_data = lookup_books(results)
+        results = list(executor.map(
+            lambda result, record: load_record(result, record, writer, books_data.get(result.get('isbn'))),
+            results, records
+        ))
+
+    close_writer(writer, results)
+    flush_detections()
+    deferred = report_invocation(results, start)
+
+    if from_queue:
+        return {'results': results, 'batchItemFailures': batch_item_failures(results, message_ids)}
+    if deferred:
+        raise DeferredRecordsError(f'{deferred} of {len(results)} records were deferred')
+    return {'results': results}
+
+
+def _lookup_response(status_code, body, headers=None):
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json', **(headers or {})},
+        'body': json.dumps(body)
+    }
+
+
+def lookup_handler(event, context):
+    """
+    Analyze the image sent in the body of an API Gateway proxy request and return its book
+    data in the response, skipping the S3 upload and event delay. The event is still loaded
+    to the DynamoDB table.
+
+    Args:
+        event: API Gateway proxy event, whose binary body is encoded as base64.
+        context: Lambda context of the invocation.
+
+    Returns:
+        dict[str,Any]: The proxy response with the structured book data (200), or the error of
+                       an empty or oversized image (400, 413), an image without a valid ISBN
+                       number (422), a deferred lookup (503) or a failed analysis (502).
+    """
+    start = time.perf_counter()
+    set_deadline(Deadline.from_context(context))
+
+    body = event.get('body') or ''
+    image_bytes = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode()
+    if not image_bytes:
+        return _lookup_response(400, {'message': 'The request body must contain a JPEG or PNG image'})
+    if len(image_bytes) > MAX_IMAGE_BYTES and not PREPROCESS_IMAGES:
+        return _lookup_response(413, {'message': f'Images sent as bytes cannot exceed {MAX_IMAGE_BYTES} bytes'})
+
+    # The request time is stored with the same format as the eventTime field of S3 notifications
+    request_context = event.get('requestContext') or {}
+    request_epoch_ms = request_context.get('requestTimeEpoch', time.time() * 1000)
+    request_time = datetime.fromtimestamp(request_epoch_ms / 1000, timezone.utc)
+    record = {
+        's3': {'bucket': {'name': None}, 'object': {'key': request_context.get('requestId', 'lookup')}},
+        'eventTime': request_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    }
+
+    writer = BatchWriter(os.getenv('TABLE_NAME'))
+    result = process_record(record, get_client('rekognition'), writer, image_bytes)
+    # Multi-book images return the book data of every book
+    item = result.get('item') or {'books': result.get('items', [])}
+    close_writer(writer, [result])
+    flush_detections()
+    report_invocation([result], start)
+
+    if result['status'] == 'SUCCESS':
+        return _lookup_response(200, item)
+    if result['status'] == 'DEFERRED':
+        return _lookup_response(503, {'message': result['error']}, {'Retry-After': '1'})
+    if result['error'] == NO_ISBN_ERROR:
+        return _lookup_response(422, {'message': result['error']})
+    return _lookup_response(502, {'message': result['error']})
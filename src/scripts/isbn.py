@@ -0,0 +1,221 @@
+import re
+
+from typing import Any
+
+# Labels printed before ISBN numbers, which are removed so that '13' is not read as digits
+ISBN_LABEL = re.compile(r'ISBN(?:[\s\-]*1[03])?[\s:]*', re.IGNORECASE)
+
+# Groups of digits, where the last group of an ISBN-10 can end with an X check digit
+DIGIT_GROUP = re.compile(r'\d+[Xx]?|(?<![A-Za-z])[Xx](?![A-Za-z])')
+
+# Single characters allowed between the groups of a printed ISBN number
+SEPARATORS = {' ', '-', '‐', '–', '.'}
+
+BOOKLAND_PREFIXES = ('978', '979')
+
+# Gap, in heights of the tallest text, below which two ISBN readings are printed on the same book
+BOOK_MARGIN = 5.0
+
+def is_valid_isbn10(isbn: str) -> bool:
+    if len(isbn) != 10 or not isbn[:9].isdigit() or not (isbn[9].isdigit() or isbn[9] in 'Xx'):
+        return False
+    digits = [int(char) for char in isbn[:9]] + [10 if isbn[9] in 'Xx' else int(isbn[9])]
+    return sum((10 - index) * digit for index, digit in enumerate(digits)) % 11 == 0
+
+
+def is_valid_isbn13(isbn: str) -> bool:
+    if len(isbn) != 13 or not isbn.isdigit() or not isbn.startswith(BOOKLAND_PREFIXES):
+        return False
+    return sum((3 if index % 2 else 1) * int(digit) for index, digit in enumerate(isbn)) % 10 == 0
+
+
+def isbn10_to_isbn13(isbn: str) -> str:
+    """
+    Convert a valid ISBN-10 number into its ISBN-13 form with the 978 prefix.
+    """
+    body = '978' + isbn[:9]
+    check_digit = (10 - sum((3 if index % 2 else 1) * int(digit) for index, digit in enumerate(body)) % 10) % 10
+    return body + str(check_digit)
+
+
+def normalize_isbn(value: str) -> str | None:
+    """
+    Validate the checksum of an ISBN-10 or ISBN-13 number, ignoring labels and separators.
+
+    Args:
+        value: String which contains the ISBN number (e.g., ISBN 978-987-629-899-5).
+
+    Returns:
+        str | None: The ISBN-13 form of the number, or None if the checksum is not valid.
+    """
+    compact = ''.join(DIGIT_GROUP.findall(ISBN_LABEL.sub(' ', value))).upper()
+    if is_valid_isbn13(compact):
+        return compact
+    if is_valid_isbn10(compact):
+        return isbn10_to_isbn13(compact)
+    return None
+
+
+def _digit_runs(text: str) -> list[list[str]]:
+    # Split the text into runs of digit groups joined by a single separator character
+    runs = []
+    previous_end = None
+    for match in DIGIT_GROUP.finditer(text):
+        joined = previous_end is not None and match.start() - previous_end == 1 \
+                 and text[previous_end] in SEPARATORS and not runs[-1][-1][-1] in 'Xx'
+        if joined:
+            runs[-1].append(match.group())
+        else:
+            runs.append([match.group()])
+        previous_end = match.end()
+    return runs
+
+
+def find_isbns(text: str) -> list[str]:
+    """
+    Find every checksum-valid ISBN number in a text, normalized to ISBN-13.
+    """
+    isbns = []
+    for run in _digit_runs(ISBN_LABEL.sub('  ', text)):
+        # Consecutive groups of each run are joined until they reach the length of an ISBN-13
+        for start in range(len(run)):
+            compact = ''
+            for group in run[start:]:
+                compact += group
+                if len(compact) > 13:
+                    break
+                if len(compact) in (10, 13):
+                    isbn = normalize_isbn(compact)
+                    if isbn is not None and isbn not in isbns:
+                        isbns.append(isbn)
+    return isbns
+
+
+def _score(candidate: dict[str,Any]) -> float:
+    # Confidence prevails, followed by explicit labels, repeated readings and taller text
+    return candidate['confidence'] / 100 \
+           + 0.2 * candidate['labeled'] \
+           + 0.05 * min(candidate['occurrences'] - 1, 4) \
+           + min(candidate['height'], 0.2)
+
+
+def extract_candidates(detections: list[dict[str,Any]]) -> list[dict[str,Any]]:
+    """
+    Extract the checksum-valid ISBN candidates from every LINE and WORD detection
+    of a Rekognition DetectText response.
+
+    Args:
+        detections: List of TextDetections returned by Rekognition.
+
+    Returns:
+        list[dict[str,Any]]: The candidates ranked from the most to the least likely, with the
+                             ISBN-13 number, the highest confidence and bounding box of its
+                             detections, the number of detections where it was found, and
+                             whether it was labeled with 'ISBN'.
+    """
+    candidates = {}
+    for detection in detections:
+        if detection.get('Type', 'LINE') not in ('LINE', 'WORD'):
+            continue
+
+        text = detection.get('DetectedText', '')
+        labeled = ISBN_LABEL.search(text) is not None
+        confidence = detection.get('Confidence', 0.0)
+        box = detection.get('Geometry', {}).get('BoundingBox', {})
+
+        for isbn in find_isbns(text):
+            candidate = candidates.get(isbn)
+            if candidate is None:
+                candidates[isbn] = {
+                    'isbn': isbn,
+                    'confidence': confidence,
+                    'labeled': labeled,
+                    'occurrences': 1,
+                    'height': box.get('Height', 0.0),
+                    'box': box
+                }
+                continue
+            candidate['occurrences'] += 1
+            candidate['labeled'] = candidate['labeled'] or labeled
+            if confidence > candidate['confidence']:
+                candidate['confidence'] = confidence
+                candidate['box'] = box
+            candidate['height'] = max(candidate['height'], box.get('Height', 0.0))
+
+    return sorted(candidates.values(), key=_score, reverse=True)
+
+
+def extract_isbn(detections: list[dict[str,Any]]) -> str | None:
+    """
+    Get the most likely checksum-valid ISBN-13 number of a list of Rekognition
+    TextDetections, or None if there are no valid candidates.
+    """
+    candidates = extract_candidates(detections)
+    return candidates[0]['isbn'] if candidates else None
+
+
+def extract_isbn_batch(responses: list[dict[str,Any]]) -> list[str | None]:
+    """
+    Get the most likely ISBN-13 number of each Rekognition DetectText response.
+
+    Args:
+        responses: List of DetectText responses with their TextDetections.
+
+    Returns:
+        list[str | None]: The ISBN-13 numbers in the order of the responses, with None
+                          for responses without valid candidates.
+    """
+    return [extract_isbn(response.get('TextDetections', [])) for response in responses]
+
+
+def _near(first: dict[str,float], second: dict[str,float], margin: float) -> bool:
+    # Boxes are expanded on every side by the margin, relative to the height of their tallest text
+    gap = margin * max(first.get('Height', 0.0), second.get('Height', 0.0))
+    return first.get('Left', 0.0) - gap <= second.get('Left', 0.0) + second.get('Width', 0.0) \
+           and second.get('Left', 0.0) - gap <= first.get('Left', 0.0) + first.get('Width', 0.0) \
+           and first.get('Top', 0.0) - gap <= second.get('Top', 0.0) + second.get('Height', 0.0) \
+           and second.get('Top', 0.0) - gap <= first.get('Top', 0.0) + first.get('Height', 0.0)
+
+
+def extract_books(detections: list[dict[str,Any]], margin: float = BOOK_MARGIN) -> list[dict[str,Any]]:
+    """
+    Extract the ISBN number of each book of a photo with several books. The LINE and WORD
+    detections with ISBN numbers are grouped by the geometry of their bounding boxes, so
+    that the readings of a book (e.g., the labeled number and the digits below its barcode)
+    end up together, and the most likely candidate of each group is kept. The same number
+    is extracted once per group, so that copies of a book are counted separately.
+
+    Args:
+        detections: List of TextDetections returned by Rekognition.
+        margin: Gap between the readings of the same book, in heights of their tallest text.
+
+    Returns:
+        list[dict[str,Any]]: The best candidate of each book, in the same format as the ones of
+                             extract_candidates, ordered from top to bottom and left to right.
+    """
+    readings = [
+        detection for detection in detections
+        if detection.get('Type', 'LINE') in ('LINE', 'WORD') and find_isbns(detection.get('DetectedText', ''))
+    ]
+    boxes = [detection.get('Geometry', {}).get('BoundingBox', {}) for detection in readings]
+
+    # Union-find over the pairs of readings whose boxes are near each other
+    parents = list(range(len(readings)))
+
+    def root(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for first in range(len(readings)):
+        for second in range(first + 1, len(readings)):
+            if _near(boxes[first], boxes[second], margin):
+                parents[root(first)] = root(second)
+
+    groups = {}
+    for index, detection in enumerate(readings):
+        groups.setdefault(root(index), []).append(detection)
+
+    books = [extract_candidates(group)[0] for group in groups.values()]
+    return sorted(books, key=lambda book: (book['box'].get('Top', 0.0), book['box'].get('Left', 0.0)))
@@ -0,0 +1,191 @@
+import os
+import json
+import math
+import time
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ISBNProcessor')
+EMIT_METRICS = os.getenv('EMIT_METRICS', 'true').lower() == 'true'
+
+# Stage records kept after being emitted, so that tests and benchmarks can read them
+HISTORY_SIZE = int(os.getenv('METRICS_HISTORY_SIZE', '10000'))
+
+# CloudWatch metric name and unit of each recorded value
+METRIC_UNITS = {
+    'duration_ms': ('Duration', 'Milliseconds'),
+    'retries': ('Retries', 'Count'),
+    'errors': ('Errors', 'Count'),
+    'deferred': ('Deferred', 'Count'),
+    'bytes': ('PayloadBytes', 'Bytes'),
+    'items': ('Items', 'Count'),
+    'records': ('Records', 'Count'),
+    'memory_hits': ('MemoryCacheHits', 'Count'),
+    'table_hits': ('TableCacheHits', 'Count'),
+    'misses': ('CacheMisses', 'Count'),
+    'hits': ('DedupHits', 'Count'),
+    'rekognition_calls_saved': ('RekognitionCallsSaved', 'Count'),
+    'saved_ms': ('SavedTime', 'Milliseconds'),
+    'catalog_hits': ('CatalogHits', 'Count'),
+    'hedged': ('HedgedRequests', 'Count')
+}
+
+# Maximum number of values of a metric within a single EMF document
+MAX_VALUES = 100
+
+_lock = threading.Lock()
+_metrics = None
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """
+    Get the q-th percentile of a list of values with the nearest-rank method, as CloudWatch does.
+
+    Args:
+        values: Values of the metric.
+        q: Percentile between 0 and 100.
+
+    Returns:
+        float | None: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+class MetricsCollector:
+    """
+    Thread-safe collector of the duration, retries, errors and payload sizes of each stage
+    of the pipeline, which are emitted as CloudWatch Embedded Metric Format (EMF) log lines
+    so that CloudWatch builds the metrics without any API call.
+    """
+    def __init__(self, namespace: str = NAMESPACE, emit: bool = EMIT_METRICS, history_size: int = HISTORY_SIZE):
+        self.namespace = namespace
+        self.emit = emit
+        self.history = deque(maxlen=history_size)
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **values: float) -> Iterator[dict[str,float]]:
+        """
+        Measure the duration of a stage, recording an error if it raises an exception.
+
+        Args:
+            name: Name of the stage (e.g., rekognition).
+            values: Initial values of the stage, which can also be set on the yielded dict.
+
+        Yields:
+            dict[str,float]: The values recorded along with the duration of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield values
+        except Exception:
+            values['errors'] = values.get('errors', 0) + 1
+            raise
+        finally:
+            self.record(name, duration_ms=round((time.perf_counter() - start) * 1000, 3), **values)
+
+    def record(self, name: str, **values: float) -> None:
+        with self._lock:
+            self._pending.append({'stage': name, **values})
+
+    def flush(self) -> list[dict[str,Any]]:
+        """
+        Emit the pending records as one EMF log line per stage and move them to the history.
+
+        Returns:
+            list[dict[str,Any]]: The records which were emitted.
+        """
+        with self._lock:
+            records, self._pending = self._pending, []
+            self.history.extend(records)
+
+        if self.emit:
+            for document in self.documents(records):
+                print(json.dumps(document), flush=True)
+        return records
+
+    def documents(self, records: list[dict[str,Any]]) -> list[dict[str,Any]]:
+        """
+        Build the EMF documents of some records, grouping the values of each stage into arrays.
+        """
+        stages = {}
+        for record in records:
+            values = stages.setdefault(record['stage'], {})
+            for key, value in record.items():
+                if key in METRIC_UNITS:
+                    values.setdefault(key, []).append(value)
+
+        documents = []
+        timestamp = int(time.time() * 1000)
+        for stage, values in stages.items():
+            longest = max((len(metric_values) for metric_values in values.values()), default=0)
+            for index in range(0, longest, MAX_VALUES):
+                chunk = {key: metric_values[index:index + MAX_VALUES] for key, metric_values in values.items()}
+                chunk = {key: metric_values for key, metric_values in chunk.items() if metric_values}
+                document = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [['Stage']],
+                            'Metrics': [
+                                {'Name': METRIC_UNITS[key][0], 'Unit': METRIC_UNITS[key][1]} for key in chunk
+                            ]
+                        }]
+                    },
+                    'Stage': stage
+                }
+                document.update({METRIC_UNITS[key][0]: metric_values for key, metric_values in chunk.items()})
+                documents.append(document)
+        return documents
+
+    def records(self, stage: str | None = None) -> list[dict[str,Any]]:
+        """
+        Get the emitted and pending records, optionally only those of a stage.
+        """
+        with self._lock:
+            records = list(self.history) + self._pending
+        return [record for record in records if stage is None or record['stage'] == stage]
+
+    def summary(self) -> dict[str,dict[str,float]]:
+        """
+        Get the count and the p50, p95 and p99 durations of each stage in the records.
+        """
+        durations = {}
+        for record in self.records():
+            if 'duration_ms' in record:
+                durations.setdefault(record['stage'], []).append(record['duration_ms'])
+
+        return {
+            stage: {
+                'count': len(values),
+                'p50_ms': percentile(values, 50),
+                'p95_ms': percentile(values, 95),
+                'p99_ms': percentile(values, 99)
+            }
+            for stage, values in durations.items()
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending.clear()
+            self.history.clear()
+
+
+def get_metrics() -> MetricsCollector:
+    """
+    Get the metrics collector of the container, which is created once and shared by every module.
+    """
+    global _metrics
+    if _metrics is None:
+        with _lock:
+            if _metrics is None:
+                _metrics = MetricsCollector()
+    return _metrics
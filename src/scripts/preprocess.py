@@ -0,0 +1,91 @@
+import io
+import os
+import importlib.util
+
+from typing import Any
+
+# Pillow is not part of the Lambda runtime, so it is provided by a layer, and it is only
+# imported on the first preprocessed image to keep it out of the cold start of the filters
+AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+MAX_IMAGE_SIDE = int(os.getenv('MAX_IMAGE_SIDE', '1600'))
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', '85'))
+
+# Optional Rekognition filters, where an empty value disables the filter
+MIN_CONFIDENCE = os.getenv('MIN_CONFIDENCE', '')
+MIN_BOUNDING_BOX_HEIGHT = os.getenv('MIN_BOUNDING_BOX_HEIGHT', '')
+REGIONS_OF_INTEREST = os.getenv('REGIONS_OF_INTEREST', '')
+
+def parse_regions(value: str) -> list[dict[str,Any]]:
+    """
+    Parse regions of interest with the format 'left,top,width,height;...', where every
+    value is a ratio of the image dimensions between 0 and 1.
+
+    Raises:
+        ValueError: If a region does not have four ratios between 0 and 1.
+    """
+    regions = []
+    for region in filter(None, (region.strip() for region in value.split(';'))):
+        ratios = [float(ratio) for ratio in region.split(',')]
+        if len(ratios) != 4 or not all(0 <= ratio <= 1 for ratio in ratios):
+            raise ValueError('Invalid region of interest', region)
+        left, top, width, height = ratios
+        regions.append({'BoundingBox': {'Left': left, 'Top': top, 'Width': width, 'Height': height}})
+    return regions
+
+
+def build_filters() -> dict[str,Any]:
+    """
+    Build the Filters parameter of Rekognition DetectText from the environment variables.
+
+    Returns:
+        dict[str,Any]: The WordFilter and RegionsOfInterest filters, empty if none is configured.
+    """
+    filters = {}
+
+    word_filter = {}
+    if MIN_CONFIDENCE:
+        word_filter['MinConfidence'] = float(MIN_CONFIDENCE)
+    if MIN_BOUNDING_BOX_HEIGHT:
+        word_filter['MinBoundingBoxHeight'] = float(MIN_BOUNDING_BOX_HEIGHT)
+    if word_filter:
+        filters['WordFilter'] = word_filter
+
+    regions = parse_regions(REGIONS_OF_INTEREST)
+    if regions:
+        filters['RegionsOfInterest'] = regions
+
+    return filters
+
+
+def downscale_image(image_bytes: bytes, max_side: int = MAX_IMAGE_SIDE, quality: int = JPEG_QUALITY) -> bytes:
+    """
+    Downscale an image so that its longest side is at most max_side pixels and re-encode
+    it as JPEG, reducing the payload sent to Rekognition.
+
+    Args:
+        image_bytes: Bytes of the JPEG or PNG image.
+        max_side: Maximum number of pixels of the longest side.
+        quality: JPEG quality of the re-encoded image.
+
+    Returns:
+        bytes: The re-encoded image, or the original bytes if Pillow is not available or the
+               re-encoded image would not be smaller.
+    """
+    if not AVAILABLE:
+        return image_bytes
+
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        if max(image.size) <= max_side and image.format == 'JPEG':
+            return image_bytes
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail((max_side, max_side))
+
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality)
+
+    downscaled = output.getvalue()
+    return downscaled if len(downscaled) < len(image_bytes) else image_bytes
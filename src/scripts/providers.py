@@ -0,0 +1,336 @@
+import os
+import re
+import json
+import time
+import threading
+import urllib.error
+import urllib.parse
+
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any
+
+from budget import call_with_budget, get_breaker, DeadlineExceeded, CircuitOpenError
+from clients import get_open_library_session, KeepAliveSession
+from isbn import normalize_isbn
+from metrics import get_metrics, percentile
+
+# Percentile of the latencies of the primary provider after which the secondary one is asked
+# as well, and the delay used instead until enough latencies of the primary were measured
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_DELAY_MS = float(os.getenv('HEDGE_DELAY_MS', '500'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+
+# Latencies kept by each provider, so that the threshold follows its recent behavior
+LATENCY_WINDOW = int(os.getenv('PROVIDER_LATENCY_WINDOW', '200'))
+
+# Lookups running at the same time across the providers, shared by the threads of a container
+PROVIDER_WORKERS = int(os.getenv('PROVIDER_WORKERS', '16'))
+
+# Hedges in flight across the threads of a container, beyond which slow lookups are waited for
+# instead of hedged, so that a burst does not fill the pool of the providers with hedges
+MAX_HEDGES = int(os.getenv('MAX_HEDGES', str(PROVIDER_WORKERS // 2)))
+
+OPEN_LIBRARY_TIMEOUT = float(os.getenv('OPEN_LIBRARY_TIMEOUT', '3'))
+OPEN_LIBRARY_MAX_ATTEMPTS = int(os.getenv('OPEN_LIBRARY_MAX_ATTEMPTS', '2'))
+
+# Subjects of Open Library editions are free-form and numerous, so only the first ones are kept as categories
+MAX_CATEGORIES = 3
+
+_lock = threading.Lock()
+_executor = None
+_hedges = 0
+
+
+class BooksUnavailableError(Exception):
+    """
+    Raised when the book metadata providers could not be reached or answered with an error,
+    so that the lookup can be retried later instead of being structured as a missing book.
+    """
+
+
+class IncompleteBookError(ValueError):
+    """
+    Raised when a provider has a match for an ISBN number which lacks fields of the book data,
+    so that the number is neither structured nor cached as a book without matching results.
+    """
+
+
+def retryable(err: Exception) -> bool:
+    """
+    Tell whether an HTTP error of a provider is transient, which is the case of throttled
+    requests, server errors and failed connections.
+    """
+    if isinstance(err, urllib.error.HTTPError):
+        return err.code == 429 or err.code >= 500
+    return isinstance(err, urllib.error.URLError)
+
+
+class BookProvider(ABC):
+    """
+    Source of book metadata whose answers are normalized into the format of structure_book_data,
+    keeping the latencies of its recent lookups to decide when a lookup is hedged.
+    """
+    name = 'provider'
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._latencies_lock = threading.Lock()
+
+    @abstractmethod
+    def lookup(self, isbn: str) -> dict[str,Any] | None:
+        """
+        Look up the book data of an ISBN number.
+
+        Returns:
+            dict[str,Any] | None: The structured book data, or None if the provider has no match.
+
+        Raises:
+            BooksUnavailableError: If the provider could not be reached or answered with an error.
+            IncompleteBookError: If the match of the provider is missing fields of the book data.
+        """
+
+    def lookup_many(self, isbns: list[str]) -> dict[str,dict[str,Any] | None]:
+        """
+        Look up the book data of several ISBN numbers, one at a time unless the provider
+        supports combined queries.
+
+        Returns:
+            dict[str,dict[str,Any] | None]: The book data of each answered number, or None if
+                                            the provider has no match. Numbers whose lookup
+                                            failed or whose match is incomplete are not included.
+        """
+        books_data = {}
+        for isbn in isbns:
+            try:
+                books_data[isbn] = self.lookup(isbn)
+            except (BooksUnavailableError, IncompleteBookError):
+                continue
+        return books_data
+
+    def timed_lookup(self, isbn: str) -> dict[str,Any] | None:
+        # Only answered lookups are measured, since failures are bounded by the timeouts instead
+        start = time.perf_counter()
+        book_data = self.lookup(isbn)
+        with self._latencies_lock:
+            self._latencies.append((time.perf_counter() - start) * 1000)
+        return book_data
+
+    def latency_percentile(self, q: float) -> float | None:
+        """
+        Get the q-th percentile of the latencies of the recent lookups, in milliseconds.
+        """
+        with self._latencies_lock:
+            latencies = list(self._latencies)
+        return percentile(latencies, q)
+
+    def hedge_delay(self) -> float:
+        """
+        Get the time to wait for an answer before asking the next provider, in seconds.
+        """
+        with self._latencies_lock:
+            samples = len(self._latencies)
+        if samples < HEDGE_MIN_SAMPLES:
+            return HEDGE_DELAY_MS / 1000
+        return self.latency_percentile(HEDGE_PERCENTILE) / 1000
+
+
+class OpenLibraryProvider(BookProvider):
+    """
+    Open Library Books API, which answers several ISBN numbers with a single request.
+    """
+    name = 'openlibrary'
+
+    def __init__(self, session: KeepAliveSession | None = None, window: int = LATENCY_WINDOW):
+        super().__init__(window)
+        self.session = session
+
+    def _get(self, path: str, timeout: float) -> bytes:
+        with get_metrics().stage(self.name) as values:
+            body = (self.session or get_open_library_session()).get(path, timeout=timeout)
+            values['bytes'] = len(body)
+        return body
+
+    def _editions(self, isbns: list[str]) -> dict[str,Any] | None:
+        # Editions of the numbers by bibkey, or None if Open Library could not be reached
+        bibkeys = urllib.parse.quote(','.join(f'ISBN:{isbn}' for isbn in isbns), safe=',:')
+        path = f'/api/books?bibkeys={bibkeys}&format=json&jscmd=data'
+        try:
+            body = call_with_budget(
+                lambda timeout: self._get(path, timeout), retryable, OPEN_LIBRARY_TIMEOUT,
+                max_attempts=OPEN_LIBRARY_MAX_ATTEMPTS, breaker=get_breaker(self.name)
+            )
+            return json.loads(body.decode())
+        except (urllib.error.URLError, DeadlineExceeded, CircuitOpenError, ValueError):
+            return None
+
+    def lookup(self, isbn: str) -> dict[str,Any] | None:
+        response = self._editions([isbn])
+        if response is None:
+            raise BooksUnavailableError(f'Could not look up ISBN {isbn} in Open Library.')
+        edition = response.get(f'ISBN:{isbn}')
+        book_data = format_open_library(isbn, edition)
+        if book_data is None and edition:
+            raise IncompleteBookError(f'Incomplete edition of ISBN {isbn} in Open Library.')
+        return book_data
+
+    def lookup_many(self, isbns: list[str]) -> dict[str,dict[str,Any] | None]:
+        response = self._editions(isbns)
+        if response is None:
+            return {}
+
+        # Incomplete editions are left out like failed lookups, since they are not a missing book
+        books_data = {}
+        for isbn in isbns:
+            edition = response.get(f'ISBN:{isbn}')
+            book_data = format_open_library(isbn, edition)
+            if book_data is not None or not edition:
+                books_data[isbn] = book_data
+        return books_data
+
+
+def format_open_library(isbn: str, edition: dict[str,Any] | None) -> dict[str,Any] | None:
+    """
+    Normalize an edition of the Open Library Books API (jscmd=data) into the format of
+    structure_book_data.
+
+    Args:
+        isbn: ISBN number of the request.
+        edition: Edition returned for the number, if any.
+
+    Returns:
+        dict[str,Any] | None: The structured book data, or None if the edition is missing its
+                              title, authors, page count or year of publication.
+    """
+    if not edition:
+        return None
+    year = re.search(r'\d{4}', edition.get('publish_date', ''))
+    authors = [author['name'] for author in edition.get('authors', []) if author.get('name')]
+    if not edition.get('title') or not authors or year is None or 'number_of_pages' not in edition:
+        return None
+
+    title = f'{edition['title']}: {edition['subtitle']}' if edition.get('subtitle') else edition['title']
+    publishers = edition.get('publishers', [])
+    isbn_13 = edition.get('identifiers', {}).get('isbn_13', [])
+    return {
+        'isbn': isbn_13[0] if isbn_13 else normalize_isbn(isbn) or isbn,
+        'authors': authors,
+        'title': title,
+        'categories': [subject['name'] for subject in edition.get('subjects', [])[:MAX_CATEGORIES]],
+        'page_count': edition['number_of_pages'],
+        'language': 'N/A', # Languages are not part of the data of editions
+        'publisher': publishers[0]['name'] if publishers else 'N/A',
+        'year': int(year.group()),
+        'exception': 0
+    }
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PROVIDER_WORKERS, thread_name_prefix='provider')
+    return _executor
+
+
+def _acquire_hedge() -> bool:
+    global _hedges
+    with _lock:
+        if _hedges >= MAX_HEDGES:
+            return False
+        _hedges += 1
+        return True
+
+
+def _release_hedge(future) -> None:
+    global _hedges
+    with _lock:
+        _hedges -= 1
+
+
+def hedged_lookup(isbn: str, providers: list[BookProvider]) -> dict[str,Any] | None:
+    """
+    Look up an ISBN number with the first provider, asking the next one as well once the
+    lookup takes longer than the hedge delay of the provider, or right away if it fails or
+    has no match, and take the first complete answer. Slower lookups which already started
+    keep running in the background, so that their latencies are still measured, while queued
+    ones are cancelled. Lookups are not hedged while MAX_HEDGES hedges are in flight.
+
+    Args:
+        isbn: ISBN-10 or ISBN-13 number without non-numerical characters.
+        providers: Providers in order of preference.
+
+    Returns:
+        dict[str,Any] | None: The structured book data of the first complete answer, or None
+                              if every provider answered without a match.
+
+    Raises:
+        BooksUnavailableError: If a provider could not be reached and none of the others had a
+                               match, since the missing provider might have had one.
+        IncompleteBookError: If every provider answered, and some only with incomplete matches.
+    """
+    if len(providers) == 1:
+        return providers[0].timed_lookup(isbn)
+
+    executor = _get_executor()
+    remaining = list(providers)
+    pending = {}
+    error = None
+    incomplete = None
+    hedged = 0
+    start = time.perf_counter()
+
+    def ask_next(hedge=False):
+        provider = remaining.pop(0)
+        future = executor.submit(provider.timed_lookup, isbn)
+        if hedge:
+            future.add_done_callback(_release_hedge)
+        pending[future] = provider
+        return provider
+
+    latest = ask_next()
+    hedging = True
+    try:
+        while pending:
+            timeout = latest.hedge_delay() if remaining and hedging else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Without room for another hedge, the pending lookups are waited for
+                hedging = _acquire_hedge()
+                if hedging:
+                    latest = ask_next(hedge=True)
+                    hedged += 1
+                continue
+
+            for future in done:
+                pending.pop(future)
+                try:
+                    book_data = future.result()
+                except BooksUnavailableError as err:
+                    error = err
+                    continue
+                except IncompleteBookError as err:
+                    incomplete = err
+                    continue
+                if book_data is not None:
+                    return book_data
+
+            # A failed lookup or a missing match is not hedged but passed on to the next provider
+            if not pending and remaining:
+                latest = ask_next()
+                hedging = True
+    finally:
+        # Lookups which lost the race and did not start yet are cancelled, releasing their hedges
+        for future in pending:
+            future.cancel()
+        get_metrics().record(
+            'lookup', duration_ms=round((time.perf_counter() - start) * 1000, 3), hedged=hedged
+        )
+
+    if error is not None:
+        raise error
+    if incomplete is not None:
+        raise incomplete
+    return None
@@ -1,9 +1,39 @@
-import urllib.request
+import os
 import urllib.error
+import urllib.parse
 import json
+import threading
 
 from typing import Any
 
+from budget import call_with_budget, get_breaker, DeadlineExceeded, CircuitOpenError
+from cache import get_isbn_cache
+from catalog import get_catalog
+from clients import get_books_session
+from isbn import normalize_isbn
+from metrics import get_metrics
+from providers import BookProvider, OpenLibraryProvider, BooksUnavailableError, IncompleteBookError, hedged_lookup, retryable
+
+# ISBN numbers combined with OR in a single query, whose volumes fit in a page of 40 results
+BATCH_QUERY_SIZE = 10
+MAX_RESULTS = 40
+
+# Socket timeout and attempts of each Google Books request, within the budget of the invocation
+BOOKS_TIMEOUT = float(os.getenv('BOOKS_TIMEOUT', '3'))
+BOOKS_MAX_ATTEMPTS = int(os.getenv('BOOKS_MAX_ATTEMPTS', '3'))
+
+# Partial response with the fields used to structure book data
+VOLUME_FIELDS = 'totalItems,items(volumeInfo(title,subtitle,authors,publisher,publishedDate,' \
+                'industryIdentifiers,pageCount,categories,language))'
+
+# Providers of book metadata in order of preference, where the following ones are asked
+# when the first one is slow, fails or has no match (e.g., google,openlibrary)
+BOOK_PROVIDERS = [name.strip() for name in os.getenv('BOOK_PROVIDERS', 'google').split(',') if name.strip()]
+
+_lock = threading.Lock()
+_providers = None
+
+
 def fetch_book_data(isbn: str) -> dict[str,Any]:
     """
     Make a GET request to the 'volumes' endpoint of the Google Books API
@@ -15,11 +45,42 @@ def fetch_book_data(isbn: str) -> dict[str,Any]:
     Returns:
         dict[str,Any]: The parsed JSON object returned from the API.
     """
+    PATH = '/books/v1/volumes?q=isbn'
+    return _get_volumes(PATH + ':' + isbn)
+
+
+def fetch_books_data(isbns: list[str]) -> dict[str,Any]:
+    """
+    Make a single GET request to the 'volumes' endpoint of the Google Books API which
+    combines several ISBN numbers with OR, asking for a partial response with the fields
+    used to structure book data.
+
+    Args:
+        isbns: List of ISBN-10 or ISBN-13 numbers without non-numerical characters.
+
+    Returns:
+        dict[str,Any]: The parsed JSON object returned from the API, with the volumes of every ISBN.
+    """
+    query = urllib.parse.quote(' OR '.join(f'isbn:{isbn}' for isbn in isbns))
+    fields = urllib.parse.quote(VOLUME_FIELDS, safe=',()')
+    return _get_volumes(f'/books/v1/volumes?q={query}&maxResults={MAX_RESULTS}&fields={fields}')
+
+
+def _get(path: str, timeout: float) -> bytes:
+    # Reuse the keep-alive connection of the container instead of a new one per lookup
+    with get_metrics().stage('books') as values:
+        body = get_books_session().get(path, timeout=timeout)
+        values['bytes'] = len(body)
+    return body
+
+
+def _get_volumes(path: str) -> dict[str,Any]:
     try:
-        URL = 'https://www.googleapis.com/books/v1/volumes?q=isbn'
-        
-        with urllib.request.urlopen(URL + ':' + isbn) as req:
-            response = json.loads(req.read().decode())
+        body = call_with_budget(
+            lambda timeout: _get(path, timeout), retryable, BOOKS_TIMEOUT,
+            max_attempts=BOOKS_MAX_ATTEMPTS, breaker=get_breaker('books')
+        )
+        response = json.loads(body.decode())
         response['code'] = 200
         return response
     except urllib.error.HTTPError as err:
@@ -31,12 +92,35 @@ def fetch_book_data(isbn: str) -> dict[str,Any]:
         return {
             'reason': err.reason
         }
+    except (DeadlineExceeded, CircuitOpenError) as err:
+        return {
+            'reason': str(err)
+        }
+
+
+def _catalog_books(isbns: list[str]) -> dict[str,dict[str,Any]]:
+    # Books of the bundled catalog are served locally, without reaching the ISBN cache or the API
+    catalog = get_catalog()
+    if catalog is None:
+        return {}
+
+    books_data = {}
+    with get_metrics().stage('catalog') as values:
+        for isbn in isbns:
+            book_data = catalog.get(isbn)
+            if book_data is not None:
+                books_data[isbn] = book_data
+        values['catalog_hits'] = len(books_data)
+    return books_data
 
 
 def structure_book_data(isbn: str) -> dict[str,Any]:
     """
     Structure the data retrieved from the Google Books API into a JSON, NoSQL 
-    format that contains relevant fields.
+    format that contains relevant fields. The bundled catalog of known books is
+    consulted first, and the rest of the results are read through the ISBN cache,
+    so that repeated ISBN numbers do not reach the API. With several BOOK_PROVIDERS,
+    slow lookups are hedged with the following providers.
 
     Args:
         isbn: String of the ISBN-10 or ISBN-13 number without non-numerical characters (e.g., 9789876290500).
@@ -46,30 +130,149 @@ def structure_book_data(isbn: str) -> dict[str,Any]:
                        from the API. In case the API outputs no matched books, a JSON object is 
                        returned with an exception value of 1 and the ISBN number, opposed to the 
                        value 0 of successfully parsed results.
+
+    Raises:
+        BooksUnavailableError: If none of the providers could be reached or answered without an error.
+        IncompleteBookError: If the matches of the providers are missing fields of the book data,
+                             which is neither structured nor cached as a missing book.
     """
-    book_data = fetch_book_data(isbn)
-
-    # If there are matching results, select the first volume found
-    if book_data['totalItems'] != 0:
-        volume_data = book_data['items'][0]['volumeInfo']
-
-        publisher = volume_data['publisher'] if 'publisher' in volume_data.keys() else 'N/A'
-        title = f'{volume_data['title']}: {volume_data['subtitle']}' \
-                if 'subtitle' in volume_data.keys() else volume_data['title']
-
-        formatted_data = {
-            'isbn': volume_data['industryIdentifiers'][1]['identifier'], # By default, ISBN-13 is taken as the ID
-            'authors': volume_data['authors'],
-            'title': title,
-            'categories': volume_data['categories'],
-            'page_count': volume_data['pageCount'],
-            'language': volume_data['language'].upper(),
-            'publisher': publisher,
-            'year': int(volume_data['publishedDate'][:4]),
-            'exception': 0
-        }
+    book_data = _catalog_books([isbn]).get(isbn)
+    if book_data is not None:
+        return book_data
+    return get_isbn_cache().get_or_load(isbn, _build_book_data)
 
-        return formatted_data
+
+def structure_books_data(isbns: list[str]) -> dict[str,dict[str,Any]]:
+    """
+    Structure the data of several ISBN numbers in the same format as structure_book_data,
+    reading through the bundled catalog and the ISBN cache and looking up the missing numbers
+    with combined queries of up to ten ISBN numbers.
+
+    Args:
+        isbns: List of ISBN-10 or ISBN-13 numbers without non-numerical characters.
+
+    Returns:
+        dict[str,dict[str,Any]]: The book data of each requested ISBN number. Numbers whose
+                                 query failed or was truncated without their volume are not
+                                 included, so that they can be looked up again with
+                                 structure_book_data.
+
+    Raises:
+        ValueError: If a number does not match ISBN-10 or ISBN-13 formats.
+    """
+    for isbn in isbns:
+        if not (isbn.isdigit() and len(isbn) in (10, 13)):
+            raise ValueError(f'The selected value does not match ISBN-10 or ISBN-13 formats.', isbn)
+
+    isbns = list(dict.fromkeys(isbns))
+    books_data = _catalog_books(isbns)
+    missing = [isbn for isbn in isbns if isbn not in books_data]
+    if missing:
+        books_data.update(get_isbn_cache().get_or_load_many(missing, _build_books_data))
+    return books_data
+
+
+def _format_volume(volume_data: dict[str,Any]) -> dict[str,Any]:
+    publisher = volume_data['publisher'] if 'publisher' in volume_data.keys() else 'N/A'
+    title = f'{volume_data['title']}: {volume_data['subtitle']}' \
+            if 'subtitle' in volume_data.keys() else volume_data['title']
+
+    return {
+        'isbn': volume_data['industryIdentifiers'][1]['identifier'], # By default, ISBN-13 is taken as the ID
+        'authors': volume_data['authors'],
+        'title': title,
+        'categories': volume_data['categories'],
+        'page_count': volume_data['pageCount'],
+        'language': volume_data['language'].upper(),
+        'publisher': publisher,
+        'year': int(volume_data['publishedDate'][:4]),
+        'exception': 0
+    }
+
+
+class GoogleBooksProvider(BookProvider):
+    """
+    Google Books API, which answers up to ten ISBN numbers combined in a single query.
+    """
+    name = 'books'
+
+    def lookup(self, isbn: str) -> dict[str,Any] | None:
+        book_data = fetch_book_data(isbn)
+        if 'totalItems' not in book_data:
+            raise BooksUnavailableError(f'Could not look up ISBN {isbn}. {book_data['reason']}')
+
+        # If there are matching results, select the first volume found. A volume with missing
+        # fields is left to the following providers, but is not a book without matching results
+        if book_data['totalItems'] != 0:
+            try:
+                return _format_volume(book_data['items'][0]['volumeInfo'])
+            except (KeyError, IndexError, ValueError) as err:
+                raise IncompleteBookError(f'Incomplete volume of ISBN {isbn}: {err!r}') from err
+        return None
+
+    def lookup_many(self, isbns: list[str]) -> dict[str,dict[str,Any] | None]:
+        books_data = {}
+        for index in range(0, len(isbns), BATCH_QUERY_SIZE):
+            chunk = isbns[index:index + BATCH_QUERY_SIZE]
+            response = fetch_books_data(chunk)
+            if 'totalItems' not in response:
+                continue
+
+            # Match the volumes with the requested numbers by any of their ISBN-10 or ISBN-13 identifiers
+            items = response.get('items', [])
+            volumes = {}
+            for item in items:
+                for identifier in item['volumeInfo'].get('industryIdentifiers', []):
+                    normalized = normalize_isbn(identifier.get('identifier', ''))
+                    if normalized is not None:
+                        volumes.setdefault(normalized, item['volumeInfo'])
+
+            for isbn in chunk:
+                volume_data = volumes.get(normalize_isbn(isbn))
+                if volume_data is None:
+                    # A number is only missing if the page is not full, since a full page can leave
+                    # out matches, while totalItems is an estimate which often exceeds the results
+                    if len(items) < MAX_RESULTS:
+                        books_data[isbn] = None
+                    continue
+                try:
+                    books_data[isbn] = _format_volume(volume_data)
+                except (KeyError, IndexError, ValueError):
+                    # Incomplete volumes are left to the single lookup of the ISBN number
+                    continue
+
+        return books_data
+
+
+PROVIDERS = {
+    'google': GoogleBooksProvider,
+    'openlibrary': OpenLibraryProvider
+}
+
+
+def get_providers() -> list[BookProvider]:
+    """
+    Get the book metadata providers of BOOK_PROVIDERS, which are created once per container
+    so that their latencies survive across warm invocations.
+
+    Raises:
+        ValueError: If a provider is unknown.
+    """
+    global _providers
+    if _providers is None:
+        with _lock:
+            if _providers is None:
+                unknown = [name for name in BOOK_PROVIDERS if name not in PROVIDERS]
+                if unknown or not BOOK_PROVIDERS:
+                    raise ValueError(f'Invalid book providers: {BOOK_PROVIDERS}')
+                _providers = [PROVIDERS[name]() for name in BOOK_PROVIDERS]
+    return _providers
+
+
+def _build_book_data(isbn: str) -> dict[str,Any]:
+    book_data = hedged_lookup(isbn, get_providers())
+    if book_data is not None:
+        return book_data
 
     # Proceed to build an exception object or message in case there are no matching results
     if isbn.isdigit() and (len(isbn) == 10 or len(isbn) == 13):
@@ -78,4 +281,32 @@ def structure_book_data(isbn: str) -> dict[str,Any]:
             'exception': 1
         }
     else:
-        raise ValueError(f'The selected value does not match ISBN-10 or ISBN-13 formats.', isbn)
\ No newline at end of file
+        raise ValueError(f'The selected value does not match ISBN-10 or ISBN-13 formats.', isbn)
+
+
+def _build_books_data(isbns: list[str]) -> dict[str,dict[str,Any]]:
+    primary, *secondaries = get_providers()
+    books_data = primary.lookup_many(isbns)
+
+    # Numbers without a match are looked up in the following providers, which answer
+    # them with a combined query instead of hedging every number of the batch
+    missing = [isbn for isbn, book_data in books_data.items() if book_data is None]
+    unanswered = set()
+    for provider in secondaries:
+        if not missing:
+            break
+        answers = provider.lookup_many(missing)
+        for isbn in missing:
+            if isbn not in answers:
+                unanswered.add(isbn)
+            elif answers[isbn] is not None:
+                books_data[isbn] = answers[isbn]
+        missing = [isbn for isbn in missing if books_data[isbn] is None]
+
+    # Numbers are only missing if every provider answered them, and the rest are left to the single lookup
+    for isbn in missing:
+        if isbn in unanswered:
+            del books_data[isbn]
+        else:
+            books_data[isbn] = {'isbn': isbn, 'exception': 1}
+    return books_data
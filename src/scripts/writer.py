@@ -0,0 +1,135 @@
+import time
+import random
+import logging
+import threading
+
+from typing import Any
+
+from botocore.exceptions import ClientError
+from budget import get_deadline
+from clients import RateLimiter, get_table
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Error codes of whole BatchWriteItem requests which are worth retrying
+RETRYABLE_ERRORS = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError'
+}
+
+
+class BatchWriter:
+    """
+    Thread-safe buffer of DynamoDB items which are written with BatchWriteItem requests
+    of up to 25 items. Unprocessed items are retried with jittered exponential backoff,
+    and items which could not be written after every attempt are kept in 'failed'.
+    """
+    MAX_BATCH_SIZE = 25
+
+    def __init__(self, table_name: str, key_names: tuple[str,...] = ('isbn', 'timestamp'),
+                 max_attempts: int = 5, base_delay: float = 0.05, max_delay: float = 1.0,
+                 rate_limiter: RateLimiter | None = None):
+        self.table_name = table_name
+        self.rate_limiter = rate_limiter
+        self.key_names = key_names
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.failed = []
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def add(self, item: dict[str,Any]) -> None:
+        """
+        Buffer an item, writing the buffer as a batch once it reaches 25 items.
+        """
+        with self._lock:
+            self._buffer.append(item)
+            if len(self._buffer) < self.MAX_BATCH_SIZE:
+                return
+            batch, self._buffer = self._buffer, []
+        self._write(batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        for index in range(0, len(batch), self.MAX_BATCH_SIZE):
+            self._write(batch[index:index + self.MAX_BATCH_SIZE])
+
+    def close(self) -> list[dict[str,Any]]:
+        """
+        Write the remaining buffered items.
+
+        Returns:
+            list[dict[str,Any]]: The items which could not be written to the table.
+        """
+        self.flush()
+        with self._lock:
+            return list(self.failed)
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, so that concurrent writers do not retry at the same time
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _key(self, item: dict[str,Any]) -> tuple:
+        return tuple(item[key_name] for key_name in self.key_names)
+
+    def _write(self, items: list[dict[str,Any]]) -> None:
+        with get_metrics().stage('dynamodb', items=len(items), retries=0) as values:
+            failed = self._write_batch(items, values)
+            values['errors'] = len(failed)
+
+        if failed:
+            with self._lock:
+                self.failed.extend(failed)
+
+    def _write_batch(self, items: list[dict[str,Any]], values: dict[str,float]) -> list[dict[str,Any]]:
+        # A batch cannot contain the same key twice, so the last item prevails as with PutItem
+        pending = {self._key(item): item for item in items}
+        table = get_table(self.table_name)
+        error_message = None
+
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                # Unprocessed items are not retried past the deadline of the invocation
+                delay = self._backoff(attempt)
+                if delay >= get_deadline().remaining():
+                    error_message = f'{error_message}, with no time left to retry'
+                    break
+                values['retries'] = attempt
+                time.sleep(delay)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(len(pending))
+
+            try:
+                response = table.batch_write_item(
+                    RequestItems={
+                        self.table_name: [{'PutRequest': {'Item': item}} for item in pending.values()]
+                    }
+                )
+                self.requests += 1
+            except ClientError as err:
+                error_message = err.response['Error']['Message']
+                if err.response['Error']['Code'] in RETRYABLE_ERRORS:
+                    continue
+                break
+
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            pending = {
+                key: pending[key]
+                for key in (self._key(request['PutRequest']['Item']) for request in unprocessed)
+            }
+            if not pending:
+                logger.info('%d objects loaded to DynamoDB table %s', len(items), self.table_name)
+                return []
+            error_message = f'{len(pending)} unprocessed items'
+
+        logger.error(
+            'Could not upload %d objects to DynamoDB table %s. %s', len(pending), self.table_name, error_message
+        )
+        return list(pending.values())
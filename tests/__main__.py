@@ -1,61 +1,289 @@
 from pathlib import Path
 import sys
 
+import base64
+import gzip
+import io
 import json
 import os
+import tarfile
+import tempfile
+import threading
+import time
 import urllib.error
+import urllib.parse
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date
+from decimal import Decimal
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import unittest
 from unittest.mock import patch, MagicMock
 
+from botocore.exceptions import ClientError
+
 # Move to the scripts/ package folder to avoid exceptions regarding the import of Lambda modules
 scripts_package_path = str(Path(__file__).resolve().parent.parent / 'src' / 'scripts')
 sys.path.insert(0, scripts_package_path)
 
-from src.scripts.utils import fetch_book_data, structure_book_data
-from src.scripts.handler import lambda_handler
+from src.scripts.barcode import decode_ean13, decode_scanline, L_WIDTHS, G_WIDTHS, AVAILABLE as BARCODE_AVAILABLE
+from src.scripts.cache import LRUCache, DynamoDBCache, ISBNCache, AnalysisCache
+from src.scripts.clients import KeepAliveSession, RateLimiter, DynamoDBTable, get_table, init_clients
+from src.scripts.preprocess import parse_regions, downscale_image, AVAILABLE as PREPROCESS_AVAILABLE
+from src.scripts.isbn import normalize_isbn, find_isbns, extract_candidates, extract_isbn_batch, extract_books
+from src.scripts.utils import fetch_book_data, fetch_books_data, structure_book_data, structure_books_data, get_isbn_cache, get_breaker, \
+    BooksUnavailableError, GoogleBooksProvider, OpenLibraryProvider, hedged_lookup
+from src.scripts.catalog import CatalogIndex, write_index
+from src.scripts.detections import DetectionArchive
+from src.scripts.budget import Deadline, CircuitBreaker, CircuitOpenError, DeadlineExceeded, call_with_budget, call_within_deadline
+from src.scripts.metrics import MetricsCollector, percentile
+from src.scripts.writer import BatchWriter
+from src.scripts.handler import lambda_handler, lookup_handler, get_metrics, get_analysis_cache, DeferredRecordsError
+from src.scripts.bulk import bulk_handler
+from src.scripts.aggregates import aggregate_handler, coalesce
+from tools.backfill import backfill, Checkpoint
+from tools.query import query_events, query_exceptions, export_table, isbn_count, day_stats, backfill_days
+from tools.catalog import build_catalog
+from tools.replay import replay, stale_keys
+
+try:
+    import aws_cdk
+    from aws_cdk.assertions import Template, Match
+    from aws_cdk import aws_dynamodb as dynamodb
+    from src.cdk import stack
+    CDK_AVAILABLE = True
+except ImportError:
+    CDK_AVAILABLE = False
+
+# Keep the EMF log lines of the handler out of the test output
+get_metrics().emit = False
 
 class TestFetchBookData(unittest.TestCase):
-    @patch('src.scripts.utils.urllib.request.urlopen')
-    def test_valid_request(self, mock_request_urlopen):
-        mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({'title': 'Example'}).encode()
+    def setUp(self):
+        get_breaker('books').reset()
 
-        mock_request_urlopen.return_value.__enter__.return_value = mock_response
+    @patch('src.scripts.utils.get_books_session')
+    def test_valid_request(self, mock_books_session):
+        mock_books_session.return_value.get.return_value = json.dumps({'title': 'Example'}).encode()
 
         isbn = '9789876290500'
         result = fetch_book_data(isbn)
         self.assertEqual(result['code'], 200)
         self.assertEqual(result['title'], 'Example')
 
-        # Check that the function also calls the right concatenated URL
-        mock_request_urlopen.assert_called_once_with(
-            f'https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}'
+        # Check that the function also calls the right concatenated path
+        mock_books_session.return_value.get.assert_called_once_with(
+            f'/books/v1/volumes?q=isbn:{isbn}', timeout=3.0
         )
     
-    @patch('src.scripts.utils.urllib.request.urlopen')
-    def test_http_error(self, mock_request_urlopen):
+    @patch('src.scripts.utils.get_books_session')
+    def test_http_error(self, mock_books_session):
         http_err = urllib.error.HTTPError(
             url='api.example.com', code=404, msg='Not found', hdrs=None, fp=None
         )
-        mock_request_urlopen.side_effect = http_err
+        mock_books_session.return_value.get.side_effect = http_err
 
         result = fetch_book_data('9789876290500')
         self.assertEqual(result['code'], 404)
         self.assertEqual(result['reason'], 'Not found')
 
-    @patch('src.scripts.utils.urllib.request.urlopen')
-    def test_url_error(self, mock_request_urlopen):
+        # Client errors are not retried
+        mock_books_session.return_value.get.assert_called_once()
+
+    @patch('src.scripts.utils.get_books_session')
+    def test_url_error(self, mock_books_session):
         url_err = urllib.error.URLError(
             reason='Connection failed', filename=None
         )
-        mock_request_urlopen.side_effect = url_err
+        mock_books_session.return_value.get.side_effect = url_err
 
         result = fetch_book_data('9789876290500')
         self.assertEqual(result['reason'], 'Connection failed')
+        self.assertEqual(mock_books_session.return_value.get.call_count, 3)
+
+    @patch('src.scripts.utils.get_books_session')
+    def test_unavailable_lookup(self, mock_books_session):
+        mock_books_session.return_value.get.side_effect = urllib.error.HTTPError(
+            url='api.example.com', code=503, msg='Service unavailable', hdrs=None, fp=None
+        )
+
+        # A failed lookup is raised instead of being cached as a missing book
+        with self.assertRaises(BooksUnavailableError):
+            structure_book_data('9789876290500')
+        self.assertEqual(len(get_isbn_cache().memory), 0)
+
+
+    @patch('src.scripts.utils.get_books_session')
+    def test_combined_request(self, mock_books_session):
+        mock_books_session.return_value.get.return_value = json.dumps({'totalItems': 0}).encode()
+
+        fetch_books_data(['9789876290500', '0306406152'])
+        path = mock_books_session.return_value.get.call_args.args[0]
+        self.assertTrue(path.startswith(
+            '/books/v1/volumes?q=isbn%3A9789876290500%20OR%20isbn%3A0306406152&maxResults=40&fields=totalItems,items('
+        ))
+
+
+class TestKeepAliveSession(unittest.TestCase):
+    def setUp(self):
+        connections = self.connections = []
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                if self.path.startswith('/missing'):
+                    self.send_response(404, 'Not found')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = gzip.compress(json.dumps({'path': self.path}).encode())
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.session = KeepAliveSession(f'http://127.0.0.1:{self.server.server_port}', timeout=5)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        for isbn in ('9789876290500', '9780306406157', '9781234567897'):
+            body = json.loads(self.session.get(f'/books/v1/volumes?q=isbn:{isbn}'))
+            self.assertEqual(body['path'], f'/books/v1/volumes?q=isbn:{isbn}')
+
+        # The three gzip responses are served through a single connection
+        self.assertEqual(len(self.connections), 1)
+
+    def test_connection_reuse_across_threads(self):
+        # Each invocation runs its lookups on a new worker pool, whose threads reuse the idle connections
+        for isbn in ('9789876290500', '9780306406157'):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(self.session.get, f'/books/v1/volumes?q=isbn:{isbn}').result()
+        self.assertEqual(len(self.connections), 1)
+
+        # Concurrent requests open a connection each, which are kept for the next ones
+        barrier = threading.Barrier(2)
+        def concurrent_get(index):
+            barrier.wait()
+            return self.session.get(f'/books/{index}')
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(concurrent_get, range(2)))
+        self.session.get('/books')
+        self.assertLessEqual(len(self.connections), 3)
+
+    def test_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as assert_error:
+            self.session.get('/missing')
+        self.assertEqual(assert_error.exception.code, 404)
+
+        # The connection stays usable after an error response
+        self.assertIn('/books', self.session.get('/books').decode())
+
+
+class TestDynamoDBTable(unittest.TestCase):
+    def test_shared_table(self):
+        with patch('src.scripts.clients.get_client') as mock_client:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                tables = list(executor.map(lambda _: get_table('table-shared'), range(4)))
+
+        # A single table built on the shared client serves every thread
+        self.assertTrue(all(table is tables[0] for table in tables))
+        mock_client.assert_called_with('dynamodb')
+
+    @patch('src.scripts.clients.get_books_session')
+    @patch('src.scripts.clients.get_client')
+    def test_init_clients(self, mock_client, mock_books_session):
+        init_clients(['rekognition'], ['table-cache', 'table-dedup'])
+        tables = {'table-cache': get_table('table-cache'), 'table-dedup': get_table('table-dedup')}
+        calls = mock_client.call_count
+
+        # The tables constructed during the init phase are the ones used by the worker threads
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for name, table in zip(tables, executor.map(get_table, tables)):
+                self.assertIs(table, tables[name])
+        self.assertEqual(mock_client.call_count, calls)
+        mock_client.assert_any_call('rekognition')
+        mock_books_session.assert_called_once_with()
+
+    def test_serialization(self):
+        from boto3.dynamodb.conditions import Attr, Key
+
+        client = MagicMock()
+        client.query.return_value = {
+            'Items': [{'isbn': {'S': '9780306406157'}, 'year': {'N': '2011'}}],
+            'LastEvaluatedKey': {'isbn': {'S': '9780306406157'}, 'timestamp': {'S': '2025-01-01'}}
+        }
+        table = DynamoDBTable('table-example', client)
+
+        response = table.query(
+            IndexName='day-index', KeyConditionExpression=Key('day').eq('2025-01-01'),
+            FilterExpression=Attr('year').eq(2011)
+        )
+        self.assertEqual(response['Items'], [{'isbn': '9780306406157', 'year': Decimal('2011')}])
+        self.assertEqual(response['LastEvaluatedKey'], {'isbn': '9780306406157', 'timestamp': '2025-01-01'})
+
+        # Conditions are built into expressions with placeholders which do not collide
+        request = client.query.call_args.kwargs
+        self.assertEqual(request['TableName'], 'table-example')
+        self.assertEqual(
+            sorted(request['ExpressionAttributeValues'].values(), key=json.dumps),
+            [{'N': '2011'}, {'S': '2025-01-01'}]
+        )
+        self.assertEqual(len(request['ExpressionAttributeNames']), 2)
+        self.assertNotEqual(request['KeyConditionExpression'], request['FilterExpression'])
+
+    def test_batch_write_item(self):
+        client = MagicMock()
+        client.batch_write_item.side_effect = lambda RequestItems: {'UnprocessedItems': RequestItems}
+        table = DynamoDBTable('table-example', client)
+
+        item = {'isbn': '9780306406157', 'timestamp': '2025-01-01', 'page_count': 398}
+        response = table.batch_write_item(RequestItems={'table-example': [{'PutRequest': {'Item': item}}]})
+
+        # Items are sent serialized and their unprocessed requests are returned as they were given
+        sent = client.batch_write_item.call_args.kwargs['RequestItems']['table-example'][0]['PutRequest']['Item']
+        self.assertEqual(sent['page_count'], {'N': '398'})
+        self.assertEqual(response['UnprocessedItems']['table-example'][0]['PutRequest']['Item'], item)
+
+    def test_transact_write_items(self):
+        client = MagicMock()
+        table = DynamoDBTable('table-example', client)
+        table.transact_write_items(TransactItems=[
+            {'Put': {'Item': {'pk': 'batch#1', 'expires_at': 100}, 'ConditionExpression': 'attribute_not_exists(pk)'}},
+            {'Update': {'Key': {'pk': 'day#2025-01-01'}, 'UpdateExpression': 'ADD events :events',
+                        'ExpressionAttributeValues': {':events': 2}}}
+        ])
+
+        # Every action is sent serialized, on the table
+        put, update = client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(put['Put']['Item'], {'pk': {'S': 'batch#1'}, 'expires_at': {'N': '100'}})
+        self.assertEqual(update['Update']['Key'], {'pk': {'S': 'day#2025-01-01'}})
+        self.assertEqual(update['Update']['ExpressionAttributeValues'], {':events': {'N': '2'}})
+        self.assertEqual({put['Put']['TableName'], update['Update']['TableName']}, {'table-example'})
 
 
 class TestStructureBookData(unittest.TestCase):
+    def setUp(self):
+        get_isbn_cache().clear()
+
     @patch('src.scripts.utils.fetch_book_data')
     def test_matching_object(self, mock_fetch_book_data):
         mock_res = {
@@ -112,6 +340,39 @@ class TestStructureBookData(unittest.TestCase):
         res_example['isbn'] = isbn_10
         self.assertEqual(structure_book_data(isbn_10), res_example) 
 
+    @patch('src.scripts.utils.fetch_book_data')
+    def test_incomplete_volume(self, mock_fetch_book_data):
+        mock_fetch_book_data.return_value = {'totalItems': 1, 'items': [{'volumeInfo': {'title': 'Untitled'}}]}
+
+        # A volume without the fields of the book data fails the lookup instead of being cached as a missing book
+        for attempt in range(2):
+            with self.assertRaises(sys.modules['providers'].IncompleteBookError):
+                structure_book_data('9789876290500')
+        self.assertEqual(mock_fetch_book_data.call_count, 2)
+
+    def test_incomplete_match_hedged(self):
+        providers = sys.modules['providers']
+
+        class StubProvider(providers.BookProvider):
+            def __init__(self, answer):
+                super().__init__()
+                self.answer = answer
+
+            def lookup(self, isbn):
+                if isinstance(self.answer, Exception):
+                    raise self.answer
+                return self.answer
+
+        incomplete = StubProvider(providers.IncompleteBookError('Incomplete volume'))
+        book = {'isbn': '9789876290500', 'exception': 0}
+
+        # An incomplete match is passed on to the next provider, and is only raised if no provider has a match
+        self.assertEqual(providers.hedged_lookup('9789876290500', [incomplete, StubProvider(book)]), book)
+        with self.assertRaises(providers.IncompleteBookError):
+            providers.hedged_lookup('9789876290500', [incomplete, StubProvider(None)])
+        with self.assertRaises(providers.BooksUnavailableError):
+            providers.hedged_lookup('9789876290500', [incomplete, StubProvider(providers.BooksUnavailableError('Down'))])
+
     @patch('src.scripts.utils.fetch_book_data')
     def test_invalid_values(self, mock_fetch_book_data):
         mock_fetch_book_data.return_value = {'totalItems': 0}
@@ -126,18 +387,711 @@ class TestStructureBookData(unittest.TestCase):
             structure_book_data('abcdefghijklm')
         self.assertEqual(assert_error.exception.args[1], 'abcdefghijklm')
 
+    @patch('src.scripts.utils.fetch_books_data')
+    def test_combined_lookup(self, mock_fetch_books_data):
+        volume = {
+            'industryIdentifiers': [
+                {'type': 'ISBN_10', 'identifier': '0306406152'},
+                {'type': 'ISBN_13', 'identifier': '9780306406157'}
+            ],
+            'authors': ['Gerald M. Weinberg'],
+            'title': 'The Psychology of Computer Programming',
+            'categories': ['Computers'],
+            'pageCount': 288,
+            'language': 'en',
+            'publishedDate': '1971'
+        }
+        mock_fetch_books_data.return_value = {'totalItems': 1, 'items': [{'volumeInfo': volume}]}
+
+        # Volumes are matched by either identifier, and numbers without volumes are not found
+        books_data = structure_books_data(['0306406152', '9742544919120', '0306406152'])
+        mock_fetch_books_data.assert_called_once_with(['0306406152', '9742544919120'])
+        self.assertEqual(books_data['0306406152']['isbn'], '9780306406157')
+        self.assertEqual(books_data['0306406152']['year'], 1971)
+        self.assertEqual(books_data['9742544919120'], {'isbn': '9742544919120', 'exception': 1})
+
+        # Failed queries leave the numbers out, and cached numbers are not queried again
+        mock_fetch_books_data.return_value = {'code': 503, 'reason': 'Unavailable'}
+        books_data = structure_books_data(['0306406152', '9789876290500'])
+        mock_fetch_books_data.assert_called_with(['9789876290500'])
+        self.assertEqual(list(books_data), ['0306406152'])
+
+        # A truncated page of volumes leaves out the numbers without a match instead of caching them as not found
+        mock_fetch_books_data.return_value = {'totalItems': 57, 'items': [{'volumeInfo': volume}] * 40}
+        books_data = structure_books_data(['9780306406157', '9781234567897'])
+        self.assertEqual(list(books_data), ['9780306406157'])
+        self.assertIsNone(get_isbn_cache().memory.get('9781234567897'))
+
+        # An estimate of totalItems above the results of a page which is not full does not undo the batching
+        mock_fetch_books_data.return_value = {'totalItems': 300, 'items': [{'volumeInfo': volume}]}
+        books_data = structure_books_data(['9780306406157', '9789505578931'])
+        self.assertEqual(books_data['9789505578931'], {'isbn': '9789505578931', 'exception': 1})
+
+        with self.assertRaises(ValueError):
+            structure_books_data(['0306406152', '123456'])
+
+
+class TestProviders(unittest.TestCase):
+    def setUp(self):
+        get_isbn_cache().clear()
+        get_metrics().clear()
+        for name in ('books', 'openlibrary'):
+            get_breaker(name).reset()
+
+        # Each stub answers the numbers it knows after its delay, or its error status
+        self.delays = {'books': 0.0, 'openlibrary': 0.0}
+        self.statuses = {'books': 200, 'openlibrary': 200}
+        self.known = {'books': {'9789876290500'}, 'openlibrary': {'9789876290500', '9780306406157'}}
+        self.paths = {'books': [], 'openlibrary': []}
+        self.servers = {
+            'books': self._start_stub('books', self._volumes),
+            'openlibrary': self._start_stub('openlibrary', self._editions)
+        }
+        urls = {name: f'http://127.0.0.1:{server.server_port}' for name, server in self.servers.items()}
+        self.sessions = [KeepAliveSession(urls['books']), KeepAliveSession(urls['openlibrary'])]
+
+        self.providers = [GoogleBooksProvider(), OpenLibraryProvider(self.sessions[1])]
+        for patcher in (
+            patch('src.scripts.utils.get_books_session', return_value=self.sessions[0]),
+            patch('src.scripts.utils.get_providers', return_value=self.providers),
+            patch('providers.HEDGE_DELAY_MS', 100)
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def _start_stub(self, name, respond):
+        test = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                test.paths[name].append(self.path)
+                time.sleep(test.delays[name])
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                body = json.dumps(respond(query)).encode()
+                self.send_response(test.statuses[name])
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _volumes(self, query):
+        isbns = [term.split(':')[1] for term in query['q'][0].split(' OR ')]
+        items = [
+            {
+                'volumeInfo': {
+                    'industryIdentifiers': [
+                        {'type': 'ISBN_10', 'identifier': isbn[3:]},
+                        {'type': 'ISBN_13', 'identifier': isbn}
+                    ],
+                    'authors': ['Michel Foucault'],
+                    'title': 'Las palabras y las cosas',
+                    'categories': ['Civilization'],
+                    'pageCount': 398,
+                    'language': 'es',
+                    'publishedDate': '2011-03-20'
+                }
+            }
+            for isbn in isbns if isbn in self.known['books']
+        ]
+        return {'totalItems': len(items), 'items': items}
+
+    def _editions(self, query):
+        isbns = [bibkey.split(':')[1] for bibkey in query['bibkeys'][0].split(',')]
+        return {
+            f'ISBN:{isbn}': {
+                'title': 'Las palabras y las cosas',
+                'subtitle': 'una arqueología de las ciencias humanas',
+                'authors': [{'name': 'Michel Foucault', 'url': 'https://openlibrary.org/authors/OL20992A'}],
+                'publishers': [{'name': 'Siglo XXI'}],
+                'publish_date': 'March 2011',
+                'identifiers': {'isbn_13': [isbn]},
+                'number_of_pages': 398,
+                'subjects': [{'name': name} for name in ('Civilization', 'Philosophy', 'Knowledge', 'Language')]
+            }
+            for isbn in isbns if isbn in self.known['openlibrary']
+        }
+
+    def test_open_library_editions(self):
+        books_data = self.providers[1].lookup_many(['9789876290500', '9742544919120'])
+        self.assertEqual(self.paths['openlibrary'], [
+            '/api/books?bibkeys=ISBN:9789876290500,ISBN:9742544919120&format=json&jscmd=data'
+        ])
+
+        # Editions are normalized into the format of structure_book_data, keeping the first subjects
+        self.assertEqual(books_data['9789876290500'], {
+            'isbn': '9789876290500',
+            'authors': ['Michel Foucault'],
+            'title': 'Las palabras y las cosas: una arqueología de las ciencias humanas',
+            'categories': ['Civilization', 'Philosophy', 'Knowledge'],
+            'page_count': 398,
+            'language': 'N/A',
+            'publisher': 'Siglo XXI',
+            'year': 2011,
+            'exception': 0
+        })
+        self.assertIsNone(books_data['9742544919120'])
+
+    def test_hedged_lookup(self):
+        self.delays['books'] = 1.0
+
+        # The slow lookup of the primary provider is hedged, and the first complete answer is taken
+        start = time.perf_counter()
+        book_data = structure_book_data('9789876290500')
+        self.assertLess(time.perf_counter() - start, 0.8)
+        self.assertEqual(book_data['publisher'], 'Siglo XXI')
+        self.assertEqual([record['hedged'] for record in get_metrics().records('lookup')], [1])
+
+        # Without hedging, the primary provider is waited for
+        self.delays['books'] = 0.0
+        self.assertEqual(hedged_lookup('9789876290500', self.providers)['publisher'], 'N/A')
+        self.assertEqual([record['hedged'] for record in get_metrics().records('lookup')], [1, 0])
+        self.assertEqual(len(self.paths['openlibrary']), 1)
+
+        # Latencies are reported per provider
+        stages = get_metrics().summary()
+        self.assertEqual(stages['openlibrary']['count'], 1)
+        self.assertGreaterEqual(stages['books']['count'], 1)
+        self.assertIsNotNone(self.providers[1].latency_percentile(95))
+
+    def test_hedge_bound(self):
+        self.delays['books'] = 0.3
+
+        # Without room for another hedge, the slow primary provider is waited for
+        with patch('providers.MAX_HEDGES', 0):
+            self.assertEqual(hedged_lookup('9789876290500', self.providers)['publisher'], 'N/A')
+        self.assertEqual([record['hedged'] for record in get_metrics().records('lookup')], [0])
+        self.assertEqual(self.paths['openlibrary'], [])
+
+        # Hedges are released once their lookups are done
+        self.assertEqual(hedged_lookup('9789876290500', self.providers)['publisher'], 'Siglo XXI')
+        time.sleep(0.4)
+        self.assertEqual(sys.modules['providers']._hedges, 0)
+
+    def test_fallback_without_match(self):
+        # Numbers without a match of the primary provider are passed on right away
+        self.assertEqual(structure_book_data('9780306406157')['publisher'], 'Siglo XXI')
+        self.assertEqual([record['hedged'] for record in get_metrics().records('lookup')], [0])
+
+        self.known['openlibrary'].clear()
+        self.assertEqual(structure_book_data('9742544919120'), {'isbn': '9742544919120', 'exception': 1})
+
+    def test_combined_fallback(self):
+        books_data = structure_books_data(['9789876290500', '9780306406157', '9742544919120'])
+        self.assertEqual(books_data['9789876290500']['publisher'], 'N/A')
+        self.assertEqual(books_data['9780306406157']['publisher'], 'Siglo XXI')
+        self.assertEqual(books_data['9742544919120'], {'isbn': '9742544919120', 'exception': 1})
+
+        # Only the numbers without a match of the primary provider reach the secondary one
+        self.assertEqual(self.paths['openlibrary'], [
+            '/api/books?bibkeys=ISBN:9780306406157,ISBN:9742544919120&format=json&jscmd=data'
+        ])
+
+        # Numbers which the secondary provider could not answer are left to the single lookup
+        get_isbn_cache().clear()
+        self.statuses['openlibrary'] = 500
+        books_data = structure_books_data(['9789876290500', '9742544919120'])
+        self.assertEqual(list(books_data), ['9789876290500'])
+
+    def test_providers_unavailable(self):
+        self.statuses['books'] = 503
+        self.assertEqual(structure_book_data('9789876290500')['publisher'], 'Siglo XXI')
+
+        # Without a match of the providers which answered, the number is deferred instead of cached as missing
+        for attempt in range(2):
+            with self.assertRaises(BooksUnavailableError):
+                structure_book_data('9742544919120')
+        self.assertEqual(len(self.paths['openlibrary']), 3)
+
+        # The lookup is deferred only if no provider answered
+        self.statuses['openlibrary'] = 500
+        with self.assertRaises(BooksUnavailableError):
+            structure_book_data('9780306406157')
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_rate(self):
+        limiter = RateLimiter(rate=100, burst=1)
+
+        # The first token is available at once and the next four take 10 ms each
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
+
+        # A batch larger than the burst delays the next acquisition by its excess
+        limiter.acquire(3)
+        start = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.025)
+
+
+class TestBudget(unittest.TestCase):
+    def test_call_within_deadline(self):
+        self.assertEqual(call_within_deadline(lambda: 'done', Deadline(1000, reserve_ms=0)), 'done')
+        self.assertEqual(call_within_deadline(lambda: 'done'), 'done')
+
+        # Calls are only waited for within the budget
+        start = time.perf_counter()
+        with self.assertRaises(DeadlineExceeded):
+            call_within_deadline(lambda: time.sleep(0.5), Deadline(100, reserve_ms=0))
+        self.assertLess(time.perf_counter() - start, 0.4)
+        with self.assertRaises(DeadlineExceeded):
+            call_within_deadline(lambda: 'done', Deadline(0, reserve_ms=0))
+
+    def test_deadline_from_context(self):
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 3000
+        deadline = Deadline.from_context(context, reserve_ms=1000)
+
+        # Socket timeouts are capped by the remaining time before the reserve
+        self.assertAlmostEqual(deadline.timeout(5), 2, delta=0.1)
+        self.assertEqual(deadline.timeout(1), 1)
+
+        # Callers without a Lambda context have an unbounded budget
+        self.assertFalse(Deadline.from_context(None).expired())
+
+        with self.assertRaises(DeadlineExceeded):
+            Deadline(500, reserve_ms=1000).timeout(5)
+
+    @patch('src.scripts.budget.time.monotonic')
+    def test_circuit_breaker(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        operation = MagicMock(side_effect=ConnectionError('Connection failed'))
+
+        with self.assertRaises(ConnectionError):
+            call_with_budget(operation, lambda err: True, 1, max_attempts=2, base_delay=0, breaker=breaker)
+        self.assertTrue(breaker.is_open)
+
+        # Calls fail fast while the circuit is open
+        with self.assertRaises(CircuitOpenError):
+            call_with_budget(operation, lambda err: True, 1, breaker=breaker)
+        self.assertEqual(operation.call_count, 2)
+
+        # A successful trial call closes the circuit after the reset timeout
+        mock_monotonic.return_value = 31
+        operation.side_effect = None
+        operation.return_value = 'body'
+        self.assertEqual(call_with_budget(operation, lambda err: True, 1, breaker=breaker), 'body')
+        self.assertFalse(breaker.is_open)
+
+    def test_retries_within_budget(self):
+        operation = MagicMock(side_effect=[ConnectionError('Connection failed'), 'body'])
+        self.assertEqual(call_with_budget(operation, lambda err: True, 1, base_delay=0.01), 'body')
+
+        # Errors which are not transient are raised at once
+        operation = MagicMock(side_effect=ValueError('Bad request'))
+        with self.assertRaises(ValueError):
+            call_with_budget(operation, lambda err: isinstance(err, ConnectionError), 1)
+        operation.assert_called_once()
+
+        # No retry is made without time left for its delay
+        operation = MagicMock(side_effect=ConnectionError('Connection failed'))
+        with self.assertRaises(DeadlineExceeded):
+            call_with_budget(operation, lambda err: True, 1, base_delay=1, max_delay=1,
+                             deadline=Deadline(1010, reserve_ms=1000))
+
+
+class TestISBNCache(unittest.TestCase):
+    @patch('src.scripts.cache.time.monotonic')
+    def test_lru_eviction_and_ttl(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        lru = LRUCache(max_size=2, ttl=60)
+        lru.put('a', 1)
+        lru.put('b', 2)
+
+        # Reading 'a' makes 'b' the least recently used entry
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(len(lru), 2)
+
+        # Entries expire after the TTL, which can only be shortened per entry
+        lru.put('d', 4, ttl=10)
+        mock_monotonic.return_value = 30
+        self.assertIsNone(lru.get('d'))
+        self.assertEqual(lru.get('c'), 3)
+        mock_monotonic.return_value = 61
+        self.assertIsNone(lru.get('c'))
+
+    def test_read_through_tiers(self):
+        table = MagicMock()
+        table.get.return_value = None
+        loader = MagicMock(return_value={'isbn': '9789876290500', 'exception': 0})
+        cache = ISBNCache(LRUCache(max_size=10, ttl=60), table, table_ttl=1000, not_found_ttl=10)
+
+        first = cache.get_or_load('9789876290500', loader)
+        first['timestamp'] = '2025-01-01'
+        second = cache.get_or_load('9789876290500', loader)
+
+        # The loader is called once and the cached object is not modified by the caller
+        loader.assert_called_once_with('9789876290500')
+        self.assertEqual(second, {'isbn': '9789876290500', 'exception': 0})
+        table.put.assert_called_once_with('9789876290500', second, 1000)
+        self.assertEqual(cache.pop_stats(), {'memory_hits': 1, 'table_hits': 0, 'misses': 1})
+
+        # A new container reads the item from the table tier instead of the loader
+        table.get.return_value = second
+        cache.memory.clear()
+        self.assertEqual(cache.get_or_load('9789876290500', loader), second)
+        self.assertEqual(loader.call_count, 1)
+        self.assertEqual(cache.pop_stats(), {'memory_hits': 0, 'table_hits': 1, 'misses': 0})
+
+    def test_read_through_many(self):
+        table = MagicMock()
+        table.get.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0} if isbn == '9788433967558' else None
+        loader = MagicMock(side_effect=lambda isbns: {isbns[0]: {'isbn': isbns[0], 'exception': 1}})
+        cache = ISBNCache(LRUCache(max_size=10, ttl=60), table, table_ttl=1000, not_found_ttl=10)
+        cache.get_or_load('9789876290500', lambda isbn: {'isbn': isbn, 'exception': 0})
+        cache.pop_stats()
+
+        books_data = cache.get_or_load_many(['9789876290500', '9788433967558', '9742544919120', '9780306406157'], loader)
+
+        # Only the missing numbers reach the loader, which can leave some of them out
+        loader.assert_called_once_with(['9742544919120', '9780306406157'])
+        self.assertEqual(sorted(books_data), ['9742544919120', '9788433967558', '9789876290500'])
+        table.put.assert_called_with('9742544919120', {'isbn': '9742544919120', 'exception': 1}, 10)
+        self.assertEqual(cache.pop_stats(), {'memory_hits': 1, 'table_hits': 1, 'misses': 2})
+
+    def test_negative_caching(self):
+        table = MagicMock()
+        table.get.return_value = None
+        cache = ISBNCache(LRUCache(max_size=10, ttl=60), table, table_ttl=1000, not_found_ttl=10)
+
+        cache.get_or_load('9742544919120', lambda isbn: {'isbn': isbn, 'exception': 1})
+        table.put.assert_called_once_with('9742544919120', {'isbn': '9742544919120', 'exception': 1}, 10)
+
+    def test_table_errors_fall_back_to_loader(self):
+        table = MagicMock()
+        table.get.side_effect = ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Throttled'}},
+            'GetItem'
+        )
+        cache = ISBNCache(LRUCache(max_size=10, ttl=60), table)
+
+        book_data = cache.get_or_load('9789876290500', lambda isbn: {'isbn': isbn, 'exception': 0})
+        self.assertEqual(book_data['exception'], 0)
+
+    @patch('src.scripts.cache.time.time')
+    @patch('src.scripts.cache.get_table')
+    def test_dynamodb_expiration(self, mock_get_table, mock_time):
+        mock_time.return_value = 1000
+        table = DynamoDBCache('cache-example')
+        table.put('9789876290500', {'isbn': '9789876290500', 'page_count': 398}, 60)
+
+        item = mock_get_table.return_value.put_item.call_args.kwargs['Item']
+        self.assertEqual(item['expires_at'], 1060)
+
+        # Expired items which were not deleted yet by DynamoDB are ignored
+        mock_get_table.return_value.get_item.return_value = {'Item': item}
+        self.assertEqual(table.get('9789876290500')['page_count'], 398)
+        mock_time.return_value = 1060
+        self.assertIsNone(table.get('9789876290500'))
+
+    def test_analysis_cache_tiers(self):
+        table = MagicMock()
+        table.get.side_effect = lambda content_hash: {'isbn': '9789876290500', 'source': 'rekognition', 'analysis_ms': 120.5} \
+                                if content_hash == 'stored' else None
+        cache = AnalysisCache(LRUCache(max_size=10, ttl=60), table, ttl=100)
+
+        # Table hits are promoted to the memory tier
+        self.assertEqual(cache.get('stored')['isbn'], '9789876290500')
+        self.assertEqual(cache.get('stored')['isbn'], '9789876290500')
+        table.get.assert_called_once_with('stored')
+
+        self.assertIsNone(cache.get('new'))
+        cache.put('new', {'isbn': '9788433967558', 'source': 'barcode', 'analysis_ms': 10.0})
+        table.put.assert_called_once_with('new', {'isbn': '9788433967558', 'source': 'barcode', 'analysis_ms': 10.0}, 100)
+        self.assertEqual(cache.get('new')['source'], 'barcode')
+
+        self.assertEqual(
+            cache.pop_stats(),
+            {'hits': 3, 'misses': 1, 'rekognition_calls_saved': 2, 'saved_ms': 251.0}
+        )
+
+
+class TestBatchWriter(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('src.scripts.writer.get_table')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+        sleep_patcher = patch('src.scripts.writer.time.sleep')
+        self.mock_sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_flush_every_25_items(self):
+        self.client.batch_write_item.return_value = {'UnprocessedItems': {}}
+        writer = BatchWriter('table-example')
+
+        for index in range(30):
+            writer.add({'isbn': str(index), 'timestamp': '2025-01-01'})
+        self.assertEqual(self.client.batch_write_item.call_count, 1)
+
+        # The remaining items are written when closing the writer
+        self.assertEqual(writer.close(), [])
+        self.assertEqual(writer.requests, 2)
+        batches = [call.kwargs['RequestItems']['table-example'] for call in self.client.batch_write_item.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [25, 5])
+
+    def test_retry_unprocessed_items(self):
+        items = [{'isbn': str(index), 'timestamp': '2025-01-01'} for index in range(3)]
+        self.client.batch_write_item.side_effect = [
+            {'UnprocessedItems': {'table-example': [{'PutRequest': {'Item': dict(items[1])}}]}},
+            {'UnprocessedItems': {}}
+        ]
+        writer = BatchWriter('table-example')
+        for item in items:
+            writer.add(item)
+
+        self.assertEqual(writer.close(), [])
+        retried_batch = self.client.batch_write_item.call_args.kwargs['RequestItems']['table-example']
+        self.assertEqual(retried_batch, [{'PutRequest': {'Item': items[1]}}])
+        self.mock_sleep.assert_called_once()
+
+    def test_report_failed_items(self):
+        self.client.batch_write_item.side_effect = ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Throttled'}},
+            'BatchWriteItem'
+        )
+        writer = BatchWriter('table-example', max_attempts=3)
+        item = {'isbn': '9789876290500', 'timestamp': '2025-01-01'}
+        writer.add(item)
+
+        # Throttled batches are retried until the attempts run out
+        get_metrics().clear()
+        failed = writer.close()
+        self.assertEqual(self.client.batch_write_item.call_count, 3)
+        self.assertEqual(len(failed), 1)
+        self.assertIs(failed[0], item)
+
+        record = get_metrics().records('dynamodb')[0]
+        self.assertEqual((record['items'], record['retries'], record['errors']), (1, 2, 1))
+
+    def test_duplicate_keys(self):
+        self.client.batch_write_item.return_value = {'UnprocessedItems': {}}
+        writer = BatchWriter('table-example')
+        writer.add({'isbn': '9789876290500', 'timestamp': '2025-01-01', 'exception': 1})
+        writer.add({'isbn': '9789876290500', 'timestamp': '2025-01-01', 'exception': 0})
+        writer.close()
+
+        batch = self.client.batch_write_item.call_args.kwargs['RequestItems']['table-example']
+        self.assertEqual(batch, [{'PutRequest': {'Item': {'isbn': '9789876290500', 'timestamp': '2025-01-01', 'exception': 0}}}])
+
+
+class TestISBNParsing(unittest.TestCase):
+    def test_normalize_isbn(self):
+        self.assertEqual(normalize_isbn('ISBN 978-987-629-899-5'), '9789876298995')
+        self.assertEqual(normalize_isbn('ISBN-10: 0-306-40615-2'), '9780306406157')
+        self.assertEqual(normalize_isbn('0-8044-2957-X'), '9780804429573')
+
+        # Invalid checksums and values which are not ISBN numbers
+        self.assertIsNone(normalize_isbn('9781234567890'))
+        self.assertIsNone(normalize_isbn('0306406153'))
+        self.assertIsNone(normalize_isbn('1234567890128'))
+
+    def test_find_isbns(self):
+        self.assertEqual(find_isbns('9 789505 578931'), ['9789505578931'])
+        self.assertEqual(find_isbns('ISBN-13 978 0 306 40615 7'), ['9780306406157'])
+        self.assertEqual(find_isbns('9788433967558 51299'), ['9788433967558'])
+        self.assertEqual(find_isbns('$12.99 - 350 pages'), [])
+
+    def test_extract_candidates(self):
+        detections = [
+            {'DetectedText': 'Las palabras y las cosas', 'Type': 'LINE', 'Confidence': 99.0},
+            {'DetectedText': '$ 24.99', 'Type': 'LINE', 'Confidence': 99.5},
+            {
+                'DetectedText': '9 789876 290500', 'Type': 'LINE', 'Confidence': 80.0,
+                'Geometry': {'BoundingBox': {'Height': 0.05}}
+            },
+            {
+                'DetectedText': 'ISBN 978-950-557-893-1', 'Type': 'LINE', 'Confidence': 95.0,
+                'Geometry': {'BoundingBox': {'Height': 0.03}}
+            },
+            {'DetectedText': '978-950-557-893-1', 'Type': 'WORD', 'Confidence': 96.0},
+            {'DetectedText': '9789505578931', 'Type': 'BARCODE', 'Confidence': 100.0}
+        ]
+
+        candidates = extract_candidates(detections)
+        self.assertEqual([candidate['isbn'] for candidate in candidates], ['9789505578931', '9789876290500'])
+        self.assertEqual(candidates[0]['occurrences'], 2)
+        self.assertEqual(candidates[0]['confidence'], 96.0)
+        self.assertTrue(candidates[0]['labeled'])
+
+    def test_extract_books(self):
+        def detection(text, left, top, confidence=90.0, detection_type='LINE'):
+            box = {'Left': left, 'Top': top, 'Width': 0.1, 'Height': 0.02}
+            return {'DetectedText': text, 'Type': detection_type, 'Confidence': confidence, 'Geometry': {'BoundingBox': box}}
+
+        detections = [
+            # Labeled number and barcode digits of a book, where a misread digit gives another valid number
+            detection('ISBN 978-950-557-893-1', 0.1, 0.1, 95.0),
+            detection('9 789505 578931', 0.1, 0.16),
+            detection('ISBN 978-987-629-050-0', 0.1, 0.18, 40.0),
+            # A second book, and a copy of the first one far away in the photo
+            detection('ISBN 0-306-40615-2', 0.6, 0.1),
+            detection('0-306-40615-2', 0.6, 0.1, 92.0, 'WORD'),
+            detection('ISBN 978-950-557-893-1', 0.1, 0.7),
+            detection('Las palabras y las cosas', 0.1, 0.3)
+        ]
+
+        books = extract_books(detections)
+        self.assertEqual([book['isbn'] for book in books], ['9789505578931', '9780306406157', '9789505578931'])
+        self.assertEqual(books[0]['occurrences'], 2)
+        self.assertEqual(extract_books([]), [])
+
+    def test_extract_isbn_batch(self):
+        responses = [
+            {'TextDetections': [{'DetectedText': 'ISBN 0-306-40615-2', 'Type': 'LINE', 'Confidence': 90.0}]},
+            {'TextDetections': [{'DetectedText': 'Chapter 1', 'Type': 'LINE', 'Confidence': 90.0}]},
+            {}
+        ]
+        self.assertEqual(extract_isbn_batch(responses), ['9780306406157', None, None])
+
+
+@unittest.skipUnless(BARCODE_AVAILABLE, 'NumPy and Pillow are required for barcode decoding')
+class TestBarcodeDecoding(unittest.TestCase):
+    images_path = Path(__file__).resolve().parent.parent / 'img'
+
+    def render_scanline(self, code, module=3):
+        import numpy as np
+
+        # Encode the left digits with the parities of the first digit and the right digits as R codes
+        parities = ['LLLLLL', 'LLGLGG', 'LLGGLG', 'LLGGGL', 'LGLLGG',
+                    'LGGLLG', 'LGGGLL', 'LGLGLG', 'LGLGGL', 'LGGLGL'][int(code[0])]
+        widths = [10, 1, 1, 1]
+        for digit, parity in zip(code[1:7], parities):
+            widths += (L_WIDTHS if parity == 'L' else G_WIDTHS)[int(digit)]
+        widths += [1, 1, 1, 1, 1]
+        for digit in code[7:]:
+            widths += L_WIDTHS[int(digit)]
+        widths += [1, 1, 1, 10]
+
+        # Runs alternate between light and dark pixels, starting with the light quiet zone
+        pixels = [255 if index % 2 == 0 else 20 for index, width in enumerate(widths) for _ in range(width * module)]
+        return np.array(pixels, dtype=np.float32)
+
+    def test_decode_scanline(self):
+        for code in ('9789876290500', '9780306406157', '9788433967558'):
+            self.assertEqual(decode_scanline(self.render_scanline(code)), code)
+
+    def test_decode_sample_images(self):
+        self.assertEqual(decode_ean13((self.images_path / '2.jpg').read_bytes()), '9788433967558')
+        self.assertEqual(decode_ean13((self.images_path / '3.jpg').read_bytes()), '9789876298995')
+
+    def test_invalid_image(self):
+        self.assertIsNone(decode_ean13(b'not an image'))
+
+
+class TestPreprocessing(unittest.TestCase):
+    def test_parse_regions(self):
+        self.assertEqual(
+            parse_regions('0.1,0.5,0.8,0.5; 0,0,1,0.2'),
+            [
+                {'BoundingBox': {'Left': 0.1, 'Top': 0.5, 'Width': 0.8, 'Height': 0.5}},
+                {'BoundingBox': {'Left': 0.0, 'Top': 0.0, 'Width': 1.0, 'Height': 0.2}}
+            ]
+        )
+        self.assertEqual(parse_regions(''), [])
+
+        with self.assertRaises(ValueError):
+            parse_regions('0.1,0.5,1.8,0.5')
+
+    @unittest.skipUnless(PREPROCESS_AVAILABLE, 'Pillow is required for image preprocessing')
+    def test_downscale_image(self):
+        from PIL import Image
+
+        image_bytes = (Path(__file__).resolve().parent.parent / 'img' / '3.jpg').read_bytes()
+        downscaled = downscale_image(image_bytes, max_side=800, quality=80)
+
+        self.assertLess(len(downscaled), len(image_bytes))
+        with Image.open(io.BytesIO(downscaled)) as image:
+            self.assertEqual(max(image.size), 800)
+
+        # Small images are sent as they are
+        self.assertIs(downscale_image(downscaled, max_side=800), downscaled)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stage_records(self):
+        metrics = MetricsCollector(emit=False)
+        with metrics.stage('books') as values:
+            values['bytes'] = 512
+
+        with self.assertRaises(urllib.error.URLError):
+            with metrics.stage('books'):
+                raise urllib.error.URLError('Connection failed')
+
+        records = metrics.records('books')
+        self.assertEqual(records[0]['bytes'], 512)
+        self.assertNotIn('errors', records[0])
+        self.assertEqual(records[1]['errors'], 1)
+        self.assertTrue(all(record['duration_ms'] >= 0 for record in records))
+
+    def test_emf_documents(self):
+        metrics = MetricsCollector(namespace='Example')
+        for index in range(150):
+            metrics.record('rekognition', duration_ms=index, retries=0)
+        metrics.record('cache', memory_hits=3, misses=1)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            metrics.flush()
+        documents = [json.loads(line) for line in output.getvalue().splitlines()]
+
+        # Values are grouped into arrays of up to 100 values per stage
+        self.assertEqual([document['Stage'] for document in documents], ['rekognition', 'rekognition', 'cache'])
+        self.assertEqual([len(document['Duration']) for document in documents[:2]], [100, 50])
+        directive = documents[0]['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Namespace'], 'Example')
+        self.assertEqual(directive['Dimensions'], [['Stage']])
+        self.assertIn({'Name': 'Duration', 'Unit': 'Milliseconds'}, directive['Metrics'])
+        self.assertEqual(documents[2]['MemoryCacheHits'], [3])
+
+        # Emitted records stay readable until the collector is cleared
+        self.assertEqual(metrics.summary()['rekognition']['count'], 150)
+        self.assertEqual(metrics.summary()['rekognition']['p99_ms'], 148)
+        metrics.clear()
+        self.assertEqual(metrics.records(), [])
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        self.assertEqual(percentile([7], 99), 7)
+
 
 class TestLambdaHandler(unittest.TestCase):
+    def setUp(self):
+        get_isbn_cache().clear()
+        get_analysis_cache().clear()
+
+    @patch('src.scripts.handler.BatchWriter')
     @patch('src.scripts.handler.load_to_db')
     @patch("src.scripts.handler.structure_book_data")
-    @patch("src.scripts.handler.boto3.client")
-    def test_lambda_handler_success(self, mock_boto, mock_structure, mock_load_db):
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_success(self, mock_boto, mock_structure, mock_load_db, mock_writer):
         bucket_name = 'my-bucket'
         file_name = 'test.jpg'
         timestamp = '2025-01-01'
 
-        raw_isbn = '978-12345-67890'
-        clean_isbn = '9781234567890'
+        raw_isbn = '978-12345-67897'
+        clean_isbn = '9781234567897'
 
         table_name = 'table-example'
 
@@ -164,7 +1118,7 @@ class TestLambdaHandler(unittest.TestCase):
 
         # Mock structure_book_data() reduced output
         mock_structure.return_value = {
-            'isbn': '9781234567890',
+            'isbn': '9781234567897',
             'exception': 0
         }
 
@@ -182,14 +1136,1553 @@ class TestLambdaHandler(unittest.TestCase):
             }
         )
         mock_structure.assert_called_once_with(clean_isbn)
+        mock_writer.assert_called_once_with(table_name)
         mock_load_db.assert_called_once_with(
             {
                 'isbn': clean_isbn,
                 'exception': 0,
-                'timestamp': timestamp
+                'timestamp': timestamp,
+                'day': timestamp
             },
-            table_name
+            mock_writer.return_value
+        )
+        mock_writer.return_value.close.assert_called_once_with()
+
+    @patch('src.scripts.handler.load_to_db')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_partial_failure(self, mock_boto, mock_structure, mock_load_db):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': key}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+                for key in ('first.jpg', 'broken.jpg', 'third.jpg')
+            ]
+        }
+
+        # Fail the Rekognition call only for the second image
+        def detect_text(Image):
+            if Image['S3Object']['Name'] == 'broken.jpg':
+                raise ClientError(
+                    {'Error': {'Code': 'InvalidImageFormatException', 'Message': 'Bad image'}},
+                    'DetectText'
+                )
+            return {'TextDetections': [{'DetectedText': '9781234567897'}]}
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = detect_text
+        mock_boto.return_value = mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        # Every record is reported in the order of the event and the failure is isolated
+        self.assertEqual(
+            [(result['key'], result['status']) for result in response['results']],
+            [('first.jpg', 'SUCCESS'), ('broken.jpg', 'FAILED'), ('third.jpg', 'SUCCESS')]
+        )
+        self.assertIn('Bad image', response['results'][1]['error'])
+        self.assertEqual(mock_load_db.call_count, 2)
+
+    @patch('src.scripts.handler.load_to_db')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_concurrent_records(self, mock_boto, mock_structure, mock_load_db):
+        records_count = 4
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': f'{index}.jpg'}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+                for index in range(records_count)
+            ]
+        }
+
+        # The barrier is only released if every record is being analyzed at the same time
+        barrier = threading.Barrier(records_count, timeout=5)
+        def detect_text(Image):
+            barrier.wait()
+            return {'TextDetections': [{'DetectedText': '9781234567897'}]}
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = detect_text
+        mock_boto.return_value = mock_rekognition
+        mock_structure.return_value = {'isbn': '9781234567897', 'exception': 0}
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        self.assertTrue(all(result['status'] == 'SUCCESS' for result in response['results']))
+        mock_boto.assert_called_once_with('rekognition')
+
+    @patch('src.scripts.handler.load_to_db')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_dedup_reuploads(self, mock_boto, mock_structure, mock_load_db):
+        def s3_event(timestamp):
+            return {
+                'Records': [
+                    {
+                        's3': {
+                            'bucket': {'name': 'my-bucket'},
+                            'object': {'key': f'cover-{timestamp}.jpg', 'eTag': '0123456789abcdef0123456789abcdef'}
+                        },
+                        'eventTime': timestamp
+                    }
+                ]
+            }
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.return_value = {'TextDetections': [{'DetectedText': '9781234567897'}]}
+        mock_boto.return_value = mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            first = lambda_handler(s3_event('2025-01-01'), None)
+            second = lambda_handler(s3_event('2025-01-02'), None)
+
+        # The re-uploaded image is not analyzed again but still gets a new event
+        mock_rekognition.detect_text.assert_called_once()
+        self.assertEqual(first['results'][0]['source'], 'rekognition')
+        self.assertEqual(
+            (second['results'][0]['source'], second['results'][0]['status'], second['results'][0]['isbn']),
+            ('dedup', 'SUCCESS', '9781234567897')
         )
+        self.assertEqual([call.args[0]['timestamp'] for call in mock_load_db.call_args_list], ['2025-01-01', '2025-01-02'])
+
+    @patch('src.scripts.handler.load_to_db')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_no_valid_isbn(self, mock_boto, mock_structure, mock_load_db):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': 'cover.jpg'}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+            ]
+        }
+
+        # Neither the title nor the price are checksum-valid ISBN numbers
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.return_value = {
+            'TextDetections': [
+                {'DetectedText': 'Las palabras y las cosas', 'Type': 'LINE'},
+                {'DetectedText': '$ 1234567890', 'Type': 'LINE'}
+            ]
+        }
+        mock_boto.return_value = mock_rekognition
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        self.assertEqual(response['results'][0]['status'], 'FAILED')
+        mock_structure.assert_not_called()
+        mock_load_db.assert_not_called()
+
+    @patch('src.scripts.handler.BARCODE_DECODING', True)
+    @patch('src.scripts.handler.decode_ean13')
+    @patch('src.scripts.handler.load_to_db')
+    @patch('src.scripts.handler.structure_books_data', MagicMock(return_value={}))
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_barcode_path(self, mock_boto, mock_structure, mock_load_db, mock_decode):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': key}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+                for key in ('barcode.jpg', 'text.jpg')
+            ]
+        }
+
+        # Only the first image has a readable barcode
+        mock_s3 = MagicMock()
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {'Body': MagicMock(read=lambda: Key.encode())}
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.return_value = {
+            'TextDetections': [{'DetectedText': 'ISBN 978-0-306-40615-7', 'Type': 'LINE'}]
+        }
+        mock_boto.side_effect = lambda service: mock_s3 if service == 's3' else mock_rekognition
+        mock_decode.side_effect = lambda image_bytes: '9789876290500' if image_bytes == b'barcode.jpg' else None
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        self.assertEqual(
+            [(result['isbn'], result['source']) for result in response['results']],
+            [('9789876290500', 'barcode'), ('9780306406157', 'rekognition')]
+        )
+        mock_rekognition.detect_text.assert_called_once_with(
+            Image={'S3Object': {'Bucket': 'my-bucket', 'Name': 'text.jpg'}}
+        )
+
+    @patch('src.scripts.handler.PREPROCESS_IMAGES', True)
+    @patch('src.scripts.handler.DETECT_TEXT_FILTERS', {'WordFilter': {'MinConfidence': 80.0}})
+    @patch('src.scripts.handler.downscale_image')
+    @patch('src.scripts.handler.load_to_db')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_preprocessing(self, mock_boto, mock_structure, mock_load_db, mock_downscale):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': 'cover.jpg'}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+            ]
+        }
+
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': MagicMock(read=lambda: b'original image')}
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.return_value = {
+            'TextDetections': [{'DetectedText': 'ISBN 978-0-306-40615-7', 'Type': 'LINE'}]
+        }
+        mock_boto.side_effect = lambda service: mock_s3 if service == 's3' else mock_rekognition
+        mock_downscale.return_value = b'small'
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        # The downscaled bytes are sent along with the configured filters
+        self.assertEqual(response['results'][0]['isbn'], '9780306406157')
+        mock_downscale.assert_called_once_with(b'original image')
+        mock_rekognition.detect_text.assert_called_once_with(
+            Image={'Bytes': b'small'},
+            Filters={'WordFilter': {'MinConfidence': 80.0}}
+        )
+
+    @patch('src.scripts.handler.BatchWriter')
+    @patch('utils.get_books_session') # The handler imports the utils module as deployed in Lambda
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_metrics(self, mock_boto, mock_books_session, mock_writer):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': 'cover.jpg'}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+            ]
+        }
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.return_value = {
+            'TextDetections': [{'DetectedText': '9780306406157'}],
+            'ResponseMetadata': {'RetryAttempts': 1}
+        }
+        mock_boto.return_value = mock_rekognition
+        mock_books_session.return_value.get.return_value = json.dumps({'totalItems': 0}).encode()
+        mock_writer.return_value.close.return_value = []
+
+        metrics = get_metrics()
+        metrics.clear()
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            lambda_handler(s3_event, None)
+
+        # Every stage of the invocation is recorded and emitted at its end
+        self.assertEqual(
+            {record['stage'] for record in metrics.records()},
+            {'rekognition', 'books', 'load_to_db', 'cache', 'dedup', 'invocation'}
+        )
+        self.assertEqual(metrics.records('rekognition')[0]['retries'], 1)
+        self.assertEqual(metrics.records('books')[0]['bytes'], len(b'{"totalItems": 0}'))
+        self.assertEqual(metrics.records('cache')[0]['misses'], 1)
+        self.assertEqual(metrics.records('invocation')[0]['records'], 1)
+        self.assertEqual(metrics.records('invocation')[0]['errors'], 0)
+
+    @patch('utils.get_breaker', MagicMock(return_value=CircuitBreaker()))
+    @patch('src.scripts.handler.BatchWriter')
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_connection_reuse(self, mock_boto, mock_writer):
+        connections = []
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                body = json.dumps({'totalItems': 0}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        session = KeepAliveSession(f'http://127.0.0.1:{server.server_port}', timeout=5)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(session.close)
+
+        mock_boto.return_value.detect_text.return_value = {'TextDetections': [{'DetectedText': '9780306406157'}]}
+        mock_writer.return_value.close.return_value = []
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': 'cover.jpg'}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+            ]
+        }
+
+        # Warm invocations run their lookups on new worker threads, which reuse the connection of the container
+        with patch('utils.get_books_session', return_value=session), \
+             patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            for _ in range(2):
+                get_isbn_cache().clear()
+                get_analysis_cache().clear()
+                lambda_handler(s3_event, None)
+        self.assertEqual(len(connections), 1)
+
+    @patch('src.scripts.handler.load_to_db')
+    @patch('src.scripts.handler.structure_books_data')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_combined_lookup(self, mock_boto, mock_structure, mock_structure_many, mock_load_db):
+        keys = {'first.jpg': '9781234567897', 'second.jpg': '9780306406157', 'third.jpg': '9781234567897'}
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': key}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+                for key in keys
+            ]
+        }
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = lambda Image: {
+            'TextDetections': [{'DetectedText': keys[Image['S3Object']['Name']]}]
+        }
+        mock_boto.return_value = mock_rekognition
+        mock_structure_many.side_effect = lambda isbns: {isbn: {'isbn': isbn, 'exception': 0} for isbn in isbns}
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        # The unique numbers of the invocation are looked up together
+        mock_structure_many.assert_called_once_with(['9780306406157', '9781234567897'])
+        mock_structure.assert_not_called()
+        self.assertEqual([result['status'] for result in response['results']], ['SUCCESS'] * 3)
+        self.assertEqual(mock_load_db.call_count, 3)
+
+    @patch('src.scripts.handler.BatchWriter')
+    @patch('src.scripts.handler.structure_books_data')
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_shared_book_data(self, mock_boto, mock_structure_many, mock_writer):
+        keys = {'a.jpg': '9781234567897', 'b.jpg': '9781234567897', 'c.jpg': '9780306406157'}
+        s3_event = {'Records': [
+            {'s3': {'bucket': {'name': 'my-bucket'}, 'object': {'key': key}}, 'eventTime': f'2025-01-01T00:00:0{second}.000Z'}
+            for second, key in enumerate(keys)
+        ]}
+        mock_boto.return_value.detect_text.side_effect = lambda Image: {
+            'TextDetections': [{'DetectedText': keys[Image['S3Object']['Name']]}]
+        }
+        mock_structure_many.side_effect = lambda isbns: {isbn: {'isbn': isbn, 'exception': 0} for isbn in isbns}
+        mock_writer.return_value.close.return_value = []
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        # Records of the same number get items of their own, under the timestamps of their events
+        self.assertEqual([result['status'] for result in response['results']], ['SUCCESS'] * 3)
+        items = [call.args[0] for call in mock_writer.return_value.add.call_args_list]
+        self.assertEqual(sorted((item['isbn'], item['timestamp']) for item in items), [
+            ('9780306406157', '2025-01-01T00:00:02.000Z'),
+            ('9781234567897', '2025-01-01T00:00:00.000Z'),
+            ('9781234567897', '2025-01-01T00:00:01.000Z')
+        ])
+
+    @patch('src.scripts.handler.BatchWriter')
+    @patch('src.scripts.handler.structure_books_data', MagicMock(return_value={}))
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_write_failure(self, mock_boto, mock_structure, mock_writer):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': key}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+                for key in ('first.jpg', 'second.jpg')
+            ]
+        }
+
+        detections = {'first.jpg': '9781234567897', 'second.jpg': '9780306406157'}
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = lambda Image: {
+            'TextDetections': [{'DetectedText': detections[Image['S3Object']['Name']]}]
+        }
+        mock_boto.return_value = mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+
+        # The writer could not write the object of the second record
+        buffered = []
+        mock_writer.return_value.add.side_effect = buffered.append
+        mock_writer.return_value.close.side_effect = lambda: [
+            item for item in buffered if item['isbn'] == '9780306406157'
+        ]
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        self.assertEqual(
+            [result['status'] for result in response['results']],
+            ['SUCCESS', 'FAILED']
+        )
+        self.assertNotIn('item', response['results'][0])
+
+
+    @patch('src.scripts.handler.BatchWriter')
+    @patch('src.scripts.handler.structure_books_data', MagicMock(return_value={}))
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_sqs_event(self, mock_boto, mock_structure, mock_writer):
+        def message(message_id, *keys):
+            body = {'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': key}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+                for key in keys
+            ]}
+            return {'eventSource': 'aws:sqs', 'messageId': message_id, 'body': json.dumps(body)}
+
+        sqs_event = {
+            'Records': [
+                message('first', 'valid.jpg'),
+                message('second', 'throttled.jpg', 'valid.jpg'),
+                message('third', 'blank.jpg'),
+                {'eventSource': 'aws:sqs', 'messageId': 'test', 'body': json.dumps({'Event': 's3:TestEvent'})}
+            ]
+        }
+
+        def detect_text(Image):
+            if Image['S3Object']['Name'] == 'throttled.jpg':
+                raise ClientError(
+                    {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                    'DetectText'
+                )
+            text = '9780306406157' if Image['S3Object']['Name'] == 'valid.jpg' else 'Untitled'
+            return {'TextDetections': [{'DetectedText': text}]}
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = detect_text
+        mock_boto.return_value = mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+        mock_writer.return_value.close.return_value = []
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(sqs_event, None)
+
+        # Only the message with a retryable failure returns to the queue
+        self.assertEqual(
+            [result['status'] for result in response['results']],
+            ['SUCCESS', 'FAILED', 'SUCCESS', 'FAILED']
+        )
+        self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'second'}])
+
+    @patch('budget._deadline', None)
+    @patch('utils.get_breaker', MagicMock(return_value=CircuitBreaker()))
+    @patch('utils.get_books_session')
+    @patch('src.scripts.handler.BatchWriter')
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_deferred_records(self, mock_boto, mock_writer, mock_books_session):
+        s3_event = {
+            'Records': [
+                {
+                    's3': {
+                        'bucket': {'name': 'my-bucket'},
+                        'object': {'key': 'cover.jpg'}
+                    },
+                    'eventTime': '2025-01-01'
+                }
+            ]
+        }
+        mock_boto.return_value.detect_text.return_value = {'TextDetections': [{'DetectedText': '9780306406157'}]}
+        mock_books_session.return_value.get.side_effect = urllib.error.URLError('Connection failed')
+        mock_writer.return_value.close.return_value = []
+
+        # Lookups which cannot reach Google Books are deferred, failing the event so that S3 retries it
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            with self.assertRaises(DeferredRecordsError):
+                lambda_handler(s3_event, None)
+
+        # Records are not analyzed without time left, and their messages return to the queue
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 500
+        sqs_event = {
+            'Records': [{'eventSource': 'aws:sqs', 'messageId': 'first', 'body': json.dumps(s3_event)}]
+        }
+        mock_boto.return_value.detect_text.reset_mock()
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(sqs_event, context)
+        mock_boto.return_value.detect_text.assert_not_called()
+        self.assertEqual(response['results'][0]['status'], 'DEFERRED')
+        self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'first'}])
+
+    @patch('src.scripts.handler.BatchWriter')
+    @patch("src.scripts.handler.get_client")
+    def test_lambda_handler_slow_detect_text(self, mock_boto, mock_writer):
+        def detect_text(Image):
+            time.sleep(1.0)
+            return {'TextDetections': [{'DetectedText': '9780306406157'}]}
+
+        mock_boto.return_value.detect_text.side_effect = detect_text
+        mock_writer.return_value.close.return_value = []
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 1300
+        sqs_event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': 'slow', 'body': json.dumps({'Records': [
+            {'s3': {'bucket': {'name': 'my-bucket'}, 'object': {'key': 'slow.jpg'}}, 'eventTime': '2025-01-01'}
+        ]})}]}
+
+        # A call of Rekognition which outlasts the budget defers its record instead of running past the deadline
+        start = time.perf_counter()
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(sqs_event, context)
+        self.assertLess(time.perf_counter() - start, 0.8)
+        mock_boto.return_value.detect_text.assert_called_once()
+        self.assertEqual(response['results'][0]['status'], 'DEFERRED')
+        self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'slow'}])
+
+    @patch('src.scripts.handler.BatchWriter')
+    @patch("src.scripts.handler.structure_book_data")
+    @patch("src.scripts.handler.get_client")
+    def test_lookup_handler(self, mock_boto, mock_structure, mock_writer):
+        def api_event(image_bytes):
+            return {
+                'body': base64.b64encode(image_bytes).decode(),
+                'isBase64Encoded': True,
+                'requestContext': {'requestId': 'request-id', 'requestTimeEpoch': 1735689600000}
+            }
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = lambda Image: {
+            'TextDetections': [{'DetectedText': '9780306406157' if Image['Bytes'] == b'cover' else 'Untitled'}]
+        }
+        mock_boto.return_value = mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+        mock_writer.return_value.close.return_value = []
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lookup_handler(api_event(b'cover'), None)
+
+        # The request body is sent to Rekognition as bytes and the book data is returned and loaded
+        mock_rekognition.detect_text.assert_called_once_with(Image={'Bytes': b'cover'})
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(
+            json.loads(response['body']),
+            {'isbn': '9780306406157', 'exception': 0, 'timestamp': '2025-01-01T00:00:00.000Z', 'day': '2025-01-01'}
+        )
+        mock_writer.return_value.add.assert_called_once()
+
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            self.assertEqual(lookup_handler(api_event(b'blank'), None)['statusCode'], 422)
+            self.assertEqual(lookup_handler({'body': None}, None)['statusCode'], 400)
+
+    @patch('src.scripts.bulk.BatchWriter')
+    @patch('handler.structure_book_data') # The bulk module imports the handler module as deployed in Lambda
+    @patch('src.scripts.bulk.get_client')
+    def test_bulk_handler(self, mock_boto, mock_structure, mock_writer):
+        members = {'shelf/a.jpg': b'bulk-cover', 'shelf/b.PNG': b'bulk-blank', 'shelf/notes.txt': b'notes',
+                   'shelf/._a.jpg': b'metadata'}
+        archives = {}
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as archive:
+            for name, data in members.items():
+                archive.writestr(name, data)
+        archives['bulk/shelf.zip'] = zip_buffer.getvalue()
+        tar_buffer = io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w:gz') as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        archives['bulk/shelf.tar.gz'] = tar_buffer.getvalue()
+
+        def get_object(Bucket, Key, Range=None):
+            data = archives[Key]
+            if Range is not None:
+                start, end = map(int, Range.removeprefix('bytes=').split('-'))
+                data = data[start:end + 1]
+            return {'Body': io.BytesIO(data)}
+
+        mock_s3 = MagicMock()
+        mock_s3.head_object.side_effect = lambda Bucket, Key: {'ContentLength': len(archives[Key])}
+        mock_s3.get_object.side_effect = get_object
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = lambda Image: {
+            'TextDetections': [{'DetectedText': '9780306406157' if Image['Bytes'] == b'bulk-cover' else 'Untitled'}]
+        }
+        mock_boto.side_effect = lambda service_name: mock_s3 if service_name == 's3' else mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+        mock_writer.return_value.close.return_value = []
+
+        for key in archives:
+            mock_s3.put_object.reset_mock()
+            event = {'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}},
+                                  'eventTime': '2025-01-01T00:00:00.000Z'}]}
+            with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+                response = bulk_handler(event, None)
+
+            # Only the images are analyzed, and the manifest is written out of the bulk prefix
+            mock_s3.put_object.assert_called_once()
+            kwargs = mock_s3.put_object.call_args.kwargs
+            self.assertEqual(kwargs['Key'], f'bulk-manifests/{key}.manifest.json')
+            manifest = json.loads(kwargs['Body'])
+            self.assertEqual(
+                {member['member']: member['status'] for member in manifest['members']},
+                {'shelf/a.jpg': 'SUCCESS', 'shelf/b.PNG': 'FAILED'}
+            )
+            self.assertEqual(manifest['summary']['succeeded'], 1)
+            self.assertEqual(manifest['summary']['failed'], 1)
+            self.assertTrue(all('analysis_ms' in member and 'load_ms' in member for member in manifest['members']))
+            self.assertEqual(response['manifests'][0]['members'], 2)
+
+        # ZIP archives are read through ranged requests instead of a single download
+        self.assertTrue(all('Range' in call.kwargs for call in mock_s3.get_object.call_args_list
+                            if call.kwargs['Key'].endswith('.zip')))
+
+    @patch('handler.structure_books_data', MagicMock(return_value={}))
+    @patch('src.scripts.bulk.BatchWriter')
+    @patch('handler.structure_book_data')
+    @patch('src.scripts.bulk.get_client')
+    def test_bulk_redrive(self, mock_boto, mock_structure, mock_writer):
+        # Two copies of the same book, and a member whose lookup is deferred on the first run
+        members = {'shelf/a.jpg': b'copy-one', 'shelf/b.jpg': b'copy-two', 'shelf/c.jpg': b'deferred'}
+        tar_buffer = io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w') as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        objects = {'bulk/shelf.tar': tar_buffer.getvalue()}
+
+        mock_s3 = MagicMock()
+        mock_s3.get_object.side_effect = lambda Bucket, Key: {'Body': io.BytesIO(objects[Key])}
+        mock_s3.put_object.side_effect = lambda Bucket, Key, Body, ContentType: objects.__setitem__(Key, Body)
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.side_effect = lambda Image: {
+            'TextDetections': [{'DetectedText': '9789505578931' if Image['Bytes'] == b'deferred' else '9780306406157'}]
+        }
+        mock_boto.side_effect = lambda service_name: mock_s3 if service_name == 's3' else mock_rekognition
+        unavailable = {'9789505578931'}
+        def structure(isbn):
+            if isbn in unavailable:
+                raise sys.modules['providers'].BooksUnavailableError('Google Books is unavailable')
+            return {'isbn': isbn, 'exception': 0}
+        mock_structure.side_effect = structure
+        mock_writer.return_value.close.return_value = []
+
+        event_time = '2025-01-01T00:00:00.000Z'
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            bulk_handler({'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': 'bulk/shelf.tar'}},
+                                       'eventTime': event_time}]}, None)
+
+        # Copies are separate events, and the deferred member is re-driven with its position
+        items = [call.args[0] for call in mock_writer.return_value.add.call_args_list]
+        self.assertEqual([item['timestamp'] for item in items], [f'{event_time}#00000', f'{event_time}#00001'])
+        manifest = json.loads(objects['bulk-manifests/bulk/shelf.tar.manifest.json'])
+        self.assertEqual(manifest['summary']['deferred'], 1)
+        self.assertEqual(manifest['redrive'], 'bulk/shelf.tar.1.redrive.json')
+        request = json.loads(objects['bulk/shelf.tar.1.redrive.json'])
+        self.assertEqual(request, {'archive': 'bulk/shelf.tar', 'event_time': event_time, 'attempt': 1,
+                                   'members': {'shelf/c.jpg': 2}})
+
+        # The request triggers a run of only the deferred member, which keeps its original timestamp
+        unavailable.clear()
+        mock_writer.return_value.add.reset_mock()
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            bulk_handler({'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': 'bulk/shelf.tar.1.redrive.json'}},
+                                       'eventTime': '2025-01-01T00:15:00.000Z'}]}, None)
+        items = [call.args[0] for call in mock_writer.return_value.add.call_args_list]
+        self.assertEqual([(item['isbn'], item['timestamp']) for item in items], [('9789505578931', f'{event_time}#00002')])
+        manifest = json.loads(objects['bulk-manifests/bulk/shelf.tar.1.redrive.json.manifest.json'])
+        self.assertEqual(manifest['summary'], {**manifest['summary'], 'members': 1, 'succeeded': 1, 'deferred': 0})
+        self.assertNotIn('redrive', manifest)
+        self.assertNotIn('bulk/shelf.tar.2.redrive.json', objects)
+
+    @patch('handler.structure_books_data', MagicMock(return_value={}))
+    @patch('src.scripts.bulk.BatchWriter')
+    @patch('handler.structure_book_data')
+    @patch('src.scripts.bulk.get_client')
+    def test_bulk_deadline(self, mock_boto, mock_structure, mock_writer):
+        members = {'shelf/a.jpg': b'first', 'shelf/b.jpg': b'second', 'shelf/c.jpg': b'third'}
+        archives = {}
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as archive:
+            for name, data in members.items():
+                archive.writestr(name, data)
+        archives['bulk/shelf.zip'] = zip_buffer.getvalue()
+        tar_buffer = io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w:gz') as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        archives['bulk/shelf.tar.gz'] = tar_buffer.getvalue()
+
+        def get_object(Bucket, Key, Range=None):
+            data = archives.get(Key, b'')
+            if Range is not None:
+                start, end = map(int, Range.removeprefix('bytes=').split('-'))
+                data = data[start:end + 1]
+            return {'Body': io.BytesIO(data)}
+
+        mock_s3 = MagicMock()
+        mock_s3.head_object.side_effect = lambda Bucket, Key: {'ContentLength': len(archives[Key])}
+        mock_s3.get_object.side_effect = get_object
+        mock_boto.side_effect = lambda service_name: mock_s3 if service_name == 's3' else MagicMock()
+        mock_writer.return_value.close.return_value = []
+
+        for key in archives:
+            mock_s3.put_object.reset_mock()
+            # The budget expires once the first member was read
+            deadline = MagicMock()
+            deadline.expired.side_effect = [False, True, True]
+            with patch('src.scripts.bulk.get_deadline', return_value=deadline), \
+                 patch.object(zipfile.ZipFile, 'read', autospec=True, side_effect=zipfile.ZipFile.read) as zip_read, \
+                 patch.object(tarfile.TarFile, 'extractfile', autospec=True,
+                              side_effect=tarfile.TarFile.extractfile) as tar_extract, \
+                 patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+                bulk_handler({'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}},
+                                           'eventTime': '2025-01-01T00:00:00.000Z'}]}, None)
+
+            # The bodies of the remaining members are never read, but they are listed and re-driven
+            reads = [call.args[1] for call in zip_read.call_args_list + tar_extract.call_args_list]
+            self.assertEqual([getattr(info, 'filename', getattr(info, 'name', None)) for info in reads], ['shelf/a.jpg'])
+            requests = {call.kwargs['Key']: json.loads(call.kwargs['Body']) for call in mock_s3.put_object.call_args_list}
+            manifest = requests[f'bulk-manifests/{key}.manifest.json']
+            self.assertEqual(
+                {member['member']: member['status'] for member in manifest['members']},
+                {'shelf/a.jpg': 'FAILED', 'shelf/b.jpg': 'DEFERRED', 'shelf/c.jpg': 'DEFERRED'}
+            )
+            self.assertEqual(requests[f'{key}.1.redrive.json']['members'], {'shelf/b.jpg': 1, 'shelf/c.jpg': 2})
+
+    @patch('src.scripts.handler.MULTI_BOOK', True)
+    @patch('src.scripts.handler.structure_books_data', MagicMock(return_value={}))
+    @patch('src.scripts.handler.BatchWriter')
+    @patch('src.scripts.handler.structure_book_data')
+    @patch('src.scripts.handler.get_client')
+    def test_lambda_handler_multi_book(self, mock_boto, mock_structure, mock_writer):
+        def detection(text, left):
+            box = {'Left': left, 'Top': 0.5, 'Width': 0.1, 'Height': 0.02}
+            return {'DetectedText': text, 'Type': 'LINE', 'Confidence': 90.0, 'Geometry': {'BoundingBox': box}}
+
+        mock_rekognition = MagicMock()
+        mock_rekognition.detect_text.return_value = {'TextDetections': [
+            detection('ISBN 978-950-557-893-1', 0.1), detection('ISBN 0-306-40615-2', 0.4),
+            detection('ISBN 978-950-557-893-1', 0.7)
+        ]}
+        mock_boto.return_value = mock_rekognition
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+        mock_writer.return_value.close.return_value = []
+
+        s3_event = {'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': 'stack.jpg'}},
+                                 'eventTime': '2025-01-01T00:00:00.000Z'}]}
+        with patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            response = lambda_handler(s3_event, None)
+
+        # A row per book, including copies, whose sort keys share the event time
+        result = response['results'][0]
+        self.assertEqual(result['status'], 'SUCCESS')
+        self.assertEqual(result['isbns'], ['9789505578931', '9780306406157', '9789505578931'])
+        items = [call.args[0] for call in mock_writer.return_value.add.call_args_list]
+        self.assertEqual(
+            sorted((item['isbn'], item['timestamp'], item['day']) for item in items),
+            [('9780306406157', '2025-01-01T00:00:00.000Z#01', '2025-01-01'),
+             ('9789505578931', '2025-01-01T00:00:00.000Z#00', '2025-01-01'),
+             ('9789505578931', '2025-01-01T00:00:00.000Z#02', '2025-01-01')]
+        )
+        self.assertNotIn('items', result)
+
+    @patch('src.scripts.detections.get_client')
+    @patch('src.scripts.handler.BatchWriter')
+    @patch('src.scripts.handler.structure_book_data')
+    @patch('src.scripts.handler.get_client')
+    def test_lambda_handler_detection_archive(self, mock_boto, mock_structure, mock_writer, mock_archive_boto):
+        mock_boto.return_value.detect_text.return_value = {'TextDetections': [
+            {
+                'DetectedText': 'ISBN 978-950-557-893-1', 'Type': 'LINE', 'Id': 0, 'Confidence': 99.123456,
+                'Geometry': {
+                    'BoundingBox': {'Width': 0.31234567, 'Height': 0.02, 'Left': 0.1, 'Top': 0.5},
+                    'Polygon': [{'X': 0.1, 'Y': 0.5}, {'X': 0.41, 'Y': 0.5}, {'X': 0.41, 'Y': 0.52}, {'X': 0.1, 'Y': 0.52}]
+                }
+            },
+            {'DetectedText': 'ISBN', 'Type': 'WORD', 'Id': 1, 'ParentId': 0, 'Confidence': 99.5}
+        ]}
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+        mock_writer.return_value.close.return_value = []
+        mock_s3 = mock_archive_boto.return_value
+
+        s3_event = {'Records': [{
+            's3': {'bucket': {'name': 'bucket'}, 'object': {'key': 'cover.jpg', 'eTag': '"0123456789abcdef"'}},
+            'eventTime': '2025-01-01T00:00:00.000Z'
+        }]}
+        with patch('detections._archive', DetectionArchive('detections-bucket')), \
+             patch.dict(os.environ, {'TABLE_NAME': 'table-example'}):
+            lambda_handler(s3_event, None)
+            # A re-uploaded image is served by the dedup cache, without detections to archive
+            lambda_handler(s3_event, None)
+
+        # The detections of the invocation are written as compact JSONL, partitioned by the day of the event
+        mock_s3.put_object.assert_called_once()
+        request = mock_s3.put_object.call_args.kwargs
+        self.assertEqual(request['Bucket'], 'detections-bucket')
+        self.assertRegex(request['Key'], r'^detections/dt=2025-01-01/\d{6}-[0-9a-f]{12}\.jsonl\.gz$')
+        entries = [json.loads(line) for line in gzip.decompress(request['Body']).splitlines()]
+        self.assertEqual(entries, [{
+            'bucket': 'bucket',
+            'key': 'cover.jpg',
+            'event_time': '2025-01-01T00:00:00.000Z',
+            'isbns': ['9789505578931'],
+            'etag': '0123456789abcdef',
+            'keys': [{'isbn': '9789505578931', 'timestamp': '2025-01-01T00:00:00.000Z'}],
+            'detections': [
+                {
+                    'DetectedText': 'ISBN 978-950-557-893-1', 'Type': 'LINE', 'Confidence': 99.12,
+                    'Geometry': {'BoundingBox': {'Width': 0.31235, 'Height': 0.02, 'Left': 0.1, 'Top': 0.5}}
+                },
+                {'DetectedText': 'ISBN', 'Type': 'WORD', 'Confidence': 99.5}
+            ]
+        }])
+        self.assertEqual(get_metrics().records('detections')[-1]['records'], 1)
+
+    def test_lambda_handler_empty_sqs_event(self):
+        sqs_event = {
+            'Records': [
+                {'eventSource': 'aws:sqs', 'messageId': 'test', 'body': json.dumps({'Event': 's3:TestEvent'})}
+            ]
+        }
+        self.assertEqual(lambda_handler(sqs_event, None), {'results': [], 'batchItemFailures': []})
+
+
+@unittest.skipUnless(CDK_AVAILABLE, 'AWS CDK is not installed')
+class TestStack(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        def synthesize(**options):
+            with patch.multiple(stack, **options):
+                return Template.from_stack(stack.isbnProcessorStack(aws_cdk.App(), 'test-stack'))
+
+        cls.templates = {
+            'direct': synthesize(ENABLE_QUEUE=False, PROVISIONED_CONCURRENCY=0,
+                                 configured_billing=dynamodb.BillingMode.PROVISIONED, AUTO_SCALING=True,
+                                 warm_throughput=None, ENABLE_LOOKUP=True, ENABLE_BULK=True),
+            'on_demand': synthesize(ENABLE_QUEUE=False, PROVISIONED_CONCURRENCY=0,
+                                    configured_billing=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                    warm_throughput=dynamodb.WarmThroughput(read_units_per_second=12000,
+                                                                            write_units_per_second=4000)),
+            'queue': synthesize(ENABLE_QUEUE=True, PROVISIONED_CONCURRENCY=0),
+            'provisioned': synthesize(ENABLE_QUEUE=True, PROVISIONED_CONCURRENCY=2)
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            catalog_layer_file = Path(directory) / 'catalog-layer.zip'
+            with zipfile.ZipFile(catalog_layer_file, 'w') as layer:
+                layer.writestr('catalog/isbn.idx', b'')
+            cls.templates['catalog'] = synthesize(ENABLE_QUEUE=False, PROVISIONED_CONCURRENCY=0,
+                                                  catalog_layer_file=catalog_layer_file)
+
+    def test_detect_text_filters(self):
+        # The word filters are optional, so the default configuration sends every detection to the parsers
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_processor',
+            'Environment': {'Variables': Match.object_like({
+                'MIN_CONFIDENCE': '', 'MIN_BOUNDING_BOX_HEIGHT': '', 'REGIONS_OF_INTEREST': ''
+            })}
+        })
+
+    def test_cold_start_options(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_processor',
+            'MemorySize': stack.LAMBDA_MEMORY_SIZE,
+            'Timeout': stack.LAMBDA_TIMEOUT_SECONDS,
+            'Architectures': [stack.LAMBDA_ARCHITECTURE],
+            'Environment': {'Variables': Match.object_like({'INIT_CLIENTS': 'true'})}
+        })
+        template.resource_count_is('AWS::Lambda::Alias', 0)
+
+        # The queue is consumed by the alias which keeps the provisioned containers
+        template = self.templates['provisioned']
+        template.has_resource_properties('AWS::Lambda::Alias', {
+            'Name': 'live',
+            'ProvisionedConcurrencyConfig': {'ProvisionedConcurrentExecutions': 2}
+        })
+        mappings = template.find_resources('AWS::Lambda::EventSourceMapping')
+        self.assertIn(':live', json.dumps(list(mappings.values())))
+
+    def test_provisioned_capacity(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_events',
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': stack.READ_CAPACITY,
+                'WriteCapacityUnits': stack.WRITE_CAPACITY
+            }
+        })
+        # Read and write capacity of the table and each of its two indexes
+        template.resource_count_is('AWS::ApplicationAutoScaling::ScalableTarget', 6)
+        for dimension, min_capacity, max_capacity in (
+            ('dynamodb:table:ReadCapacityUnits', stack.READ_CAPACITY, stack.MAX_READ_CAPACITY),
+            ('dynamodb:table:WriteCapacityUnits', stack.WRITE_CAPACITY, stack.MAX_WRITE_CAPACITY)
+        ):
+            template.has_resource_properties('AWS::ApplicationAutoScaling::ScalableTarget', {
+                'ScalableDimension': dimension,
+                'MinCapacity': min_capacity,
+                'MaxCapacity': max_capacity
+            })
+        template.has_resource_properties('AWS::ApplicationAutoScaling::ScalingPolicy', {
+            'PolicyType': 'TargetTrackingScaling',
+            'TargetTrackingScalingPolicyConfiguration': Match.object_like({
+                'TargetValue': stack.TARGET_UTILIZATION
+            })
+        })
+
+    def test_on_demand_capacity(self):
+        template = self.templates['on_demand']
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_events',
+            'BillingMode': 'PAY_PER_REQUEST',
+            'ProvisionedThroughput': Match.absent(),
+            'WarmThroughput': {'ReadUnitsPerSecond': 12000, 'WriteUnitsPerSecond': 4000}
+        })
+        template.resource_count_is('AWS::ApplicationAutoScaling::ScalableTarget', 0)
+
+    def test_staged_indexes(self):
+        # Existing tables get one new index per deploy, starting with the day index
+        with patch.multiple(stack, EVENT_INDEXES=[stack.DAY_INDEX_NAME]):
+            template = Template.from_stack(stack.isbnProcessorStack(aws_cdk.App(), 'test-stack'))
+        tables = template.find_resources('AWS::DynamoDB::Table', {'Properties': {'TableName': 'isbn_events'}})
+        [table] = tables.values()
+        self.assertEqual(
+            [index['IndexName'] for index in table['Properties']['GlobalSecondaryIndexes']], [stack.DAY_INDEX_NAME]
+        )
+
+    def test_read_indexes(self):
+        template = self.templates['on_demand']
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_events',
+            'GlobalSecondaryIndexes': Match.array_with([
+                Match.object_like({
+                    'IndexName': stack.DAY_INDEX_NAME,
+                    'KeySchema': [
+                        {'AttributeName': 'day', 'KeyType': 'HASH'},
+                        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'}
+                }),
+                Match.object_like({
+                    'IndexName': stack.EXCEPTION_INDEX_NAME,
+                    'KeySchema': [
+                        {'AttributeName': 'exception_day', 'KeyType': 'HASH'},
+                        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                    ],
+                    'Projection': {'ProjectionType': 'KEYS_ONLY'}
+                })
+            ])
+        })
+
+    def test_image_hashes_table(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_image_hashes',
+            'BillingMode': 'PAY_PER_REQUEST',
+            'KeySchema': [{'AttributeName': 'content_hash', 'KeyType': 'HASH'}],
+            'TimeToLiveSpecification': {'AttributeName': 'expires_at', 'Enabled': True}
+        })
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'Environment': {'Variables': Match.object_like({
+                'DEDUP_TABLE_NAME': Match.any_value(),
+                'DEDUP_TTL': str(stack.DEDUP_TTL_DAYS * 24 * 3600)
+            })}
+        })
+
+    def test_detections_archive(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::S3::Bucket', {
+            'BucketName': stack.ARCHIVE_BUCKET_NAME,
+            'LifecycleConfiguration': {'Rules': [Match.object_like({
+                'Transitions': [{'StorageClass': 'GLACIER_IR', 'TransitionInDays': stack.ARCHIVE_TRANSITION_DAYS}]
+            })]}
+        })
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_processor',
+            'Environment': {'Variables': Match.object_like({
+                'DETECTIONS_BUCKET': Match.any_value(),
+                'DETECTIONS_PREFIX': stack.ARCHIVE_PREFIX
+            })}
+        })
+
+    def test_book_providers(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_processor',
+            'Environment': {'Variables': Match.object_like({
+                'BOOK_PROVIDERS': ','.join(stack.BOOK_PROVIDERS),
+                'HEDGE_PERCENTILE': str(stack.HEDGE_PERCENTILE),
+                'HEDGE_DELAY_MS': str(stack.HEDGE_DELAY_MS)
+            })}
+        })
+
+    def test_lookup_endpoint(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_lookup',
+            'Handler': 'handler.lookup_handler',
+            'Timeout': min(stack.LAMBDA_TIMEOUT_SECONDS, 29)
+        })
+        template.has_resource_properties('AWS::ApiGateway::Resource', {'PathPart': 'lookup'})
+        template.has_resource_properties('AWS::ApiGateway::Method', {
+            'HttpMethod': 'POST',
+            'Integration': Match.object_like({'Type': 'AWS_PROXY', 'IntegrationHttpMethod': 'POST'})
+        })
+
+    def test_direct_s3_events(self):
+        template = self.templates['direct']
+        template.resource_count_is('AWS::SQS::Queue', 0)
+
+        # The only event source mapping is the one of the table stream
+        mappings = template.find_resources('AWS::Lambda::EventSourceMapping')
+        self.assertTrue(all('StartingPosition' in mapping['Properties'] for mapping in mappings.values()))
+        template.has_resource_properties('Custom::S3BucketNotifications', {
+            'NotificationConfiguration': {
+                'LambdaFunctionConfigurations': Match.array_with([Match.object_like({'Events': ['s3:ObjectCreated:Put']})])
+            }
+        })
+
+    def test_aggregates_stream(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_events',
+            'StreamSpecification': {'StreamViewType': 'NEW_AND_OLD_IMAGES'}
+        })
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_aggregates',
+            'KeySchema': [{'AttributeName': 'pk', 'KeyType': 'HASH'}]
+        })
+
+        template.has_resource_properties('AWS::DynamoDB::Table', {
+            'TableName': 'isbn_aggregates',
+            'TimeToLiveSpecification': {'AttributeName': 'expires_at', 'Enabled': True}
+        })
+
+        # The consumer has a role of its own, which is the only one granted the aggregates table
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_aggregates',
+            'Role': {'Fn::GetAtt': [Match.string_like_regexp('AggregatesExecutionRole'), 'Arn']}
+        })
+        policies = [
+            policy for policy in template.find_resources('AWS::IAM::Policy').values()
+            if 'dynamodb:UpdateItem' in json.dumps(policy['Properties']['PolicyDocument'])
+        ]
+        self.assertEqual(len(policies), 1)
+        self.assertEqual(len(policies[0]['Properties']['Roles']), 1)
+        self.assertIn('AggregatesExecutionRole', policies[0]['Properties']['Roles'][0]['Ref'])
+
+        # Only the inserted and removed events, and the rewritten ones whose exception changed, reach the consumer
+        [mapping] = template.find_resources('AWS::Lambda::EventSourceMapping').values()
+        self.assertEqual(
+            (mapping['Properties']['BatchSize'], mapping['Properties']['StartingPosition'],
+             mapping['Properties']['MaximumRetryAttempts']),
+            (stack.AGGREGATE_BATCH_SIZE, 'TRIM_HORIZON', stack.AGGREGATE_RETRY_ATTEMPTS)
+        )
+        patterns = [json.loads(pattern['Pattern']) for pattern in mapping['Properties']['FilterCriteria']['Filters']]
+        self.assertEqual(patterns[:2], [{'eventName': ['INSERT']}, {'eventName': ['REMOVE']}])
+        self.assertEqual(patterns[2], {
+            'eventName': ['MODIFY'],
+            'dynamodb': {'OldImage': {'exception': {'N': ['0']}}, 'NewImage': {'exception': {'N': ['1']}}}
+        })
+        self.assertEqual(len(patterns), 4)
+
+    def test_catalog_layer(self):
+        self.templates['direct'].resource_count_is('AWS::Lambda::LayerVersion', 0)
+
+        # Every function gets the layer, whose index is found at its default path under /opt
+        template = self.templates['catalog']
+        template.resource_count_is('AWS::Lambda::LayerVersion', 1)
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_processor',
+            'Layers': [Match.object_like({'Ref': Match.string_like_regexp('CatalogLayer')})]
+        })
+
+    def test_bulk_archives(self):
+        template = self.templates['direct']
+        template.has_resource_properties('AWS::Lambda::Function', {
+            'FunctionName': 'isbn_bulk',
+            'Handler': 'bulk.bulk_handler',
+            'Timeout': stack.BULK_TIMEOUT_SECONDS,
+            'Environment': {'Variables': Match.object_like({'MANIFEST_PREFIX': stack.MANIFEST_PREFIX})}
+        })
+
+        # Images and archives are sent to their functions by notifications which do not overlap
+        configurations = template.find_resources('Custom::S3BucketNotifications')
+        configurations = list(configurations.values())[0]['Properties']['NotificationConfiguration']
+        filters = [
+            (configuration['Events'], {rule['Name']: rule['Value'] for rule in configuration['Filter']['Key']['FilterRules']})
+            for configuration in configurations['LambdaFunctionConfigurations']
+        ]
+        self.assertEqual(len(filters), len(stack.IMAGE_SUFFIXES) + len(stack.ARCHIVE_SUFFIXES) + 1)
+        self.assertIn((['s3:ObjectCreated:*'], {'prefix': stack.BULK_PREFIX, 'suffix': stack.REDRIVE_SUFFIX}), filters)
+        self.assertIn((['s3:ObjectCreated:*'], {'prefix': stack.BULK_PREFIX, 'suffix': '.zip'}), filters)
+        self.assertIn((['s3:ObjectCreated:Put'], {'suffix': '.jpg'}), filters)
+
+        template.has_resource_properties('AWS::IAM::Role', {
+            'Policies': Match.array_with([Match.object_like({
+                'PolicyDocument': {'Statement': Match.array_with([Match.object_like({'Action': 's3:PutObject'})])}
+            })])
+        })
+
+    def test_latency_alarms(self):
+        template = self.templates['direct']
+        template.resource_count_is('AWS::CloudWatch::Alarm', len(stack.P99_ALARM_THRESHOLDS))
+        for stage, threshold in stack.P99_ALARM_THRESHOLDS.items():
+            template.has_resource_properties('AWS::CloudWatch::Alarm', {
+                'Namespace': stack.METRICS_NAMESPACE,
+                'MetricName': 'Duration',
+                'Dimensions': [{'Name': 'Stage', 'Value': stage}],
+                'ExtendedStatistic': 'p99',
+                'Threshold': threshold,
+                'ComparisonOperator': 'GreaterThanThreshold'
+            })
+
+    def test_queue_mode(self):
+        template = self.templates['queue']
+        template.resource_count_is('AWS::SQS::Queue', 2)
+        template.has_resource_properties('AWS::SQS::Queue', {
+            'QueueName': 'isbn_images',
+            'VisibilityTimeout': stack.LAMBDA_TIMEOUT_SECONDS * 6,
+            'RedrivePolicy': {
+                'deadLetterTargetArn': Match.any_value(),
+                'maxReceiveCount': stack.QUEUE_MAX_RECEIVE_COUNT
+            }
+        })
+        template.has_resource_properties('AWS::SQS::Queue', {
+            'QueueName': 'isbn_images_dlq',
+            'MessageRetentionPeriod': 14 * 24 * 3600
+        })
+        template.has_resource_properties('AWS::Lambda::EventSourceMapping', {
+            'BatchSize': stack.QUEUE_BATCH_SIZE,
+            'MaximumBatchingWindowInSeconds': stack.QUEUE_BATCHING_WINDOW,
+            'ScalingConfig': {'MaximumConcurrency': stack.QUEUE_MAX_CONCURRENCY},
+            'FunctionResponseTypes': ['ReportBatchItemFailures']
+        })
+        template.has_resource_properties('Custom::S3BucketNotifications', {
+            'NotificationConfiguration': {
+                'QueueConfigurations': Match.array_with([Match.object_like({'Events': ['s3:ObjectCreated:Put']})])
+            }
+        })
+
+
+class TestBackfill(unittest.TestCase):
+    @patch('tools.backfill.BatchWriter')
+    @patch('tools.backfill.load_record', lambda result, record, writer, book_data: result)
+    @patch('tools.backfill.lookup_books', MagicMock(return_value={}))
+    @patch('tools.backfill.analyze_record')
+    @patch('tools.backfill.get_books_session')
+    @patch('tools.backfill.get_client')
+    def test_resume_from_checkpoint(self, mock_boto, mock_books_session, mock_process, mock_writer):
+        mock_writer.return_value.close.return_value = []
+        mock_process.side_effect = lambda record, rekognition, image_bytes: {
+            'key': record['s3']['object']['key'],
+            'status': 'FAILED' if image_bytes == b'broken' else 'SUCCESS'
+        }
+
+        with tempfile.TemporaryDirectory() as directory:
+            images_path = Path(directory) / 'images'
+            images_path.mkdir()
+            for name, content in (('a.jpg', b'a'), ('b.png', b'b'), ('c.jpg', b'broken'), ('notes.txt', b'')):
+                (images_path / name).write_bytes(content)
+
+            # The first image was already loaded by an interrupted run
+            checkpoint_path = Path(directory) / 'checkpoint.jsonl'
+            checkpoint_path.write_text(json.dumps({'source_id': str(images_path / 'a.jpg'), 'status': 'SUCCESS'}) + '\n')
+
+            summary = backfill(str(images_path), 'table-example', Checkpoint(checkpoint_path), workers=2, chunk_size=1)
+            self.assertEqual(
+                {key: summary[key] for key in ('processed', 'succeeded', 'failed', 'skipped')},
+                {'processed': 2, 'succeeded': 1, 'failed': 1, 'skipped': 1}
+            )
+            self.assertIn('images_per_sec', summary)
+
+            # Local images are sent as bytes with S3-like timestamps
+            record = mock_process.call_args_list[0].args[0]
+            self.assertRegex(record['eventTime'], r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z$')
+
+            # A new run only retries the failed image
+            summary = backfill(str(images_path), 'table-example', Checkpoint(checkpoint_path))
+            self.assertEqual((summary['processed'], summary['skipped']), (1, 2))
+
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        get_isbn_cache().clear()
+
+    def _write_archive(self, path):
+        # Archive three images as the handler would: one parsed as it is today, one parsed with
+        # a different number by an earlier parser, whose item has the ISBN-10 of the provider as
+        # its key, and one without any number
+        def detection(text):
+            box = {'Left': 0.1, 'Top': 0.5, 'Width': 0.3, 'Height': 0.02}
+            return {'DetectedText': text, 'Type': 'LINE', 'Id': 0, 'Confidence': 95.0, 'Geometry': {'BoundingBox': box}}
+
+        archive = DetectionArchive('detections-bucket')
+        for key, text, isbns, keys in (
+            ('same.jpg', 'ISBN 978-950-557-893-1', ['9789505578931'], ['9789505578931']),
+            ('changed.jpg', 'ISBN 0-306-40615-2', ['9789876290500'], ['9876290509']),
+            ('blank.jpg', 'Chapter 1', [], [])
+        ):
+            record = {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}}, 'eventTime': '2025-01-01T00:00:00.000Z'}
+            entry = archive.add(record, [detection(text)], isbns)
+            entry['keys'] = [{'isbn': isbn, 'timestamp': record['eventTime']} for isbn in keys]
+
+        with patch('src.scripts.detections.get_client') as mock_boto:
+            [key] = archive.flush()
+            body = mock_boto.return_value.put_object.call_args.kwargs['Body']
+        archive_path = path / key
+        archive_path.parent.mkdir(parents=True)
+        archive_path.write_bytes(body)
+
+    @patch('tools.replay.get_table')
+    @patch('tools.replay.BatchWriter')
+    @patch('tools.replay.lookup_books', MagicMock(return_value={}))
+    @patch('handler.structure_book_data')
+    def test_replay(self, mock_structure, mock_writer, mock_table):
+        mock_structure.side_effect = lambda isbn: {'isbn': isbn, 'exception': 0}
+        mock_writer.return_value.close.return_value = []
+        mock_table.return_value.delete_item.return_value = {'Attributes': {'isbn': '9789876290500'}}
+
+        with tempfile.TemporaryDirectory() as directory:
+            self._write_archive(Path(directory))
+
+            # A dry run only reports the images whose numbers changed
+            summary = replay(directory, 'table-example', workers=2, dry_run=True)
+            self.assertEqual(
+                {key: summary[key] for key in ('archives', 'images', 'changed', 'no_isbn', 'items')},
+                {'archives': 1, 'images': 3, 'changed': 1, 'no_isbn': 1, 'items': 0}
+            )
+            mock_writer.assert_not_called()
+
+            # Partitions out of the range of days are skipped
+            self.assertEqual(replay(directory, 'table-example', start_day='2025-01-02', dry_run=True)['images'], 0)
+
+            summary = replay(directory, 'table-example', workers=2)
+
+        # Items are written under the keys of the original events, and the stale item is deleted
+        self.assertEqual((summary['succeeded'], summary['items'], summary['deleted']), (2, 2, 1))
+        items = [call.args[0] for call in mock_writer.return_value.add.call_args_list]
+        self.assertEqual(
+            sorted((item['isbn'], item['timestamp']) for item in items),
+            [('9780306406157', '2025-01-01T00:00:00.000Z'), ('9789505578931', '2025-01-01T00:00:00.000Z')]
+        )
+        mock_table.return_value.delete_item.assert_called_once_with(
+            Key={'isbn': '9876290509', 'timestamp': '2025-01-01T00:00:00.000Z'}, ReturnValues='ALL_OLD'
+        )
+
+    def test_stale_keys(self):
+        written = [{'isbn': '9780306406157', 'timestamp': '2025-01-01T00:00:00.000Z#01'}]
+        entry = {'event_time': '2025-01-01T00:00:00.000Z', 'isbns': ['9789876290500', '9780306406157']}
+
+        # Entries archived without keys rebuild them from the parsed numbers and their positions
+        self.assertEqual(stale_keys(entry, written), [{'isbn': '9789876290500', 'timestamp': '2025-01-01T00:00:00.000Z#00'}])
+        entry['keys'] = [
+            {'isbn': '9876290509', 'timestamp': '2025-01-01T00:00:00.000Z#00'},
+            {'isbn': '9780306406157', 'timestamp': '2025-01-01T00:00:00.000Z#01'}
+        ]
+        self.assertEqual(stale_keys(entry, written), [{'isbn': '9876290509', 'timestamp': '2025-01-01T00:00:00.000Z#00'}])
+
+
+class TestQuery(unittest.TestCase):
+    @patch('tools.query.get_table')
+    def test_query_events_by_day(self, mock_table):
+        # The first day has two pages and the second day has none
+        mock_table.return_value.query.side_effect = [
+            {'Items': [{'isbn': '9789876290500', 'year': Decimal('2011')}], 'LastEvaluatedKey': {'isbn': '9789876290500'}},
+            {'Items': [{'isbn': '9788433967558', 'year': Decimal('2011')}]},
+            {'Items': []}
+        ]
+
+        items = list(query_events('table-example', date(2025, 1, 1), date(2025, 1, 2), language='es', year=2011))
+        self.assertEqual(items, [{'isbn': '9789876290500', 'year': 2011}, {'isbn': '9788433967558', 'year': 2011}])
+
+        calls = mock_table.return_value.query.call_args_list
+        self.assertEqual([call.kwargs['IndexName'] for call in calls], ['day-index'] * 3)
+        self.assertEqual(calls[1].kwargs['ExclusiveStartKey'], {'isbn': '9789876290500'})
+        self.assertNotIn('ExclusiveStartKey', calls[2].kwargs)
+        self.assertIn('FilterExpression', calls[0].kwargs)
+
+    @patch('tools.query.get_table')
+    def test_read_aggregates(self, mock_table):
+        items = {'isbn#9789876290500': {'events': Decimal('3'), 'not_found': Decimal('0')},
+                 'day#2025-01-01': {'events': Decimal('8'), 'not_found': Decimal('2')}}
+        mock_table.return_value.get_item.side_effect = lambda Key: {'Item': items[Key['pk']]} if Key['pk'] in items else {}
+
+        self.assertEqual(isbn_count('9789876290500'), 3)
+        self.assertEqual(day_stats(date(2025, 1, 1)), {'events': 8, 'not_found': 2, 'not_found_rate': 0.25})
+        self.assertEqual(day_stats(date(2025, 1, 2)), {'events': 0, 'not_found': 0, 'not_found_rate': 0.0})
+        mock_table.assert_called_with('isbn_aggregates')
+
+    @patch('tools.query.get_table')
+    def test_query_exceptions(self, mock_table):
+        mock_table.return_value.query.return_value = {'Items': [{'isbn': '9742544919120'}]}
+        items = list(query_exceptions('table-example', date(2025, 1, 1), date(2025, 1, 7)))
+        self.assertEqual(len(items), 7)
+        self.assertEqual(mock_table.return_value.query.call_args.kwargs['IndexName'], 'exception-index')
+
+    @patch('tools.query.get_table')
+    def test_export_jsonl(self, mock_table):
+        # Each segment returns two pages of two items
+        def scan(Segment, TotalSegments, ExclusiveStartKey=None, **kwargs):
+            page = 1 if ExclusiveStartKey else 0
+            items = [{'isbn': f'{Segment}-{page}-{index}', 'page_count': Decimal('398')} for index in range(2)]
+            return {'Items': items} if page else {'Items': items, 'LastEvaluatedKey': {'isbn': items[-1]['isbn']}}
+        mock_table.return_value.scan.side_effect = scan
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'events.jsonl.gz'
+            summary = export_table('table-example', path, segments=3)
+            with gzip.open(path, 'rt') as file:
+                items = [json.loads(line) for line in file]
+
+        self.assertEqual(summary, {'items': 12, 'pages': 6})
+        self.assertEqual(len({item['isbn'] for item in items}), 12)
+        self.assertTrue(all(item['page_count'] == 398 for item in items))
+
+    def test_export_invalid_format(self):
+        with self.assertRaises(ValueError):
+            export_table('table-example', Path('events.csv'), file_format='csv')
+
+    @patch('tools.query.get_table')
+    def test_backfill_days(self, mock_table):
+        items = [
+            {'isbn': '9789876290500', 'timestamp': '2024-12-31T10:00:00.000Z', 'exception': Decimal('0')},
+            {'isbn': '9742544919120', 'timestamp': '2024-12-31T11:00:00.000Z', 'exception': Decimal('1')},
+            {'isbn': '9780306406157', 'timestamp': '2024-12-31T12:00:00.000Z', 'exception': Decimal('0')}
+        ]
+        mock_table.return_value.scan.return_value = {'Items': items}
+        mock_table.return_value.update_item.side_effect = [
+            {}, {}, ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'Deleted'}}, 'UpdateItem')
+        ]
+
+        # Only the items without a day are scanned, and items deleted since the scan are skipped
+        summary = backfill_days('table-example', segments=1)
+        self.assertEqual(summary, {'updated': 2, 'exceptions': 1})
+        self.assertIn('FilterExpression', mock_table.return_value.scan.call_args.kwargs)
+
+        requests = [call.kwargs for call in mock_table.return_value.update_item.call_args_list]
+        self.assertEqual(requests[0]['UpdateExpression'], 'SET #day = :day')
+        self.assertEqual(requests[1]['UpdateExpression'], 'SET #day = :day, exception_day = :day')
+        self.assertEqual(requests[1]['ExpressionAttributeValues'], {':day': '2024-12-31'})
+
+
+class TestAggregates(unittest.TestCase):
+    @staticmethod
+    def stream_record(sequence, isbn, timestamp, exception=0, event_name='INSERT', old_exception=None):
+        def image(exception):
+            return {
+                'isbn': {'S': isbn}, 'timestamp': {'S': timestamp},
+                'day': {'S': timestamp[:10]}, 'exception': {'N': str(exception)}
+            }
+
+        images = {'SequenceNumber': str(sequence)}
+        if event_name != 'REMOVE':
+            images['NewImage'] = image(exception)
+        if event_name != 'INSERT':
+            images['OldImage'] = image(exception if old_exception is None else old_exception)
+        return {'eventName': event_name, 'dynamodb': images}
+
+    def test_coalesce(self):
+        records = [
+            self.stream_record(1, '9789876290500', '2025-01-01T00:00:00.000Z'),
+            self.stream_record(2, '9789876290500', '2025-01-01T00:00:01.000Z'),
+            self.stream_record(3, '9780306406157', '2025-01-02T00:00:00.000Z', exception=1),
+            self.stream_record(4, '9789876290500', '2025-01-01T00:00:00.000Z', event_name='MODIFY')
+        ]
+        increments = coalesce(records)
+        self.assertEqual(increments['isbn#9789876290500'], {'events': 2, 'not_found': 0})
+        self.assertEqual(increments['day#2025-01-01'], {'events': 2, 'not_found': 0})
+        self.assertEqual(increments['day#2025-01-02'], {'events': 1, 'not_found': 1})
+        self.assertEqual(increments['exception#1'], {'events': 1, 'not_found': 1})
+        self.assertEqual(len(increments), 6)
+
+        # Removed items are subtracted, and rewritten items only move between the exception flags
+        records = [
+            self.stream_record(5, '9789876290500', '2025-01-01T00:00:00.000Z', event_name='REMOVE'),
+            self.stream_record(6, '9780306406157', '2025-01-02T00:00:00.000Z', event_name='MODIFY', old_exception=1)
+        ]
+        increments = coalesce(records)
+        self.assertEqual(increments['isbn#9789876290500'], {'events': -1, 'not_found': 0})
+        self.assertEqual(increments['isbn#9780306406157'], {'events': 0, 'not_found': -1})
+        self.assertEqual(increments['day#2025-01-02'], {'events': 0, 'not_found': -1})
+        self.assertEqual(increments['exception#1'], {'events': -1, 'not_found': -1})
+
+        # Keys whose changes cancel out are not updated
+        self.assertNotIn('exception#0', increments)
+        self.assertEqual(len(increments), 5)
+
+    @patch('src.scripts.aggregates.get_table')
+    def test_aggregate_handler(self, mock_table):
+        event = {'Records': [
+            self.stream_record(sequence, '9789876290500', '2025-01-01T00:00:00.000Z') for sequence in range(50)
+        ]}
+        self.assertEqual(aggregate_handler(event, None), {'records': 50, 'updated': 3})
+
+        # A burst of events results in a single transaction, with the marker of the batch and an update per key
+        actions = mock_table.return_value.transact_write_items.call_args.kwargs['TransactItems']
+        marker = actions[0]['Put']
+        self.assertTrue(marker['Item']['pk'].startswith('batch#'))
+        self.assertEqual(marker['ConditionExpression'], 'attribute_not_exists(pk)')
+        self.assertGreater(marker['Item']['expires_at'], time.time())
+        updates = [action['Update'] for action in actions[1:]]
+        self.assertEqual([update['Key']['pk'] for update in updates],
+                         ['day#2025-01-01', 'exception#0', 'isbn#9789876290500'])
+        self.assertTrue(all(update['ExpressionAttributeValues'][':events'] == 50 for update in updates))
+
+        # A retried batch finds its marker, even after other batches updated the same keys
+        mock_table.return_value.transact_write_items.side_effect = ClientError(
+            {
+                'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                'CancellationReasons': [{'Code': 'ConditionalCheckFailed'}, *[{'Code': 'None'}] * 3]
+            },
+            'TransactWriteItems'
+        )
+        self.assertEqual(aggregate_handler(event, None), {'records': 50, 'updated': 0})
+
+    @patch('src.scripts.aggregates.get_table')
+    def test_aggregate_handler_parts(self, mock_table):
+        conflict = ClientError(
+            {
+                'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                'CancellationReasons': [{'Code': 'None'}, {'Code': 'TransactionConflict'}]
+            },
+            'TransactWriteItems'
+        )
+        mock_table.return_value.transact_write_items.side_effect = [conflict, {}, {}]
+        event = {'Records': [
+            self.stream_record(sequence, f'978{sequence:010d}', '2025-01-01T00:00:00.000Z') for sequence in range(100)
+        ]}
+
+        # 102 keys are written by two transactions, each with the marker of its part, and conflicts are retried
+        self.assertEqual(aggregate_handler(event, None), {'records': 100, 'updated': 102})
+        calls = mock_table.return_value.transact_write_items.call_args_list
+        self.assertEqual(len(calls), 3)
+        markers = {call.kwargs['TransactItems'][0]['Put']['Item']['pk'] for call in calls}
+        self.assertEqual(len(markers), 2)
+        self.assertTrue(all(len(call.kwargs['TransactItems']) <= 100 for call in calls))
+
+
+class TestCatalog(unittest.TestCase):
+    BOOK = {
+        'isbn': '9780306406157', 'authors': ['Author'], 'title': 'Title', 'categories': ['Fiction'],
+        'page_count': 100, 'language': 'EN', 'publisher': 'Publisher', 'year': 2011, 'exception': 0
+    }
+
+    def test_index_lookup(self):
+        books = [self.BOOK, {**self.BOOK, 'isbn': '9789876290500', 'title': 'Other'}, {**self.BOOK, 'isbn': '0-8044-2957-X'}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'isbn.idx'
+            self.assertEqual(write_index(books, path), 3)
+            index = CatalogIndex(path)
+
+            # ISBN-10 numbers are stored and looked up by their ISBN-13 form
+            self.assertEqual(index.get('0306406152'), self.BOOK)
+            self.assertEqual(index.get('9789876290500')['title'], 'Other')
+            self.assertEqual(index.get('080442957X')['isbn'], '9780804429573')
+            self.assertIsNone(index.get('9781234567897'))
+            self.assertIsNone(index.get('123'))
+            index.close()
+
+            path.write_bytes(b'not an index')
+            with self.assertRaises(ValueError):
+                CatalogIndex(path)
+
+    @patch('src.scripts.utils.get_books_session')
+    def test_structure_book_data_from_catalog(self, mock_books_session):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'isbn.idx'
+            write_index([self.BOOK], path)
+            index = CatalogIndex(path)
+            with patch('src.scripts.utils.get_catalog', return_value=index):
+                self.assertEqual(structure_book_data('9780306406157'), self.BOOK)
+                self.assertEqual(structure_books_data(['9780306406157']), {'9780306406157': self.BOOK})
+            index.close()
+
+        # Books of the catalog never reach the Google Books API
+        mock_books_session.assert_not_called()
+
+    def test_build_catalog(self):
+        events = [
+            {**self.BOOK, 'title': 'Old title', 'timestamp': '2025-01-01T00:00:00.000Z'},
+            {**self.BOOK, 'timestamp': '2025-01-02T00:00:00.000Z', 'day': '2025-01-02'},
+            {'isbn': '9789876290500', 'exception': 1, 'timestamp': '2025-01-01T00:00:00.000Z'},
+            # Identifiers of other types stored as the number of a found book are skipped instead of failing the build
+            {**self.BOOK, 'isbn': 'UCAL:B4515181', 'timestamp': '2025-01-03T00:00:00.000Z'}
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            dump = Path(directory) / 'events.jsonl.gz'
+            with gzip.open(dump, 'wt') as file:
+                file.writelines(json.dumps(event) + '\n' for event in events)
+            index_path = Path(directory) / 'isbn.idx'
+            layer_path = Path(directory) / 'catalog-layer.zip'
+
+            summary = build_catalog([dump], index_path, layer_path)
+            self.assertEqual(
+                (summary['items'], summary['not_found'], summary['incomplete'], summary['books']), (4, 1, 1, 1)
+            )
+
+            # The latest event of each book is indexed, without the attributes of the event
+            index = CatalogIndex(index_path)
+            self.assertEqual(index.get('9780306406157'), self.BOOK)
+            self.assertIsNone(index.get('9789876290500'))
+            index.close()
+            with zipfile.ZipFile(layer_path) as layer:
+                self.assertEqual(layer.namelist(), ['catalog/isbn.idx'])
 
 
 if __name__ == '__main__':
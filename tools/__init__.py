@@ -0,0 +1,7 @@
+from pathlib import Path
+import sys
+
+# Move to the scripts/ package folder to reuse the Lambda modules as they are deployed
+scripts_package_path = str(Path(__file__).resolve().parent.parent / 'src' / 'scripts')
+if scripts_package_path not in sys.path:
+    sys.path.insert(0, scripts_package_path)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+
+from datetime import datetime, timezone
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator
+
+from clients import RateLimiter, get_client, get_books_session
+from detections import flush_detections
+from handler import analyze_record, load_record, lookup_books, close_writer
+from metrics import get_metrics
+from writer import BatchWriter
+
+logger = logging.getLogger('backfill')
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+
+class RateLimitedRekognition:
+    """
+    Rekognition client whose DetectText calls are limited by a shared rate limiter.
+    """
+    def __init__(self, client, rate_limiter: RateLimiter):
+        self.client = client
+        self.rate_limiter = rate_limiter
+
+    def detect_text(self, **kwargs) -> dict[str,Any]:
+        self.rate_limiter.acquire()
+        return self.client.detect_text(**kwargs)
+
+
+class Checkpoint:
+    """
+    Append-only JSONL file with the result of every processed image, so that an
+    interrupted run can be resumed by skipping the images which were already loaded.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.completed = set()
+        if path.exists():
+            with path.open() as file:
+                for line in file:
+                    result = json.loads(line)
+                    if result['status'] == 'SUCCESS':
+                        self.completed.add(result['source_id'])
+        self._lock = threading.Lock()
+
+    def record(self, results: list[dict[str,Any]]) -> None:
+        with self._lock, self.path.open('a') as file:
+            for result in results:
+                file.write(json.dumps(result) + '\n')
+                if result['status'] == 'SUCCESS':
+                    self.completed.add(result['source_id'])
+
+
+def _timestamp(value: datetime) -> str:
+    # Same format as the eventTime field of S3 event notifications
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def list_sources(source: str) -> Iterator[tuple[str,dict[str,Any]]]:
+    """
+    List the images of a local directory or an S3 prefix (s3://bucket/prefix) as
+    S3 event records, along with their source identifiers.
+    """
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[5:].partition('/')
+        paginator = get_client('s3').get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if Path(item['Key']).suffix.lower() in IMAGE_SUFFIXES:
+                    record = {
+                        's3': {
+                            'bucket': {'name': bucket},
+                            'object': {'key': item['Key'], 'eTag': item['ETag'].strip('"')}
+                        },
+                        'eventTime': _timestamp(item['LastModified'])
+                    }
+                    yield f's3://{bucket}/{item['Key']}', record
+    else:
+        for path in sorted(Path(source).rglob('*')):
+            if path.suffix.lower() in IMAGE_SUFFIXES:
+                record = {
+                    's3': {'bucket': {'name': None}, 'object': {'key': str(path)}},
+                    'eventTime': _timestamp(datetime.fromtimestamp(path.stat().st_mtime))
+                }
+                yield str(path), record
+
+
+def _chunks(items: Iterator, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def backfill(source: str, table_name: str, checkpoint: Checkpoint, workers: int = 8, chunk_size: int = 100,
+             rekognition_rate: float = 10, books_rate: float = 10, dynamodb_rate: float = 2) -> dict[str,Any]:
+    """
+    Process the images of a local directory or S3 prefix with the pipeline of the Lambda
+    handler on a thread pool, limiting the rate of each downstream service.
+
+    Args:
+        source: Local directory or S3 prefix (s3://bucket/prefix) with the images.
+        table_name: Name of the DynamoDB table where the structured data is stored.
+        checkpoint: Checkpoint with the images which were already loaded.
+        workers: Number of images processed at the same time.
+        chunk_size: Number of images whose results are checkpointed together, once written.
+        rekognition_rate: Maximum DetectText calls per second.
+        books_rate: Maximum Google Books API requests per second.
+        dynamodb_rate: Maximum items written to DynamoDB per second.
+
+    Returns:
+        dict[str,Any]: The summary of the run with counts, duration, throughput and the
+                       latency percentiles of each stage.
+    """
+    rekognition = RateLimitedRekognition(get_client('rekognition'), RateLimiter(rekognition_rate))
+    get_books_session().rate_limiter = RateLimiter(books_rate)
+    dynamodb_limiter = RateLimiter(dynamodb_rate)
+
+    # Stage metrics are reported in the summary instead of being printed as EMF log lines
+    metrics = get_metrics()
+    metrics.emit = False
+
+    def analyze(source_record):
+        source_id, record = source_record
+        # Local images are read from disk and sent to Rekognition as bytes
+        image_bytes = Path(source_id).read_bytes() if record['s3']['bucket']['name'] is None else None
+        result = analyze_record(record, rekognition, image_bytes)
+        result['source_id'] = source_id
+        return result
+
+    summary = {'processed': 0, 'succeeded': 0, 'failed': 0, 'skipped': 0}
+
+    def pending():
+        for source_id, record in list_sources(source):
+            if source_id in checkpoint.completed:
+                summary['skipped'] += 1
+            else:
+                yield source_id, record
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in _chunks(pending(), chunk_size):
+            writer = BatchWriter(table_name, rate_limiter=dynamodb_limiter)
+            results = list(executor.map(analyze, chunk))
+
+            # The ISBN numbers of the chunk are looked up together with combined queries
+            books_data = lookup_books(results)
+            results = list(executor.map(
+                lambda result, source_record: load_record(result, source_record[1], writer, books_data.get(result.get('isbn'))),
+                results, chunk
+            ))
+
+            # Results are only checkpointed once their objects are written to the table
+            close_writer(writer, results)
+            checkpoint.record(results)
+            flush_detections()
+            metrics.flush()
+
+            succeeded = sum(result['status'] == 'SUCCESS' for result in results)
+            summary['processed'] += len(results)
+            summary['succeeded'] += succeeded
+            summary['failed'] += len(results) - succeeded
+            logger.info('Processed %d images (%d skipped)', summary['processed'], summary['skipped'])
+
+    summary['duration_s'] = round(time.perf_counter() - start, 2)
+    summary['images_per_sec'] = round(summary['processed'] / summary['duration_s'], 2) if summary['duration_s'] else 0.0
+    summary['stages'] = metrics.summary()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Process archived cover images from a local directory or an S3 prefix (s3://bucket/prefix).'
+    )
+    parser.add_argument('source', help='Local directory or S3 prefix with the images')
+    parser.add_argument('--table', default=os.getenv('TABLE_NAME', 'isbn_events'), help='DynamoDB table name')
+    parser.add_argument('--checkpoint', type=Path, default=Path('backfill.checkpoint.jsonl'), help='Checkpoint file')
+    parser.add_argument('--workers', type=int, default=8, help='Images processed at the same time')
+    parser.add_argument('--chunk-size', type=int, default=100, help='Images checkpointed together')
+    parser.add_argument('--rekognition-rate', type=float, default=10, help='DetectText calls per second')
+    parser.add_argument('--books-rate', type=float, default=10, help='Google Books requests per second')
+    parser.add_argument('--dynamodb-rate', type=float, default=2, help='DynamoDB items written per second')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    summary = backfill(
+        args.source, args.table, Checkpoint(args.checkpoint), args.workers, args.chunk_size,
+        args.rekognition_rate, args.books_rate, args.dynamodb_rate
+    )
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import gzip
+import json
+import logging
+import zipfile
+import argparse
+
+from pathlib import Path
+from typing import Any, Iterator
+
+from catalog import CatalogIndex, write_index
+from isbn import normalize_isbn
+
+logger = logging.getLogger('catalog')
+
+# Path of the index within the layer, which Lambda extracts under /opt as CATALOG_PATH expects
+LAYER_INDEX_PATH = 'catalog/isbn.idx'
+
+def read_dump(path: Path) -> Iterator[dict[str,Any]]:
+    """
+    Read the items of a JSONL dump, such as an export of the isbn_events table, which is
+    decompressed if its name ends with .gz.
+
+    Yields:
+        dict[str,Any]: The item of each non-empty line.
+    """
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def select_books(items: Iterator[dict[str,Any]]) -> tuple[list[dict[str,Any]], dict[str,int]]:
+    """
+    Select the latest found book data of each ISBN number among the items of the dumps,
+    leaving out the events without matching results and the incomplete items, which include
+    the items whose number is not a valid ISBN (e.g., an identifier of another type).
+
+    Returns:
+        tuple[list[dict[str,Any]], dict[str,int]]: The selected books, and the number of read,
+                                                   not found and incomplete items.
+    """
+    books = {}
+    counts = {'items': 0, 'not_found': 0, 'incomplete': 0}
+    for item in items:
+        counts['items'] += 1
+        if item.get('exception', 0) != 0:
+            counts['not_found'] += 1
+            continue
+        isbn = normalize_isbn(str(item.get('isbn', '')))
+        if isbn is None or not item.get('title'):
+            counts['incomplete'] += 1
+            continue
+        # Items of the ISBN-10 and ISBN-13 forms of a number are the same book
+        latest = books.get(isbn)
+        if latest is None or item.get('timestamp', '') >= latest.get('timestamp', ''):
+            books[isbn] = item
+    return list(books.values()), counts
+
+
+def build_catalog(dumps: list[Path], index_path: Path, layer_path: Path | None = None) -> dict[str,Any]:
+    """
+    Build the sorted, memory-mapped index of the known books of some JSONL dumps, optionally
+    packaged as the ZIP file of a Lambda layer.
+
+    Args:
+        dumps: Paths of the JSONL dumps, optionally gzip-compressed.
+        index_path: Path of the index file.
+        layer_path: Optional path of the ZIP file of the layer.
+
+    Returns:
+        dict[str,Any]: The summary of the build with the number of books and the size of the index.
+    """
+    books, counts = select_books(item for dump in dumps for item in read_dump(dump))
+    summary = {**counts, 'books': write_index(books, index_path), 'index_bytes': index_path.stat().st_size}
+
+    if layer_path is not None:
+        with zipfile.ZipFile(layer_path, 'w', compression=zipfile.ZIP_DEFLATED) as layer:
+            layer.write(index_path, LAYER_INDEX_PATH)
+        summary['layer_bytes'] = layer_path.stat().st_size
+
+    logger.info('Indexed %d books of %d items into %s', summary['books'], summary['items'], index_path)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or read the bundled catalog of known books.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build the index from JSONL dumps')
+    build_parser.add_argument('dumps', type=Path, nargs='+', help='JSONL dumps (e.g., events.jsonl.gz)')
+    build_parser.add_argument('--output', type=Path, default=Path('isbn.idx'), help='Index file')
+    build_parser.add_argument('--layer', type=Path, help='ZIP file of the Lambda layer (e.g., catalog-layer.zip)')
+
+    lookup_parser = subparsers.add_parser('lookup', help='Look up ISBN numbers in an index')
+    lookup_parser.add_argument('index', type=Path, help='Index file')
+    lookup_parser.add_argument('isbns', nargs='+', help='ISBN-10 or ISBN-13 numbers')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command == 'build':
+        print(json.dumps(build_catalog(args.dumps, args.output, args.layer), indent=4))
+        return
+
+    index = CatalogIndex(args.index)
+    for isbn in args.isbns:
+        print(json.dumps({'isbn': isbn, 'book_data': index.get(isbn)}))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
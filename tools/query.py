@@ -0,0 +1,377 @@
+import os
+import gzip
+import json
+import queue
+import logging
+import argparse
+import threading
+import importlib.util
+
+from datetime import date, timedelta
+from decimal import Decimal
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from boto3.dynamodb.conditions import Attr, Key, ConditionBase
+from botocore.exceptions import ClientError
+from aggregates import isbn_key, day_key, exception_key
+from clients import get_table
+
+logger = logging.getLogger('query')
+
+# Global secondary indexes of the isbn_events table, as defined in cdk/stack.py
+DAY_INDEX_NAME = 'day-index'
+EXCEPTION_INDEX_NAME = 'exception-index'
+
+# Table of the counters kept up to date by the stream consumer of the isbn_events table
+AGGREGATES_TABLE_NAME = 'isbn_aggregates'
+
+# PyArrow is only required to export Parquet files
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+# Columns of the Parquet files, where the attributes missing from an item are null
+PARQUET_COLUMNS = {
+    'isbn': 'string',
+    'timestamp': 'string',
+    'day': 'string',
+    'exception': 'int64',
+    'title': 'string',
+    'authors': 'list<string>',
+    'categories': 'list<string>',
+    'page_count': 'int64',
+    'language': 'string',
+    'publisher': 'string',
+    'year': 'int64'
+}
+
+def _plain(value: Any) -> Any:
+    # The Table resource returns numbers as Decimal, which are not serializable as JSON
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, set)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _days(start: date, end: date) -> Iterator[str]:
+    for offset in range((end - start).days + 1):
+        yield (start + timedelta(days=offset)).isoformat()
+
+
+def paginate(table_name: str, **kwargs: Any) -> Iterator[dict[str,Any]]:
+    """
+    Query a DynamoDB table or index, following LastEvaluatedKey until every page is read.
+
+    Args:
+        table_name: Name of the DynamoDB table.
+        kwargs: Parameters of the Query request (e.g., IndexName, KeyConditionExpression).
+
+    Yields:
+        dict[str,Any]: The items of each page, with numbers as int or float.
+    """
+    table = get_table(table_name)
+    while True:
+        response = table.query(**kwargs)
+        for item in response.get('Items', []):
+            yield _plain(item)
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_events(table_name: str, start: date, end: date,
+                 language: str | None = None, year: int | None = None) -> Iterator[dict[str,Any]]:
+    """
+    Get the events of a range of days through the day index, in chronological order.
+
+    Args:
+        table_name: Name of the DynamoDB table.
+        start: First day of the range.
+        end: Last day of the range, included.
+        language: Optional language code of the books (e.g., ES).
+        year: Optional publication year of the books.
+
+    Yields:
+        dict[str,Any]: The items of the events.
+    """
+    condition = None
+    if language is not None:
+        condition = Attr('language').eq(language.upper())
+    if year is not None:
+        condition = Attr('year').eq(year) if condition is None else condition & Attr('year').eq(year)
+
+    for day in _days(start, end):
+        kwargs = {'IndexName': DAY_INDEX_NAME, 'KeyConditionExpression': Key('day').eq(day)}
+        if condition is not None:
+            kwargs['FilterExpression'] = condition
+        yield from paginate(table_name, **kwargs)
+
+
+def query_exceptions(table_name: str, start: date, end: date) -> Iterator[dict[str,Any]]:
+    """
+    Get the events of ISBN numbers without matching results in a range of days through the
+    sparse exception index, which only holds those events.
+
+    Yields:
+        dict[str,Any]: The keys of the events (isbn, timestamp and exception_day).
+    """
+    for day in _days(start, end):
+        yield from paginate(
+            table_name, IndexName=EXCEPTION_INDEX_NAME, KeyConditionExpression=Key('exception_day').eq(day)
+        )
+
+
+def get_aggregate(key: str, table_name: str = AGGREGATES_TABLE_NAME) -> dict[str,int]:
+    """
+    Read the counters of an aggregate key with a single GetItem request.
+
+    Returns:
+        dict[str,int]: The number of events and of events without matching results, which are 0
+                       for keys without events.
+    """
+    item = get_table(table_name).get_item(Key={'pk': key}).get('Item', {})
+    return {'events': int(item.get('events', 0)), 'not_found': int(item.get('not_found', 0))}
+
+
+def isbn_count(isbn: str, table_name: str = AGGREGATES_TABLE_NAME) -> int:
+    """
+    Get how many times an ISBN number was scanned.
+    """
+    return get_aggregate(isbn_key(isbn), table_name)['events']
+
+
+def day_stats(day: date, table_name: str = AGGREGATES_TABLE_NAME) -> dict[str,Any]:
+    """
+    Get the number of events of a day and the share of them without matching results.
+    """
+    counters = get_aggregate(day_key(day.isoformat()), table_name)
+    counters['not_found_rate'] = round(counters['not_found'] / counters['events'], 4) if counters['events'] else 0.0
+    return counters
+
+
+def exception_count(exception: int, table_name: str = AGGREGATES_TABLE_NAME) -> int:
+    """
+    Get the number of events with an exception flag, 0 for found books and 1 for the rest.
+    """
+    return get_aggregate(exception_key(exception), table_name)['events']
+
+
+def scan_segment(table_name: str, segment: int, total_segments: int, page_size: int | None = None,
+                 condition: ConditionBase | None = None) -> Iterator[list[dict[str,Any]]]:
+    """
+    Scan a segment of a DynamoDB table page by page.
+
+    Args:
+        condition: Optional filter of the scanned items, which is applied after each page is read.
+
+    Yields:
+        list[dict[str,Any]]: The items of each page, with numbers as int or float.
+    """
+    table = get_table(table_name)
+    kwargs = {'Segment': segment, 'TotalSegments': total_segments}
+    if page_size is not None:
+        kwargs['Limit'] = page_size
+    if condition is not None:
+        kwargs['FilterExpression'] = condition
+    while True:
+        response = table.scan(**kwargs)
+        yield [_plain(item) for item in response.get('Items', [])]
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+@contextmanager
+def _jsonl_writer(path: Path) -> Iterator[Callable[[list[dict[str,Any]]], None]]:
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        yield lambda items: file.writelines(json.dumps(item) + '\n' for item in items)
+
+
+@contextmanager
+def _parquet_writer(path: Path) -> Iterator[Callable[[list[dict[str,Any]]], None]]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'string': pa.string(), 'int64': pa.int64(), 'list<string>': pa.list_(pa.string())}
+    schema = pa.schema([(name, types[column_type]) for name, column_type in PARQUET_COLUMNS.items()])
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        yield lambda items: writer.write_table(pa.Table.from_pylist(items, schema=schema))
+
+
+def export_table(table_name: str, path: Path, file_format: str = 'jsonl', segments: int = 4,
+                 page_size: int | None = None) -> dict[str,Any]:
+    """
+    Export a DynamoDB table with a parallel scan into a gzip-compressed JSONL file or a
+    Parquet file. The pages of the segments are written as they arrive through a bounded
+    queue, so that only a few pages are held in memory at the same time.
+
+    Args:
+        table_name: Name of the DynamoDB table.
+        path: Path of the exported file.
+        file_format: Format of the exported file, either jsonl or parquet.
+        segments: Number of segments scanned at the same time.
+        page_size: Optional maximum number of items of each page.
+
+    Returns:
+        dict[str,Any]: The summary of the export with the number of items and pages.
+
+    Raises:
+        ValueError: If the format is not supported.
+        RuntimeError: If the format is parquet and PyArrow is not installed.
+    """
+    if file_format == 'jsonl':
+        open_writer = _jsonl_writer
+    elif file_format == 'parquet':
+        if not PARQUET_AVAILABLE:
+            raise RuntimeError('Parquet exports require PyArrow')
+        open_writer = _parquet_writer
+    else:
+        raise ValueError(f'Invalid export format: {file_format}')
+
+    pages = queue.Queue(maxsize=segments * 2)
+    stopped = threading.Event()
+
+    def scan(segment):
+        # Every segment ends with None, even if the scan fails, so that the writer is not left waiting
+        try:
+            for page in scan_segment(table_name, segment, segments, page_size):
+                if stopped.is_set():
+                    return
+                pages.put(page)
+        finally:
+            pages.put(None)
+
+    summary = {'items': 0, 'pages': 0}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(scan, segment) for segment in range(segments)]
+        finished = 0
+        try:
+            with open_writer(path) as write:
+                while finished < segments:
+                    page = pages.get()
+                    if page is None:
+                        finished += 1
+                    elif page:
+                        write(page)
+                        summary['items'] += len(page)
+                        summary['pages'] += 1
+        finally:
+            # Release the segments blocked on a full queue if the writer fails
+            stopped.set()
+            while finished < segments:
+                finished += pages.get() is None
+
+    for future in futures:
+        future.result()
+
+    logger.info('Exported %d items of table %s to %s', summary['items'], table_name, path)
+    return summary
+
+
+def backfill_days(table_name: str, segments: int = 4, page_size: int | None = None) -> dict[str,int]:
+    """
+    Add the 'day' attribute, and the 'exception_day' attribute of the events without matching
+    results, to the items written before the indexes of the read side, so that query_events
+    and query_exceptions find them. The items missing the attribute are found with a parallel
+    scan and updated one by one, which can be run again safely since updated items are skipped.
+    Updates are MODIFY events of the stream, so the aggregates do not count them again.
+
+    Returns:
+        dict[str,int]: The number of updated items and of those without matching results.
+    """
+    def backfill(segment):
+        table = get_table(table_name)
+        counts = {'updated': 0, 'exceptions': 0}
+        for page in scan_segment(table_name, segment, segments, page_size, Attr('day').not_exists()):
+            for item in page:
+                day = item['timestamp'][:10]
+                update = 'SET #day = :day, exception_day = :day' if item.get('exception') == 1 else 'SET #day = :day'
+                try:
+                    table.update_item(
+                        Key={'isbn': item['isbn'], 'timestamp': item['timestamp']},
+                        UpdateExpression=update,
+                        # Items deleted since the scan are not created again with only these attributes
+                        ConditionExpression='attribute_exists(isbn)',
+                        ExpressionAttributeNames={'#day': 'day'},
+                        ExpressionAttributeValues={':day': day}
+                    )
+                except ClientError as err:
+                    if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                        continue
+                    raise
+                counts['updated'] += 1
+                counts['exceptions'] += item.get('exception') == 1
+        return counts
+
+    summary = {'updated': 0, 'exceptions': 0}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for counts in executor.map(backfill, range(segments)):
+            summary['updated'] += counts['updated']
+            summary['exceptions'] += counts['exceptions']
+
+    logger.info('Added the day of %d items of table %s', summary['updated'], table_name)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or export the ISBN events of the DynamoDB table.')
+    parser.add_argument('--table', default=os.getenv('TABLE_NAME', 'isbn_events'), help='DynamoDB table name')
+    parser.add_argument('--aggregates-table', default=AGGREGATES_TABLE_NAME, help='DynamoDB table of the aggregates')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    events_parser = subparsers.add_parser('events', help='Events of a range of days')
+    exceptions_parser = subparsers.add_parser('exceptions', help='Events without matching results of a range of days')
+    for subparser in (events_parser, exceptions_parser):
+        subparser.add_argument('--start', type=date.fromisoformat, required=True, help='First day (YYYY-MM-DD)')
+        subparser.add_argument('--end', type=date.fromisoformat, default=date.today(), help='Last day (YYYY-MM-DD)')
+    events_parser.add_argument('--language', help='Language code of the books (e.g., ES)')
+    events_parser.add_argument('--year', type=int, help='Publication year of the books')
+
+    count_parser = subparsers.add_parser('count', help='Times an ISBN number was scanned')
+    count_parser.add_argument('isbn', help='ISBN-13 number')
+    day_parser = subparsers.add_parser('day', help='Events and not-found rate of a day')
+    day_parser.add_argument('day', type=date.fromisoformat, nargs='?', default=date.today(), help='Day (YYYY-MM-DD)')
+
+    export_parser = subparsers.add_parser('export', help='Export the whole table with a parallel scan')
+    export_parser.add_argument('path', type=Path, help='Exported file (e.g., events.jsonl.gz or events.parquet)')
+    export_parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl', help='Exported format')
+    export_parser.add_argument('--segments', type=int, default=4, help='Segments scanned at the same time')
+    export_parser.add_argument('--page-size', type=int, help='Maximum items of each scanned page')
+
+    backfill_parser = subparsers.add_parser('backfill-days', help='Add the day attributes to the items written before the indexes')
+    backfill_parser.add_argument('--segments', type=int, default=4, help='Segments scanned at the same time')
+    backfill_parser.add_argument('--page-size', type=int, help='Maximum items of each scanned page')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command == 'export':
+        summary = export_table(args.table, args.path, args.format, args.segments, args.page_size)
+        print(json.dumps(summary, indent=4))
+        return
+
+    if args.command == 'backfill-days':
+        print(json.dumps(backfill_days(args.table, args.segments, args.page_size), indent=4))
+        return
+
+    if args.command == 'count':
+        print(json.dumps({'isbn': args.isbn, 'events': isbn_count(args.isbn, args.aggregates_table)}))
+        return
+    if args.command == 'day':
+        print(json.dumps({'day': args.day.isoformat(), **day_stats(args.day, args.aggregates_table)}))
+        return
+
+    if args.command == 'events':
+        items = query_events(args.table, args.start, args.end, args.language, args.year)
+    else:
+        items = query_exceptions(args.table, args.start, args.end)
+    for item in items:
+        print(json.dumps(item))
+
+
+if __name__ == '__main__':
+    main()
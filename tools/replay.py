@@ -0,0 +1,241 @@
+import os
+import re
+import gzip
+import json
+import time
+import logging
+import argparse
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator
+
+from clients import get_client, get_table
+from handler import load_record, lookup_books, close_writer, event_timestamp, NO_ISBN_ERROR, MULTI_BOOK
+from isbn import extract_isbn, extract_books
+from metrics import get_metrics
+from writer import BatchWriter
+
+logger = logging.getLogger('replay')
+
+# Day partition of the archived objects (e.g., detections/dt=2025-01-01/...)
+DAY_PATTERN = re.compile(r'dt=(\d{4}-\d{2}-\d{2})')
+
+def _in_range(name: str, start_day: str | None, end_day: str | None) -> bool:
+    match = DAY_PATTERN.search(name)
+    if match is None:
+        return start_day is None and end_day is None
+    return (start_day is None or match.group(1) >= start_day) and (end_day is None or match.group(1) <= end_day)
+
+
+def list_archives(source: str, start_day: str | None = None, end_day: str | None = None) -> Iterator[str]:
+    """
+    List the gzip-compressed JSONL objects of the detection archive under an S3 prefix
+    (s3://bucket/prefix) or a local directory, in order and within an optional range of days.
+    """
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[5:].partition('/')
+        paginator = get_client('s3').get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.jsonl.gz') and _in_range(item['Key'], start_day, end_day):
+                    yield f's3://{bucket}/{item['Key']}'
+    else:
+        paths = [Path(source)] if Path(source).is_file() else sorted(Path(source).rglob('*.jsonl.gz'))
+        for path in paths:
+            if _in_range(str(path), start_day, end_day):
+                yield str(path)
+
+
+def read_archive(archive: str) -> Iterator[dict[str,Any]]:
+    """
+    Read the entries of an archived object as a stream, decompressing it line by line.
+
+    Yields:
+        dict[str,Any]: The bucket, key, event time and detections of each analyzed image.
+    """
+    if archive.startswith('s3://'):
+        bucket, _, key = archive[5:].partition('/')
+        body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    else:
+        body = open(archive, 'rb')
+    try:
+        with gzip.GzipFile(fileobj=body) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        body.close()
+
+
+def parse_entry(entry: dict[str,Any], multi_book: bool = MULTI_BOOK) -> tuple[dict[str,Any], dict[str,Any]]:
+    """
+    Parse the archived detections of an image with the current ISBN parsers, in the same way
+    as analyze_record does with a DetectText response.
+
+    Returns:
+        tuple[dict[str,Any], dict[str,Any]]: The partial result of the image, and the S3 event
+                                             record which gives its items their original keys.
+    """
+    record = {
+        's3': {'bucket': {'name': entry['bucket']}, 'object': {'key': entry['key']}},
+        'eventTime': entry['event_time']
+    }
+    result = {'bucket': entry['bucket'], 'key': entry['key'], 'source': 'replay'}
+
+    if multi_book:
+        isbns = [book['isbn'] for book in extract_books(entry['detections'])]
+        if isbns:
+            result['isbns'] = isbns
+    else:
+        isbn = extract_isbn(entry['detections'])
+        if isbn is not None:
+            result['isbn'] = isbn
+
+    if 'isbn' not in result and 'isbns' not in result:
+        result['status'] = 'FAILED'
+        result['error'] = NO_ISBN_ERROR
+    return result, record
+
+
+def _parsed_isbns(result: dict[str,Any]) -> list[str]:
+    return result.get('isbns') or ([result['isbn']] if 'isbn' in result else [])
+
+
+def stale_keys(entry: dict[str,Any], written: list[dict[str,Any]]) -> list[dict[str,str]]:
+    """
+    Get the keys of the items originally written for an image which were not written again by
+    the replay, since their ISBN number or position changed. Items are keyed by the ISBN number
+    of the provider, which can differ from the parsed one (e.g., its ISBN-10 form), so the keys
+    archived along with the detections are used. Entries archived before them, or whose lookup
+    was deferred, only have the parsed numbers, whose keys are rebuilt instead.
+    """
+    if 'keys' in entry:
+        previous = [(key['isbn'], key['timestamp']) for key in entry['keys']]
+    else:
+        isbns = entry.get('isbns', [])
+        previous = [
+            (isbn, event_timestamp(entry['event_time'], position, len(isbns))) for position, isbn in enumerate(isbns)
+        ]
+    keys = {(item['isbn'], item['timestamp']) for item in written}
+    return [{'isbn': isbn, 'timestamp': timestamp} for isbn, timestamp in previous if (isbn, timestamp) not in keys]
+
+
+def _chunks(items: Iterator, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay(source: str, table_name: str, workers: int = 8, chunk_size: int = 100, multi_book: bool = MULTI_BOOK,
+           start_day: str | None = None, end_day: str | None = None, dry_run: bool = False) -> dict[str,Any]:
+    """
+    Derive the items of the isbn_events table again from the detection archive, parsing each
+    image with the current ISBN parsers and structuring its book data on a thread pool, without
+    calling Rekognition. Items are written under the keys of their original events, so that a
+    replay overwrites them instead of adding new events, and can be run again safely. Items of
+    numbers which are no longer parsed from an image are deleted once its new items are written.
+
+    Args:
+        source: S3 prefix (s3://bucket/prefix) or local directory of the archive.
+        table_name: Name of the DynamoDB table where the structured data is stored.
+        workers: Number of images parsed and loaded at the same time.
+        chunk_size: Number of images whose ISBN numbers are looked up together.
+        multi_book: Whether the ISBN number of every book of each image is extracted.
+        start_day: Optional first day of the replayed partitions (e.g., 2025-01-01).
+        end_day: Optional last day of the replayed partitions.
+        dry_run: Whether the images are only parsed, without looking up or writing their books.
+
+    Returns:
+        dict[str,Any]: The summary of the run with counts, duration, throughput and the
+                       latency percentiles of each stage.
+    """
+    # Stage metrics are reported in the summary instead of being printed as EMF log lines
+    metrics = get_metrics()
+    metrics.emit = False
+
+    summary = {
+        'archives': 0, 'images': 0, 'changed': 0, 'succeeded': 0, 'failed': 0, 'deferred': 0,
+        'no_isbn': 0, 'items': 0, 'deleted': 0
+    }
+
+    def entries():
+        for archive in list_archives(source, start_day, end_day):
+            summary['archives'] += 1
+            yield from read_archive(archive)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in _chunks(entries(), chunk_size):
+            parsed = list(executor.map(lambda entry: parse_entry(entry, multi_book), chunk))
+            results = [result for result, _ in parsed]
+            changed = [_parsed_isbns(result) != entry.get('isbns', []) for result, entry in zip(results, chunk)]
+            summary['changed'] += sum(changed)
+
+            if not dry_run:
+                writer = BatchWriter(table_name)
+                books_data = lookup_books(results)
+                results = list(executor.map(
+                    lambda result, record: load_record(result, record, writer, books_data.get(result.get('isbn'))),
+                    results, [record for _, record in parsed]
+                ))
+                written = [[result['item']] if 'item' in result else result.get('items', []) for result in results]
+                close_writer(writer, results)
+
+                # Stale items are only deleted once the items which replace them were written
+                for entry, result, items, image_changed in zip(chunk, results, written, changed):
+                    if result['status'] != 'SUCCESS':
+                        continue
+                    summary['items'] += len(items)
+                    # With archived keys, a number answered differently by the provider is stale as well
+                    if not image_changed and 'keys' not in entry:
+                        continue
+                    for key in stale_keys(entry, items):
+                        response = get_table(table_name).delete_item(Key=key, ReturnValues='ALL_OLD')
+                        summary['deleted'] += 'Attributes' in response
+                metrics.flush()
+
+            statuses = [result.get('status') for result in results]
+            summary['images'] += len(results)
+            summary['succeeded'] += statuses.count('SUCCESS')
+            summary['failed'] += statuses.count('FAILED')
+            summary['deferred'] += statuses.count('DEFERRED')
+            summary['no_isbn'] += sum(result.get('error') == NO_ISBN_ERROR for result in results)
+            logger.info('Replayed %d images of %d archives', summary['images'], summary['archives'])
+
+    summary['duration_s'] = round(time.perf_counter() - start, 2)
+    summary['images_per_sec'] = round(summary['images'] / summary['duration_s'], 2) if summary['duration_s'] else 0.0
+    summary['stages'] = metrics.summary()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Derive the isbn_events items again from the archive of raw Rekognition detections.'
+    )
+    parser.add_argument('source', help='S3 prefix (s3://bucket/detections/) or local directory of the archive')
+    parser.add_argument('--table', default=os.getenv('TABLE_NAME', 'isbn_events'), help='DynamoDB table name')
+    parser.add_argument('--workers', type=int, default=8, help='Images parsed and loaded at the same time')
+    parser.add_argument('--chunk-size', type=int, default=100, help='Images whose ISBN numbers are looked up together')
+    parser.add_argument('--multi-book', action='store_true', default=MULTI_BOOK, help='Extract every book of each image')
+    parser.add_argument('--start-day', help='First day of the replayed partitions (e.g., 2025-01-01)')
+    parser.add_argument('--end-day', help='Last day of the replayed partitions')
+    parser.add_argument('--dry-run', action='store_true', help='Only parse the images, without writing items')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    summary = replay(
+        args.source, args.table, args.workers, args.chunk_size, args.multi_book,
+        args.start_day, args.end_day, args.dry_run
+    )
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == '__main__':
+    main()